@@ -16,6 +16,7 @@ from skimage.segmentation import find_boundaries
 from scipy.stats import pearsonr
 from scipy import r_, degrees
 import tempfile
+from utils.isce_raster import open_image
 class FeaturesExtractor:
     def __init__(self, url, productName, coThr=None):
         self._eps = 10**-20
@@ -216,13 +217,10 @@ class FeaturesExtractor:
         self.getDemAndWbd(geoname, [self._demName,self._wbdName])
 
     def loadImage(self, imgxml,band=None):
-        if imgxml == self._imgMap['dem']['name']:
-            img = createDemImage()
-        else:
-            img = createImage()
-        img.load(imgxml)
-        img.filename = os.path.basename(img.filename)
-        return img.memMap(band=band)
+        img = open_image(imgxml)
+        if band is None:
+            return img.data
+        return img.band(band)
     
     def loadImages(self):
         for k,v in self._imgMap.items():
@@ -513,9 +513,56 @@ class Sentinel1_TOPS(Component):
 
 
 
-    def mergeDeramped(self):
+    def burstLimits(self):
         '''
-        Merge deramped SLCs into single file.
+        Line limits [start, end) of the valid lines of each burst in the merged swath.
+        '''
+        t0 = self.bursts[0].sensingStart
+        dt = self.bursts[0].azimuthTimeInterval
+
+        tstart = t0 + datetime.timedelta(seconds = (dt*self.bursts[0].firstValidLine))
+        tend   = self.bursts[-1].sensingStart + datetime.timedelta(seconds=((self.bursts[-1].firstValidLine + self.bursts[-1].numValidLines-1) * dt))
+
+        nLines = int( np.round((tend - tstart).total_seconds() / dt)) + 1
+        print('Expected nLines: ', nLines)
+
+        azMasterOff = []
+        for index, burst in enumerate(self.bursts):
+            soff = burst.sensingStart + datetime.timedelta(seconds = (burst.firstValidLine*dt)) 
+            start = int(np.round((soff - tstart).total_seconds() / dt))
+            end = start + burst.numValidLines
+
+            azMasterOff.append([start,end])
+
+            print('Burst: ', index, [start,end])
+
+        return nLines, azMasterOff
+
+    def mergeDeramped(self, blockLines=1024, maxFFT=None):
+        '''
+        Merge deramped SLCs into single file. Bursts are memory mapped once and
+        written into an output memory map in blocks of lines (see mergeBursts).
+        '''
+
+        width = self.bursts[0].numberOfSamples
+        nLines, azMasterOff = self.burstLimits()
+
+        outfile = os.path.join(self.outdir, 'merged.slc')
+        bursts = [(burst.derampimage.filename, burst.firstValidLine, burst.numValidLines) for burst in self.bursts]
+        mergeBursts(bursts, azMasterOff, width, outfile, blockLines=blockLines, maxFFT=maxFFT)
+
+        img = isceobj.createSlcImage()
+        img.setWidth(width)
+        img.setAccessMode('READ')
+        img.setFilename(outfile)
+
+        img.createImage()
+        img.renderHdr()
+        img.finalizeImage()
+
+    def mergeDerampedFull(self):
+        '''
+        Merge deramped SLCs into single file, in memory. Reference for mergeDeramped.
         '''
 
         nBursts = len(self.bursts)
@@ -616,6 +663,93 @@ def getOffset(mas, slv):
 
     return res
 
+def getOverlapOffset(mas, slv, xpos=(4096, 8192, 16384), win=1024, maxFFT=None):
+    '''
+    Same as getOffset for the overlap windows only. Windows outside the swath are
+    skipped and, with maxFFT, the window is cropped to at most maxFFT lines and
+    samples around its center.
+    '''
+    nLines, width = mas.shape
+    if maxFFT is not None:
+        cwin = min(win, maxFFT)
+        r0 = max((nLines - maxFFT)//2, 0)
+        r1 = min(r0 + maxFFT, nLines)
+    else:
+        cwin = win
+        r0, r1 = 0, nLines
+
+    res = []
+    for x0 in xpos:
+        if x0 + win > width:
+            continue
+        c0 = x0 + (win - cwin)//2
+        m1 = np.fft.fft2(np.abs(mas[r0:r1,c0:c0+cwin]))
+        m2 = np.fft.fft2(np.abs(slv[r0:r1,c0:c0+cwin]))
+        g = np.abs(np.fft.ifft2(m1 * np.conj(m2)))
+        res.append(np.unravel_index(g.argmax(), g.shape))
+
+    return res
+
+
+def mergeBursts(bursts, limits, width, outfile, blockLines=1024, maxFFT=None):
+    '''
+    Merge bursts [(filename, firstValidLine, numValidLines)] with valid line
+    limits [start, end) in the output into a memory mapped output file. Overlaps
+    are averaged. Each burst file is memory mapped once and at most blockLines
+    lines are in memory at a time, whatever the number of bursts.
+    '''
+    nLines = limits[-1][1] - limits[0][0]
+    out = np.memmap(outfile, dtype=np.complex64, mode='w+', shape=(nLines, width))
+    base = limits[0][0]
+
+    def copyLines(dst0, src, s0, s1, other=None, o0=0):
+        for k0 in range(s0, s1, blockLines):
+            k1 = min(k0 + blockLines, s1)
+            if other is None:
+                out[dst0 + k0 - s0: dst0 + k1 - s0] = src[k0:k1]
+            else:
+                out[dst0 + k0 - s0: dst0 + k1 - s0] = 0.5*(src[k0:k1] + other[o0 + k0 - s0: o0 + k1 - s0])
+
+    topData = None
+    for index, (fname, firstValid, numValid) in enumerate(bursts):
+        raw = np.memmap(fname, dtype=np.complex64, mode='r')
+        curData = raw.reshape((-1, width))[firstValid: firstValid + numValid,:]
+        curLimit = limits[index]
+
+        #####If middle burst
+        if index > 0:
+            topLimit = limits[index-1]
+            olap = topLimit[1] - curLimit[0]
+
+            if olap <= 0:
+                raise Exception('No Burst Overlap')
+
+            print('Offsets: ', index, getOverlapOffset(topData[-olap:,:], curData[:olap,:], maxFFT=maxFFT))
+
+            copyLines(curLimit[0] - base, topData, topData.shape[0] - olap, topData.shape[0], curData, 0)
+            tlim = olap
+        else:
+            tlim = 0
+
+        if index != (len(bursts)-1):
+            botLimit = limits[index+1]
+
+            if curLimit[1] - botLimit[0] < 0:
+                raise Exception('No Burst Overlap')
+
+            blim = botLimit[0] - curLimit[0]
+        else:
+            blim = curData.shape[0]
+
+        copyLines(curLimit[0] - base + tlim, curData, tlim, blim)
+
+        ####Only the previous burst map is kept open
+        topData = curData
+
+    out.flush()
+    del out
+
+
 def createParser():
     import argparse
 
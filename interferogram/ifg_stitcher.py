@@ -9,17 +9,107 @@ import isce
 from isceobj.Image.Image import Image
 from isceobj.Image.BILImage import BILImage
 from utils.imutils import *
+from utils.isce_raster import RasterImage
 from utils.UrlUtils import UrlUtils
 import shutil
 import argparse
 import json
 import tempfile
 import copy
+import hashlib
 from contrib.UnwrapComp.unwrapComponents import UnwrapComponents
 
 WATER_VALUE = 255
 #if changing the WATER_VALUE back to negative chenge this line np.logical_and(uim1 > 0,uim1 < WATER_VALUE)
 
+#persist the intermediate mosaics of a stitch into a work dir so that a restarted
+#job can resume from the last completed stage. the manifest records the checksums of the
+#inputs, and for each completed stage the arrays saved and the mosaic size.
+#a completed stitch leaves a 'stitch' stage with the checksums of its outputs
+class StitchCheckpoint:
+    def __init__(self,work_dir,inputs):
+        self._work_dir = work_dir
+        self._manifest_name = os.path.join(work_dir,'manifest.json')
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        self._inputs = {}
+        for name in inputs:
+            self._inputs[name] = self.checksum(name)
+        self._manifest = {'inputs':self._inputs,'stages':{}}
+        if os.path.exists(self._manifest_name):
+            manifest = json.load(open(self._manifest_name))
+            if manifest['inputs'] == self._inputs or self.stitched_inputs(manifest):
+                self._manifest = manifest
+            else:
+                print('Inputs changed since last checkpoint. Discarding',work_dir)
+                self.clear()
+    
+    #the stitch outputs overwrite some of the inputs (e.g. the cor of the first frame),
+    #so after a completed stitch an input can also match the output it was replaced by
+    def stitched_inputs(self,manifest):
+        if 'stitch' not in manifest['stages'] or set(manifest['inputs']) != set(self._inputs):
+            return False
+        outputs = manifest['stages']['stitch']['info']['outputs']
+        return all(self._inputs[n] in (manifest['inputs'][n],outputs.get(n)) for n in self._inputs)
+    
+    def checksum(self,fname,bsize=2**22):
+        md5 = hashlib.md5()
+        with open(fname,'rb') as fp:
+            for block in iter(lambda: fp.read(bsize),b''):
+                md5.update(block)
+        return md5.hexdigest()
+    
+    def write_manifest(self):
+        tmp = self._manifest_name + '.tmp'
+        json.dump(self._manifest,open(tmp,'w'),indent=2,sort_keys=True,default=lambda x: x.item())
+        os.rename(tmp,self._manifest_name)
+    
+    def clear(self):
+        for fname in os.listdir(self._work_dir):
+            if fname.endswith('.npy'):
+                os.remove(os.path.join(self._work_dir,fname))
+        self._manifest = {'inputs':self._inputs,'stages':{}}
+        self.write_manifest()
+    
+    def has(self,stage):
+        return stage in self._manifest['stages']
+    
+    #drop a stage superseded by a later one
+    def remove(self,stage):
+        st = self._manifest['stages'].pop(stage,None)
+        if st is None:
+            return
+        self.write_manifest()
+        for fname in st['arrays']:
+            if os.path.exists(os.path.join(self._work_dir,fname)):
+                os.remove(os.path.join(self._work_dir,fname))
+    
+    #drop all the stages starting with prefix
+    def remove_all(self,prefix):
+        for stage in list(self._manifest['stages']):
+            if stage.startswith(prefix):
+                self.remove(stage)
+    
+    #save the mosaic arrays (image,conncomp,cor,extras...), size and image info of a stage
+    def save(self,stage,arrays,size,info):
+        fnames = []
+        for i,arr in enumerate(arrays):
+            fname = stage + '_' + str(i) + '.npy'
+            np.save(os.path.join(self._work_dir,fname),arr)
+            fnames.append(fname)
+        #only record the stage once all the arrays are on disk
+        self._manifest['stages'][stage] = {'arrays':fnames,'size':size,'info':info}
+        self.write_manifest()
+        print('Checkpointed stage',stage)
+    
+    #return the copy-on-write memmaps, size and image info saved for stage
+    def load(self,stage):
+        st = self._manifest['stages'][stage]
+        arrays = [np.load(os.path.join(self._work_dir,f),mmap_mode='c') for f in st['arrays']]
+        print('Resuming from stage',stage)
+        return arrays,copy.deepcopy(st['size']),st['info']
+    
+
 class IfgStitcher:
     def __init__(self):
         #isce image object of the full mask
@@ -35,6 +125,7 @@ class IfgStitcher:
         self._extra_prds_in2 = []
         self._image_info = {}
         self._stitch_only = False
+        self._checkpoint = None
 
 
 #zero the multiples of np in the overlap region
@@ -639,15 +730,8 @@ class IfgStitcher:
             fp = tempfile.NamedTemporaryFile()
             im.filename = fp.name
             fp.close()
-        if im.scheme.lower() == 'bil':
-            immap = np.memmap(im.filename, im.toNumpyDataType(), mode,
-                            shape=(im.coord2.coordSize , im.bands, im.coord1.coordSize))
-        elif im.scheme.lower() == 'bip':
-            immap = np.memmap(im.filename, im.toNumpyDataType(), mode,
-                              shape=(im.coord2.coordSize, im.coord1.coordSize, im.bands))
-        elif im.scheme.lower() == 'bsq':
-            immap = np.memmap(im.filename, im.toNumpyDataType(), mode,
-                        shape=(im.bands, im.coord2.coordSize, im.coord1.coordSize))
+        immap = RasterImage(im.filename, im.coord1.coordSize, im.coord2.coordSize,
+                            im.bands, im.scheme, im.toNumpyDataType(), mode).data
         return np.squeeze(immap)  
     
     def generate_image(self,name,width,height):
@@ -702,9 +786,21 @@ class IfgStitcher:
                         self._extra_prds_out[i][ii,i1:i1+nlat1,j1:j1+nlon1] = im1[ii,:,:]
                         self._extra_prds_out[i][ii,i2+mask2[0],j2+mask2[1]] = im2[ii,mask2[0],mask2[1]]
         
-    def stitch_sequence(self,names,sizes,outname=''):
+    #stage is the checkpoint prefix of the pairs stitched in the sequence (none if None)
+    def stitch_sequence(self,names,sizes,outname='',stage=None):
         print('stitch_sequence')
         bname = os.path.basename(names[0])
+        #find the last pair of the sequence that was checkpointed
+        start = 0
+        if self._checkpoint is not None and stage is not None:
+            for k in range(1,len(names) - 1):
+                if self._checkpoint.has(stage + '_pair_' + str(k)):
+                    start = k
+        if start > 0:
+            mm1,cmm1,pmm1,extras,size1 = self.load_stage(stage + '_pair_' + str(start))
+            self._extra_prds_out = extras
+            self._extra_prds_in1 = [p.copy() for p in extras]
+            return self.stitch_sequence_from(names,sizes,outname,stage,start,mm1,cmm1,pmm1,size1,bname)
         im1 = get_image(names[0] + '.xml')
         shape = (sizes[0]['lat']['size'],im1.bands,sizes[0]['lon']['size'])
         mm1 = self.get_memmap(im1.toNumpyDataType(), 'c',shape,
@@ -731,7 +827,11 @@ class IfgStitcher:
             self.generate_extra_memmaps(mm1.shape[2],mm1.shape[0],outname)
             for i in range(len(self._extra_prds_in1)):
                 self._extra_prds_out[i] = self._extra_prds_in1[i].copy()
-        for i in range(1,len(names)):
+        return self.stitch_sequence_from(names,sizes,outname,stage,0,mm1,cmm1,pmm1,size1,bname)
+    
+    #stitch the images of the sequence after the start-th one onto the mosaic mm1,cmm1,pmm1
+    def stitch_sequence_from(self,names,sizes,outname,stage,start,mm1,cmm1,pmm1,size1,bname):
+        for i in range(start + 1,len(names)):
             im2 = get_image(names[i] + '.xml')
             shape = (sizes[i]['lat']['size'],im2.bands,sizes[i]['lon']['size'])
             mm2 = self.get_memmap(im2.toNumpyDataType(), 'c', shape,
@@ -762,6 +862,9 @@ class IfgStitcher:
                 self._extra_prds_in1.append(p.copy())
             if mm1 is None:
                 return None,None,None,None
+            if self._checkpoint is not None and stage is not None and i < len(names) - 1:
+                self.save_stage(stage + '_pair_' + str(i),mm1,cmm1,pmm1,self._extra_prds_out,size1)
+                self._checkpoint.remove(stage + '_pair_' + str(i - 1))
             
         return mm1,cmm1,pmm1,size1
     
@@ -783,6 +886,36 @@ class IfgStitcher:
         return
 
         
+    #list of all the files read by the stitcher, used to validate a checkpoint
+    def get_input_files(self,names):
+        ret = []
+        for seq in names:
+            for name in seq:
+                ddir = os.path.dirname(name)
+                bname = os.path.basename(name)
+                for fname in [name,name.replace('.geo','.conncomp.geo'),os.path.join(ddir,self._cor_name)] \
+                             + [os.path.join(ddir,n) for n in self._extra_prd_names]:
+                    for f in [fname,fname + '.xml']:
+                        if os.path.exists(f) and f not in ret:
+                            ret.append(f)
+        return ret
+    
+    #files written by the stitch, with the images written by save_image
+    def get_output_files(self,outname):
+        ret = []
+        for name in [outname,outname.replace('.geo','.conncomp.geo'),self._cor_name] + self._extra_prd_names:
+            ret.extend([name,name + '.xml'])
+        return ret
+    
+    def save_stage(self,stage,im,cim,pim,extras,size):
+        if self._checkpoint is not None:
+            self._checkpoint.save(stage,[im,cim,pim] + list(extras),size,self._image_info)
+    
+    def load_stage(self,stage):
+        arrays,size,info = self._checkpoint.load(stage)
+        self._image_info.update(info)
+        return arrays[0],arrays[1],arrays[2],arrays[3:],size
+        
     def stitch(self,args):
         while True:#just a trick to avoid a lot of nested if statements
             if 'extra_products' in args: 
@@ -807,6 +940,13 @@ class IfgStitcher:
             elif args['direction'] != 'across':
                 print('Stitch direction either across or along. Entered',args['direction'])
                 raise Exception
+            if 'checkpoint_dir' in args:
+                self._checkpoint = StitchCheckpoint(args['checkpoint_dir'],self.get_input_files(names))
+            outputs = self.get_output_files(args['outname'])
+            if self._checkpoint is not None and self._checkpoint.has('stitch') \
+               and all(os.path.exists(f) for f in outputs):
+                print('Stitch already completed for these inputs. Skipping')
+                break
             #im1,cm1,size1 = self.stitch_sequence(names[1], sizes[1])
             #if there is only one subswath and the direction is along than 
             #the stich _equence will already stitch all the ifgs so give
@@ -815,22 +955,42 @@ class IfgStitcher:
                 outname = args['outname']
             else:
                 outname = ''
-            im1,cm1,pm1,size1 = self.stitch_sequence(names[0], sizes[0],outname)
-            #NOTE: cannot use the self._extra_prds_in1 since it gets overwritten
-            #in stitch_sequence
-            extra_prds_in1 = []
-            for p in self._extra_prds_out:
-                extra_prds_in1.append(p.copy())
-            if im1 is None:
-                print('Stitching failed')
-                break
-            
-            i = 1
-            for name,size in zip(names[1:],sizes[1:]):
-                im2,cm2,pm2,size2 = self.stitch_sequence(name, size)
-                if im2 is None:
+            #find the last across-track merge that completed. the first sequence is merge_0
+            start = -1
+            if self._checkpoint is not None and len(names) > 1:
+                for k in range(len(names) - 1):
+                    if self._checkpoint.has('merge_' + str(k)):
+                        start = k
+            if start >= 0:
+                im1,cm1,pm1,extra_prds_in1,size1 = self.load_stage('merge_' + str(start))
+            else:
+                start = 0
+                im1,cm1,pm1,size1 = self.stitch_sequence(names[0], sizes[0],outname,'seq_0')
+                #NOTE: cannot use the self._extra_prds_in1 since it gets overwritten
+                #in stitch_sequence
+                extra_prds_in1 = []
+                for p in self._extra_prds_out:
+                    extra_prds_in1.append(p.copy())
+                if im1 is None:
                     print('Stitching failed')
-                    break 
+                    break
+                if len(names) > 1:
+                    self.save_stage('merge_0',im1,cm1,pm1,extra_prds_in1,size1)
+                    if self._checkpoint is not None:
+                        self._checkpoint.remove_all('seq_0_')
+            
+            i = start + 1
+            for name,size in zip(names[start + 1:],sizes[start + 1:]):
+                if self._checkpoint is not None and self._checkpoint.has('seq_' + str(i)):
+                    im2,cm2,pm2,self._extra_prds_out,size2 = self.load_stage('seq_' + str(i))
+                else:
+                    im2,cm2,pm2,size2 = self.stitch_sequence(name, size,'','seq_' + str(i))
+                    if im2 is None:
+                        print('Stitching failed')
+                        break 
+                    self.save_stage('seq_' + str(i),im2,cm2,pm2,self._extra_prds_out,size2)
+                    if self._checkpoint is not None:
+                        self._checkpoint.remove_all('seq_' + str(i) + '_')
                 self._extra_prds_in1 = extra_prds_in1
                 self._extra_prds_in2 = []
                 for p in self._extra_prds_out:
@@ -845,6 +1005,12 @@ class IfgStitcher:
                 extra_prds_in1 = []
                 for p in self._extra_prds_out:
                     extra_prds_in1.append(p.copy())
+                if i < len(names) - 1:
+                    self.save_stage('merge_' + str(i),im1,cm1,pm1,extra_prds_in1,size1)
+                    #the new merge supersedes the previous one and the sequence merged in
+                    if self._checkpoint is not None:
+                        self._checkpoint.remove('merge_' + str(i - 1))
+                        self._checkpoint.remove('seq_' + str(i))
                
                 i += 1
             #zero where ccomp == 0
@@ -856,6 +1022,13 @@ class IfgStitcher:
             self.save_image(os.path.join(os.path.dirname(names[0][0]),self._cor_name),self._cor_name,size1)
             for name in self._extra_prd_names:
                 self.save_image(os.path.join(os.path.dirname(names[0][0]),name),name,size1)
+            #replace the intermediate mosaics with the completion record. other stages
+            #(e.g. two_stage) are kept
+            if self._checkpoint is not None:
+                for prefix in ['seq_','merge_']:
+                    self._checkpoint.remove_all(prefix)
+                self._checkpoint.save('stitch',[],size1,
+                                      {'outputs':dict([(f,self._checkpoint.checksum(f)) for f in outputs if os.path.exists(f)])})
 
             #if reaches the bottom everything went ok so break
             break
@@ -879,6 +1052,14 @@ class IfgStitcher:
         inpFile = os.path.join(unwrappedIntFilename)
         outFile = os.path.join(unwrapped2StageFilename)
     
+        #skip if already done on the same inputs
+        if self._checkpoint is not None:
+            info = {'inputs':[self._checkpoint.checksum(inpFile),self._checkpoint.checksum(ccFile)],
+                    'settings':[unwrapper_2stage_name,solver_2stage]}
+            if self._checkpoint.has('two_stage') and os.path.exists(outFile) \
+               and self._checkpoint.load('two_stage')[2] == info:
+                print('Two stage unwrap already completed for',inpFile)
+                return
         # Hand over to 2Stage unwrap
         unw = UnwrapComponents()
         unw.setInpFile(inpFile)
@@ -887,6 +1068,8 @@ class IfgStitcher:
         unw.setSolver(solver_2stage)
         unw.setRedArcs(unwrapper_2stage_name)
         unw.unwrapComponents()
+        if self._checkpoint is not None:
+            self._checkpoint.save('two_stage',[],None,info)
 #fname is the name of the json file with keys
 #"outname":"output filename", #normally something like filt_topophase.unw.geo
 #"filenames":[[["run_1_1/merged/filt_topophase.unw.geo",
@@ -896,6 +1079,8 @@ class IfgStitcher:
                #"run_2_2/merged/filt_topophase.unw.geo",
                #"run_2_3/merged/filt_topophase.unw.geo"]]]
 ### NOTE: each row the names must be arranged by subswath increasing number
+#optional "checkpoint_dir":"stitch_work" persists the intermediate mosaics so that
+#a restarted stitch resumes from the last completed sequence/merge
 
 def main(fname):
     inps = json.load(open(fname))
@@ -31,6 +31,8 @@ import glob
 import numpy as np
 import shelve
 import re
+import hashlib
+from multiprocessing.pool import ThreadPool
 
 sep = "\n"
 tab = "    "
@@ -555,8 +557,7 @@ class Sentinel1_TOPS(Component):
                 if burst.IPFversion == '002.36':
                    print('The IPF version is 2.36. Correcting the Elevation Antenna Pattern ...')
                    Geap = self.elevationAntennaPattern(burst)
-                   for i in range(burst.firstValidLine, burst.lastValidLine):
-                       outdata[i, burst.firstValidSample:burst.lastValidSample] = outdata[i, burst.firstValidSample:burst.lastValidSample]/Geap[burst.firstValidSample:burst.lastValidSample]
+                   outdata[burst.firstValidLine:burst.lastValidLine, burst.firstValidSample:burst.lastValidSample] /= Geap[None, burst.firstValidSample:burst.lastValidSample]
                 ########################
 
                 outdata.tofile(fid)
@@ -581,32 +582,41 @@ class Sentinel1_TOPS(Component):
         band = None
         src = None
 
-    def computeAzimuthCarrier(self, burst, offset=0.0, position=None):
+    def computeCarrierTerms(self, burst, offset=0.0):
         '''
-        Returns the ramp function as a numpy array.
+        Returns the 1D terms of the azimuth carrier (eta along lines, eta_ref and
+        Kt along samples) so that carr = pi * Kt * (eta - eta_ref)**2.
         '''
         Vs = np.linalg.norm(burst.orbit.interpolateOrbit(burst.sensingMid, method='hermite').getVelocity())
         Ks =   2 * Vs * burst.azimuthSteeringRate / burst.radarWavelength 
 
-
-        if position is None:
-            rng = np.arange(burst.numberOfSamples) * burst.rangePixelSize + burst.startingRange
+        rng = np.arange(burst.numberOfSamples) * burst.rangePixelSize + burst.startingRange
 
 ## Seems to work best for basebanding data
-            eta =( np.arange(0, burst.numberOfLines) - (burst.numberOfLines//2)) * burst.azimuthTimeInterval +  offset * burst.azimuthTimeInterval
+        eta =( np.arange(0, burst.numberOfLines) - (burst.numberOfLines//2)) * burst.azimuthTimeInterval +  offset * burst.azimuthTimeInterval
 
-            f_etac = burst.doppler(rng)
-            Ka     = burst.azimuthFMRate(rng)
+        f_etac = burst.doppler(rng)
+        Ka     = burst.azimuthFMRate(rng)
 
-            eta_ref = (burst.doppler(burst.startingRange) / burst.azimuthFMRate(burst.startingRange) ) - (f_etac / Ka)
+        eta_ref = (burst.doppler(burst.startingRange) / burst.azimuthFMRate(burst.startingRange) ) - (f_etac / Ka)
 
-#            eta_ref *= 0.0
-            Kt = Ks / (1.0 - Ks/Ka)
+#        eta_ref *= 0.0
+        Kt = Ks / (1.0 - Ks/Ka)
 
+        return eta, eta_ref, Kt
 
+    def computeAzimuthCarrier(self, burst, offset=0.0, position=None):
+        '''
+        Returns the ramp function as a numpy array.
+        '''
+        if position is None:
+            eta, eta_ref, Kt = self.computeCarrierTerms(burst, offset=offset)
             carr = np.pi * Kt[None,:] * ((eta[:,None] - eta_ref[None,:])**2)
 
         else:
+            Vs = np.linalg.norm(burst.orbit.interpolateOrbit(burst.sensingMid, method='hermite').getVelocity())
+            Ks =   2 * Vs * burst.azimuthSteeringRate / burst.radarWavelength 
+
             ####y and x need to be zero index
             y,x = position
 
@@ -633,20 +643,8 @@ class Sentinel1_TOPS(Component):
         tau_sub = np.array(burst.slantRangeTimeSub)
         theta_sub = np.array(burst.elevationAngle)
         ###########################################
-        #Reading the 2 way EAP (Elevation Antenna Pattern from AUX_CAL file)
-        fp = open(burst.auxFile,'r')
-        xml_root = ElementTree(file=fp).getroot()
-        res = xml_root.find('calibrationParamsList/calibrationParams')
-        paramsList = xml_root.find('calibrationParamsList')
-        for par in (paramsList.getchildren()):
-            if par.find('swath').text == burst.swath and par.find('polarisation').text == burst.polarization:
-              print (par.find('swath').text)
-              print (par.find('polarisation').text)
-              delta_theta = float(par.find('elevationAntennaPattern/elevationAngleIncrement').text)
-              Geap_IQ = [float(val) for val in par.find('elevationAntennaPattern/values').text.split()]
-        I = np.array(Geap_IQ[0::2])
-        Q = np.array(Geap_IQ[1::2])
-        Geap = I[:]+Q[:]*1j   # Complex vector of Elevation Antenna Pattern
+        #2 way EAP (Elevation Antenna Pattern) from the parsed AUX_CAL cache
+        delta_theta, Geap = loadAuxCal(burst.auxFile)[(burst.swath, burst.polarization)]
         Nelt = np.shape(Geap)[0]
         #########################
         # Vector of elevation angle in antenna frame
@@ -659,14 +657,8 @@ class Sentinel1_TOPS(Component):
         ########################
         #interpolate the 2-way complex EAP
         tau = tau0 + np.arange(Ns)/fs
-        from scipy.interpolate import interp1d
-       # f = interp1d(tau_sub,theta_sub)
-       # theta = f(tau)
         theta = np.interp(tau, tau_sub, theta_sub)
-       # theta = interpolate(theta_sub,tau_sub,tau)
-        f2 = interp1d(theta_eap,Geap)
-        Geap_interpolated = f2(theta) # interpolate(Geap,theta_eap,theta)
-       # Geap_interpolated = np.interp(theta, theta_eap, Geap)
+        Geap_interpolated = interpolateEAP(theta_eap, Geap, theta)
         phi_EAP = np.angle(Geap_interpolated)
         cJ = np.complex64(1.0j)
         GEAP = np.exp(cJ * phi_EAP)
@@ -685,9 +677,10 @@ class Sentinel1_TOPS(Component):
         return ramp
 
 
-    def derampImage(self, offset=0.0, action=True):
+    def derampImage(self, offset=0.0, action=True, blockSize=256, nthreads=None, tol=1.0e-4):
         '''
-        Deramp the bursts.
+        Deramp the bursts. Each burst is streamed through memory maps in blocks of
+        lines on nthreads threads (see derampBlocks).
         '''
 
         t0 = self.bursts[0].sensingStart
@@ -699,13 +692,11 @@ class Sentinel1_TOPS(Component):
 
 
             if action:
-                data = np.fromfile(infile, dtype=np.complex64).reshape((burst.numberOfLines, burst.numberOfSamples))
-
-
-                ramp = self.computeRamp(burst, offset=offset)
+                eta, eta_ref, Kt = self.computeCarrierTerms(burst, offset=offset)
 
                 #####Write Deramped SLC to file
-                data *= ramp
+                derampBlocks(infile, derampfile, eta, eta_ref, Kt,
+                        blockSize=blockSize, nthreads=nthreads, tol=tol)
 
 
                 print('Burst Number: %d'%(index+1))
@@ -716,10 +707,6 @@ class Sentinel1_TOPS(Component):
                     lineOffset += boff
                     print('Burst OFfset: %d'%lineOffset)
 
-                fid = open(derampfile, 'wb')
-                data.tofile(fid)
-                fid.close()
-
 
             ####Render ISCE XML
             slcImage = isceobj.createSlcImage()
@@ -733,8 +720,14 @@ class Sentinel1_TOPS(Component):
             slcImage.renderHdr()
             burst.derampimage = slcImage 
 
-        band = None
-        src = None
+    def derampImageFull(self, offset=0.0):
+        '''
+        Deramp the bursts with the full burst ramp in memory. Reference for derampImage.
+        '''
+        for index, burst in enumerate(self.bursts):
+            data = np.fromfile(burst.image.filename, dtype=np.complex64).reshape((burst.numberOfLines, burst.numberOfSamples))
+            data *= self.computeRamp(burst, offset=offset)
+            data.tofile(os.path.join(self.outdir, 'deramp_%02d'%(index+1) + '.slc'))
 
     def crop(self, bbox):
         '''
@@ -785,6 +778,156 @@ class Sentinel1_TOPS(Component):
         return
 
 
+def carrierBlock(eta, eta_ref, piKt, tol=1.0e-4):
+    '''
+    Azimuth carrier pi*Kt*(eta - eta_ref)**2 for a block of lines as float32 in
+    [-pi, pi). The carrier is evaluated in float32 if its rounding error, about
+    |carr| * 2**-21, is below tol radians. Otherwise it is evaluated in float64 and
+    wrapped before the conversion to float32.
+    '''
+    d0 = np.max(np.abs(eta)) + np.max(np.abs(eta_ref))
+    maxCarr = np.max(np.abs(piKt)) * d0 * d0
+    if maxCarr * 2.0**-21 < tol:
+        d = eta.astype(np.float32)[:,None] - eta_ref.astype(np.float32)[None,:]
+        carr = piKt.astype(np.float32)[None,:] * d * d
+    else:
+        d = eta[:,None] - eta_ref[None,:]
+        carr = piKt[None,:] * d * d
+        carr = np.remainder(carr + np.pi, 2*np.pi) - np.pi
+        carr = carr.astype(np.float32)
+    return carr
+
+
+def derampBlocks(infile, outfile, eta, eta_ref, Kt, blockSize=256, nthreads=None, tol=1.0e-4):
+    '''
+    Multiply a complex64 burst by exp(-1j * pi * Kt * (eta - eta_ref)**2) in blocks
+    of lines. Input and output are memory maps, blocks run on nthreads threads and
+    peak memory is a few times blockSize lines.
+
+    Compared to the full float64 ramp of computeRamp, the phase of the output
+    differs by at most tol radians plus float32 rounding of the wrapped phase
+    (about 1e-6 rad). The amplitude is unchanged to complex64 precision.
+    '''
+    length = eta.size
+    width = eta_ref.size
+    src = np.memmap(infile, dtype=np.complex64, mode='r', shape=(length, width))
+    dst = np.memmap(outfile, dtype=np.complex64, mode='w+', shape=(length, width))
+    piKt = np.pi * np.asarray(Kt, dtype=np.float64)
+    eta = np.asarray(eta, dtype=np.float64)
+    eta_ref = np.asarray(eta_ref, dtype=np.float64)
+
+    def work(r0):
+        r1 = min(r0 + blockSize, length)
+        carr = carrierBlock(eta[r0:r1], eta_ref, piKt, tol)
+        ramp = np.empty(carr.shape, dtype=np.complex64)
+        ramp.real = np.cos(carr)
+        ramp.imag = -np.sin(carr)
+        np.multiply(src[r0:r1], ramp, out=dst[r0:r1])
+
+    blocks = range(0, length, blockSize)
+    if nthreads is None:
+        nthreads = os.cpu_count() or 1
+
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(work, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for r0 in blocks:
+            work(r0)
+
+    dst.flush()
+    del src, dst
+
+
+####Parsed AUX_CAL antenna patterns, keyed by md5 of the AUX_CAL file
+AUX_CAL_CACHE = {}
+
+def auxCalHash(auxFile):
+    '''
+    md5 of an AUX_CAL file.
+    '''
+    md5 = hashlib.md5()
+    with open(auxFile, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def parseAuxCal(auxFile):
+    '''
+    Elevation antenna patterns of an AUX_CAL file as
+    {(swath, polarisation): (elevationAngleIncrement, complex pattern)}.
+    '''
+    xml_root = ElementTree(file=auxFile).getroot()
+    patterns = {}
+    for par in xml_root.find('calibrationParamsList'):
+        key = (par.find('swath').text, par.find('polarisation').text)
+        delta_theta = float(par.find('elevationAntennaPattern/elevationAngleIncrement').text)
+        Geap_IQ = np.array(par.find('elevationAntennaPattern/values').text.split(), dtype=np.float64)
+        patterns[key] = (delta_theta, Geap_IQ[0::2] + 1j * Geap_IQ[1::2])
+    return patterns
+
+
+def loadAuxCal(auxFile, cacheDir=None):
+    '''
+    Parsed antenna patterns of an AUX_CAL file. The patterns are kept in memory and
+    saved as aux_cal_<md5>.npz in cacheDir (default: next to the AUX_CAL file), so
+    the XML is parsed once per calibration file instead of once per burst.
+    '''
+    key = auxCalHash(auxFile)
+    if key in AUX_CAL_CACHE:
+        return AUX_CAL_CACHE[key]
+
+    if cacheDir is None:
+        cacheDir = os.path.dirname(os.path.abspath(auxFile))
+    npzFile = os.path.join(cacheDir, 'aux_cal_{0}.npz'.format(key))
+
+    patterns = None
+    if os.path.exists(npzFile):
+        try:
+            with np.load(npzFile) as npz:
+                patterns = {}
+                for name in npz.files:
+                    if name.endswith('_values'):
+                        swath, pol = name[:-len('_values')].split('_')
+                        patterns[(swath, pol)] = (float(npz[swath + '_' + pol + '_delta']), npz[name])
+        except (IOError, ValueError, KeyError):
+            patterns = None
+
+    if patterns is None:
+        patterns = parseAuxCal(auxFile)
+        arrays = {}
+        for (swath, pol), (delta_theta, Geap) in patterns.items():
+            arrays[swath + '_' + pol + '_delta'] = np.array(delta_theta)
+            arrays[swath + '_' + pol + '_values'] = Geap
+        try:
+            with open(npzFile + '.tmp', 'wb') as fid:
+                np.savez(fid, **arrays)
+            os.rename(npzFile + '.tmp', npzFile)
+        except (IOError, OSError):
+            print('Could not write AUX_CAL cache {0}'.format(npzFile))
+
+    AUX_CAL_CACHE[key] = patterns
+    return patterns
+
+
+def interpolateEAP(theta_eap, Geap, theta):
+    '''
+    Linear interpolation of the complex antenna pattern Geap(theta_eap) at all range
+    samples theta at once. Like scipy's interp1d, raises ValueError outside the table.
+    '''
+    if (np.min(theta) < theta_eap[0]) or (np.max(theta) > theta_eap[-1]):
+        raise ValueError('Elevation angles outside the AUX_CAL antenna pattern.')
+    out = np.empty(np.shape(theta), dtype=np.complex128)
+    out.real = np.interp(theta, theta_eap, Geap.real)
+    out.imag = np.interp(theta, theta_eap, Geap.imag)
+    return out
+
+
 def anx2roll(delta_anx):
    #Returns the Platform nominal roll as function of elapsed time from
    #ascending node crossing time (ANX)
@@ -337,10 +337,10 @@ def create_dir(dir_name):
     logger.info("Calling {}".format(mkdir_cmd_line))
     call_noerr(mkdir_cmd_line)
 
-def call_noerr(cmd):
+def call_noerr(cmd, cwd=None):
     """Run command and warn if exit status is not 0."""
 
-    try: check_call(cmd, shell=True)
+    try: check_call(cmd, shell=True, cwd=cwd)
     except Exception as e:
         logger.warn("Got exception running {}: {}".format(cmd, str(e)))
         logger.warn("Traceback: {}".format(traceback.format_exc()))
@@ -385,25 +385,24 @@ def main():
     ctx['filter_strength'] = ctx.get("context", {}).get("filter_strength", 0.5)
     logger.info("Using filter_strength of %f" % ctx['filter_strength'])
 
+    # registry of completed steps in the work dir; a retried job resumes at the first incomplete step
+    from pge_steps import StepRegistry, StepGraph
+    registry = StepRegistry(os.path.join(cwd, "_pge_steps"))
+
     # unzip SAFE dirs
-    master_safe_dirs = []
-    for i in ctx['master_zip_file']:
-        logger.info("Unzipping {}.".format(i))
-        with ZipFile(i, 'r') as zf:
-            zf.extractall()
-        logger.info("Removing {}.".format(i))
-        try: os.unlink(i)
-        except: pass
-        master_safe_dirs.append(i.replace(".zip", ".SAFE"))
-    slave_safe_dirs = []
-    for i in ctx['slave_zip_file']:
-        logger.info("Unzipping {}.".format(i))
-        with ZipFile(i, 'r') as zf:
-            zf.extractall()
-        logger.info("Removing {}.".format(i))
-        try: os.unlink(i)
-        except: pass
-        slave_safe_dirs.append(i.replace(".zip", ".SAFE"))
+    master_safe_dirs = [i.replace(".zip", ".SAFE") for i in ctx['master_zip_file']]
+    slave_safe_dirs = [i.replace(".zip", ".SAFE") for i in ctx['slave_zip_file']]
+    def unzip_safe():
+        for i in chain(ctx['master_zip_file'], ctx['slave_zip_file']):
+            logger.info("Unzipping {}.".format(i))
+            with ZipFile(i, 'r') as zf:
+                zf.extractall()
+            logger.info("Removing {}.".format(i))
+            try: os.unlink(i)
+            except: pass
+    registry.run("unzip", unzip_safe, master_safe_dirs + slave_safe_dirs,
+                 params=[ctx['master_zip_file'], ctx['slave_zip_file']],
+                 inputs=ctx['master_zip_file'] + ctx['slave_zip_file'])
 
     # get polarization values
     master_pol = get_polarization(master_safe_dirs[0])
@@ -417,17 +416,20 @@ def main():
     logger.info("Determining envelope bbox from SLC swaths.")
     bbox_json = "bbox.json"
     
-    if ctx['stitch_subswaths_xt']:
-        logger.info("stitch_subswaths_xt is True")
-        bbox_cmd_tmpl = "{}/get_union_bbox.sh -o {} *.SAFE/annotation/s1?-iw?-slc-{}-*.xml"
-        check_call(bbox_cmd_tmpl.format(BASE_PATH, bbox_json,
-                                    match_pol), shell=True)
-    else:
-        logger.info("stitch_subswaths_xt is False. Processing for swathnum : %s" %ctx['swathnum'])
-        bbox_cmd_tmpl = "{}/get_union_bbox.sh -o {} *.SAFE/annotation/s1?-iw{}-slc-{}-*.xml"
-        check_call(bbox_cmd_tmpl.format(BASE_PATH, bbox_json, ctx['swathnum'],
-                                    match_pol), shell=True)
-    
+    def union_bbox():
+        if ctx['stitch_subswaths_xt']:
+            logger.info("stitch_subswaths_xt is True")
+            bbox_cmd_tmpl = "{}/get_union_bbox.sh -o {} *.SAFE/annotation/s1?-iw?-slc-{}-*.xml"
+            check_call(bbox_cmd_tmpl.format(BASE_PATH, bbox_json,
+                                        match_pol), shell=True)
+        else:
+            logger.info("stitch_subswaths_xt is False. Processing for swathnum : %s" %ctx['swathnum'])
+            bbox_cmd_tmpl = "{}/get_union_bbox.sh -o {} *.SAFE/annotation/s1?-iw{}-slc-{}-*.xml"
+            check_call(bbox_cmd_tmpl.format(BASE_PATH, bbox_json, ctx['swathnum'],
+                                        match_pol), shell=True)
+    registry.run("bbox", union_bbox, [bbox_json],
+                 params=[match_pol, ctx['swathnum'], ctx['stitch_subswaths_xt']])
+
     with open(bbox_json) as f:
         bbox = json.load(f)['envelope']
     logger.info("bbox: {}".format(bbox))
@@ -474,69 +476,75 @@ def main():
     preprocess_dem_dir="preprocess_dem"
     geocode_dem_dir="geocode_dem"
 
-    # download project specific preprocess DEM
-    if 'kilauea' in ctx['project']:
-        s = requests.session()
-        s.auth = (dem_user, dem_pass)
-        download_file(KILAUEA_DEM_XML, session=s)
-        download_file(KILAUEA_DEM, session=s)
-        preprocess_dem_file = os.path.basename(KILAUEA_DEM)
-    else:
-        # get DEM bbox
-        dem_S, dem_N, dem_W, dem_E = bbox
-        dem_S = int(math.floor(dem_S))
-        dem_N = int(math.ceil(dem_N))
-        dem_W = int(math.floor(dem_W))
-        dem_E = int(math.ceil(dem_E))
+    def stage_preprocess_dem():
+        url = dem_url
+        # download project specific preprocess DEM
+        if 'kilauea' in ctx['project']:
+            s = requests.session()
+            s.auth = (dem_user, dem_pass)
+            download_file(KILAUEA_DEM_XML, session=s)
+            download_file(KILAUEA_DEM, session=s)
+            preprocess_dem_file = os.path.basename(KILAUEA_DEM)
+        else:
+            # get DEM bbox
+            dem_S, dem_N, dem_W, dem_E = bbox
+            dem_S = int(math.floor(dem_S))
+            dem_N = int(math.ceil(dem_N))
+            dem_W = int(math.floor(dem_W))
+            dem_E = int(math.ceil(dem_E))
         
 
-        if dem_type.startswith("SRTM"):
-            if dem_type.startswith("SRTM3"):
-                dem_url = srtm3_dem_url
+            if dem_type.startswith("SRTM"):
+                if dem_type.startswith("SRTM3"):
+                    url = srtm3_dem_url
   
-            dem_cmd = [
-                "{}/applications/dem.py".format(os.environ['ISCE_HOME']), "-a",
-                "stitch", "-b", "{} {} {} {}".format(dem_S, dem_N, dem_W, dem_E),
-                "-r", "-s", "1", "-f", "-x", "-c", "-n", dem_user, "-w", dem_pass,
-                "-u", dem_url
-            ]
-            dem_cmd_line = " ".join(dem_cmd)
-            logger.info("Calling dem.py: {}".format(dem_cmd_line))
-            check_call(dem_cmd_line, shell=True)
-            preprocess_dem_file = glob("*.dem.wgs84")[0]
+                dem_cmd = [
+                    "{}/applications/dem.py".format(os.environ['ISCE_HOME']), "-a",
+                    "stitch", "-b", "{} {} {} {}".format(dem_S, dem_N, dem_W, dem_E),
+                    "-r", "-s", "1", "-f", "-x", "-c", "-n", dem_user, "-w", dem_pass,
+                    "-u", url
+                ]
+                dem_cmd_line = " ".join(dem_cmd)
+                logger.info("Calling dem.py: {}".format(dem_cmd_line))
+                check_call(dem_cmd_line, shell=True)
+                preprocess_dem_file = glob("*.dem.wgs84")[0]
             
-        else:
-            if dem_type == "NED1": dem_url = ned1_dem_url
-            elif dem_type.startswith("NED13"): dem_url = ned13_dem_url
-            else: raise RuntimeError("Unknown dem type %s." % dem_type)
-            if dem_type == "NED13-downsampled": downsample_option = "-d 33%"
-            else: downsample_option = ""
-            dem_S = dem_S - 1 if dem_S > -89 else dem_S
-            dem_N = dem_N + 1 if dem_N < 89 else dem_N
-            dem_W = dem_W - 1 if dem_W > -179 else dem_W
-            dem_E = dem_E + 1 if dem_E < 179 else dem_E
-            dem_cmd = [
-                "{}/ned_dem.py".format(BASE_PATH), "-a",
-                "stitch", "-b", "{} {} {} {}".format(dem_S, dem_N, dem_W, dem_E),
-                downsample_option, "-u", dem_user, "-p", dem_pass, dem_url
-            ]
-            dem_cmd_line = " ".join(dem_cmd)
-            logger.info("Calling ned_dem.py: {}".format(dem_cmd_line))
-            check_call(dem_cmd_line, shell=True)
-            preprocess_dem_file = "stitched.dem"
-    logger.info("Using Preprocess DEM file: {}".format(preprocess_dem_file))
-
-    move_dem_separate_dir(preprocess_dem_dir)
-    preprocess_dem_file = os.path.join(preprocess_dem_dir, preprocess_dem_file)
-
-    # fix file path in Preprocess DEM xml
-    fix_cmd = [
-        "{}/applications/fixImageXml.py".format(os.environ['ISCE_HOME']),
-        "-i", preprocess_dem_file, "--full"
-    ]
-    fix_cmd_line = " ".join(fix_cmd)
-    logger.info("Calling fixImageXml.py: {}".format(fix_cmd_line))
-    check_call(fix_cmd_line, shell=True)
+            else:
+                if dem_type == "NED1": url = ned1_dem_url
+                elif dem_type.startswith("NED13"): url = ned13_dem_url
+                else: raise RuntimeError("Unknown dem type %s." % dem_type)
+                if dem_type == "NED13-downsampled": downsample_option = "-d 33%"
+                else: downsample_option = ""
+                dem_S = dem_S - 1 if dem_S > -89 else dem_S
+                dem_N = dem_N + 1 if dem_N < 89 else dem_N
+                dem_W = dem_W - 1 if dem_W > -179 else dem_W
+                dem_E = dem_E + 1 if dem_E < 179 else dem_E
+                dem_cmd = [
+                    "{}/ned_dem.py".format(BASE_PATH), "-a",
+                    "stitch", "-b", "{} {} {} {}".format(dem_S, dem_N, dem_W, dem_E),
+                    downsample_option, "-u", dem_user, "-p", dem_pass, url
+                ]
+                dem_cmd_line = " ".join(dem_cmd)
+                logger.info("Calling ned_dem.py: {}".format(dem_cmd_line))
+                check_call(dem_cmd_line, shell=True)
+                preprocess_dem_file = "stitched.dem"
+        logger.info("Using Preprocess DEM file: {}".format(preprocess_dem_file))
+
+        move_dem_separate_dir(preprocess_dem_dir)
+        preprocess_dem_file = os.path.join(preprocess_dem_dir, preprocess_dem_file)
+
+        # fix file path in Preprocess DEM xml
+        fix_cmd = [
+            "{}/applications/fixImageXml.py".format(os.environ['ISCE_HOME']),
+            "-i", preprocess_dem_file, "--full"
+        ]
+        fix_cmd_line = " ".join(fix_cmd)
+        logger.info("Calling fixImageXml.py: {}".format(fix_cmd_line))
+        check_call(fix_cmd_line, shell=True)
+        return preprocess_dem_file
+    preprocess_dem_file = registry.run("preprocess_dem", stage_preprocess_dem,
+                                       lambda r: [r, "{}.xml".format(r)],
+                                       params=[ctx['project'], dem_type, bbox], inputs=[bbox_json])[0]
     
     '''
     geocode_dem_url = srtm3_dem_url
@@ -556,44 +564,50 @@ def main():
     logger.info("Using Geocode DEM file: {}".format(geocode_dem_file))
     '''
 
-    preprocess_vrt_file=""
-    if dem_type.startswith("SRTM"):
-        preprocess_vrt_file = glob(os.path.join(preprocess_dem_dir, "*.dem.wgs84.vrt"))[0]
-    elif dem_type.startswith("NED1"):
-        preprocess_vrt_file = os.path.join(preprocess_dem_dir, "combinedDEM.vrt")
-        print("preprocess_vrt_file : %s"%preprocess_vrt_file)
-    else: raise RuntimeError("Unknown dem type %s." % dem_type)
-
-    if not os.path.isfile(preprocess_vrt_file):
-        print("%s does not exists. Exiting")
+    def stage_geocode_dem():
+        preprocess_vrt_file=""
+        if dem_type.startswith("SRTM"):
+            preprocess_vrt_file = glob(os.path.join(preprocess_dem_dir, "*.dem.wgs84.vrt"))[0]
+        elif dem_type.startswith("NED1"):
+            preprocess_vrt_file = os.path.join(preprocess_dem_dir, "combinedDEM.vrt")
+            print("preprocess_vrt_file : %s"%preprocess_vrt_file)
+        else: raise RuntimeError("Unknown dem type %s." % dem_type)
+
+        if not os.path.isfile(preprocess_vrt_file):
+            print("%s does not exists. Exiting")
     
-    geocode_dem_dir = os.path.join(preprocess_dem_dir, "Coarse_preprocess_dem")
-    create_dir(geocode_dem_dir)
-
-    dem_cmd = [
-        "{}/applications/downsampleDEM.py".format(os.environ['ISCE_HOME']), "-i",
-        "{}".format(preprocess_vrt_file), "-r", "90"
-    ]
-    dem_cmd_line = " ".join(dem_cmd)
-    logger.info("Calling downsampleDEM.py: {}".format(dem_cmd_line))
-    check_call(dem_cmd_line, shell=True)
-    geocode_dem_file = ""
+        geocode_dem_dir = os.path.join(preprocess_dem_dir, "Coarse_preprocess_dem")
+        create_dir(geocode_dem_dir)
+
+        dem_cmd = [
+            "{}/applications/downsampleDEM.py".format(os.environ['ISCE_HOME']), "-i",
+            "{}".format(preprocess_vrt_file), "-r", "90"
+        ]
+        dem_cmd_line = " ".join(dem_cmd)
+        logger.info("Calling downsampleDEM.py: {}".format(dem_cmd_line))
+        check_call(dem_cmd_line, shell=True)
+        geocode_dem_file = ""
 
-    if dem_type.startswith("SRTM"):
-        geocode_dem_file = glob(os.path.join(geocode_dem_dir, "*.dem.wgs84"))[0]
-    elif dem_type.startswith("NED1"):
-        geocode_dem_file = os.path.join(geocode_dem_dir, "combinedDEM")
-    logger.info("Using Geocode DEM file: {}".format(geocode_dem_file))
-
-
-    # fix file path in Geocoding DEM xml
-    fix_cmd = [
-        "{}/applications/fixImageXml.py".format(os.environ['ISCE_HOME']),
-        "-i", geocode_dem_file, "--full"
-    ]
-    fix_cmd_line = " ".join(fix_cmd)
-    logger.info("Calling fixImageXml.py: {}".format(fix_cmd_line))
-    check_call(fix_cmd_line, shell=True)
+        if dem_type.startswith("SRTM"):
+            geocode_dem_file = glob(os.path.join(geocode_dem_dir, "*.dem.wgs84"))[0]
+        elif dem_type.startswith("NED1"):
+            geocode_dem_file = os.path.join(geocode_dem_dir, "combinedDEM")
+        logger.info("Using Geocode DEM file: {}".format(geocode_dem_file))
+
+
+        # fix file path in Geocoding DEM xml
+        fix_cmd = [
+            "{}/applications/fixImageXml.py".format(os.environ['ISCE_HOME']),
+            "-i", geocode_dem_file, "--full"
+        ]
+        fix_cmd_line = " ".join(fix_cmd)
+        logger.info("Calling fixImageXml.py: {}".format(fix_cmd_line))
+        check_call(fix_cmd_line, shell=True)
+        return geocode_dem_file
+    geocode_dem_file = registry.run("geocode_dem", stage_geocode_dem,
+                                    lambda r: [r, "{}.xml".format(r)],
+                                    params=[dem_type, preprocess_dem_file],
+                                    inputs=[preprocess_dem_file, "{}.xml".format(preprocess_dem_file)])[0]
     
     # download auciliary calibration files
     aux_cmd = [
@@ -603,78 +617,94 @@ def main():
     aux_cmd_line = " ".join(aux_cmd)
     #logger.info("Calling fetchCal.py: {}".format(aux_cmd_line))
     logger.info("Calling fetchCalES.py: {}".format(aux_cmd_line))
-    check_call(aux_cmd_line, shell=True)
+    registry.run("aux_cal", lambda: check_call(aux_cmd_line, shell=True), ["aux_cal"])
         
     # create initial input xml
     do_esd = True
     esd_coh_th = 0.85
     xml_file = "topsApp.xml"
-    create_input_xml(os.path.join(BASE_PATH, 'topsApp_standard_product.xml.tmpl'), xml_file,
-                     str(master_safe_dirs), str(slave_safe_dirs), 
-                     ctx['master_orbit_file'], ctx['slave_orbit_file'],
-                     master_pol, slave_pol, preprocess_dem_file, geocode_dem_file,
-                     "1, 2, 3" if ctx['stitch_subswaths_xt'] else ctx['swathnum'],
-                     ctx['azimuth_looks'], ctx['range_looks'], ctx['filter_strength'],
-                     "{} {} {} {}".format(*bbox), "True", do_esd,
-                     esd_coh_th)
+    xml_params = [str(master_safe_dirs), str(slave_safe_dirs), 
+                  ctx['master_orbit_file'], ctx['slave_orbit_file'],
+                  master_pol, slave_pol, preprocess_dem_file, geocode_dem_file,
+                  "1, 2, 3" if ctx['stitch_subswaths_xt'] else ctx['swathnum'],
+                  ctx['azimuth_looks'], ctx['range_looks'], ctx['filter_strength'],
+                  "{} {} {} {}".format(*bbox), "True"]
+    # files read by topsApp
+    topsapp_inputs = master_safe_dirs + slave_safe_dirs + \
+                     [ctx['master_orbit_file'], ctx['slave_orbit_file'], "aux_cal"] + \
+                     [j for i in (preprocess_dem_file, geocode_dem_file) for j in (i, "{}.xml".format(i))]
+
+    # topsApp outputs are moved into the product directory after geocoding
+    def topsapp_output(path):
+        return (path, os.path.join(id, path))
+
+    # topsApp steps run after an earlier attempt moved PICKLE need it back
+    def restore_pickle():
+        if not os.path.exists('PICKLE') and os.path.isdir(os.path.join(id, 'PICKLE')):
+            logger.info("Restoring PICKLE from {}.".format(id))
+            shutil.move(os.path.join(id, 'PICKLE'), 'PICKLE')
 
     #get the time before stating topsApp.py
     topsApp_start_time=datetime.now()
     logger.info("TopsApp Start Time : {}".format(topsApp_start_time))
 
     # run topsApp to prepesd step
-    topsapp_cmd = [
-        "topsApp.py", "--steps", "--end=prepesd",
-    ]
-    topsapp_cmd_line = " ".join(topsapp_cmd)
-    logger.info("Calling topsApp.py to prepesd step: {}".format(topsapp_cmd_line))
-    check_call(topsapp_cmd_line, shell=True)
+    def topsapp_prepesd():
+        create_input_xml(os.path.join(BASE_PATH, 'topsApp_standard_product.xml.tmpl'), xml_file,
+                         *(xml_params + [do_esd, esd_coh_th]))
+        topsapp_cmd = [
+            "topsApp.py", "--steps", "--end=prepesd",
+        ]
+        topsapp_cmd_line = " ".join(topsapp_cmd)
+        logger.info("Calling topsApp.py to prepesd step: {}".format(topsapp_cmd_line))
+        check_call(topsapp_cmd_line, shell=True)
+    registry.run("topsapp_prepesd", topsapp_prepesd, [topsapp_output("PICKLE/prepesd")],
+                 params=xml_params + [do_esd, esd_coh_th], inputs=topsapp_inputs)
 
     # iterate over ESD coherence thresholds
-    esd_coh_increment = 0.05
-    esd_coh_min = 0.5
-    topsapp_cmd = [
-        "topsApp.py", "--steps", "--dostep=esd",
-    ]
-    topsapp_cmd_line = " ".join(topsapp_cmd)
-    while True:
-        logger.info("Calling topsApp.py on esd step with ESD coherence threshold: {}".format(esd_coh_th))
-        try:
-            check_call(topsapp_cmd_line, shell=True)
-            break
-        except CalledProcessError:
-            logger.info("ESD filtering failed with ESD coherence threshold: {}".format(esd_coh_th))
-            esd_coh_th = round(esd_coh_th-esd_coh_increment, 2)
-            if esd_coh_th < esd_coh_min:
-                logger.info("Disabling ESD filtering.")
-                do_esd = False
-                create_input_xml(os.path.join(BASE_PATH, 'topsApp_standard_product.xml.tmpl'), xml_file,
-                                 str(master_safe_dirs), str(slave_safe_dirs), 
-                                 ctx['master_orbit_file'], ctx['slave_orbit_file'],
-                                 master_pol, slave_pol, preprocess_dem_file, geocode_dem_file,
-                                 "1, 2, 3" if ctx['stitch_subswaths_xt'] else ctx['swathnum'],
-                                 ctx['azimuth_looks'], ctx['range_looks'], ctx['filter_strength'],
-                                 "{} {} {} {}".format(*bbox), "True", do_esd,
-                                 esd_coh_th)
+    def topsapp_esd(do_esd=do_esd, esd_coh_th=esd_coh_th):
+        restore_pickle()
+        esd_coh_increment = 0.05
+        esd_coh_min = 0.5
+        topsapp_cmd = [
+            "topsApp.py", "--steps", "--dostep=esd",
+        ]
+        topsapp_cmd_line = " ".join(topsapp_cmd)
+        while True:
+            logger.info("Calling topsApp.py on esd step with ESD coherence threshold: {}".format(esd_coh_th))
+            try:
+                check_call(topsapp_cmd_line, shell=True)
                 break
-            logger.info("Stepping down ESD coherence threshold to: {}".format(esd_coh_th))
-            logger.info("Creating topsApp.xml with ESD coherence threshold: {}".format(esd_coh_th))
-            create_input_xml(os.path.join(BASE_PATH, 'topsApp_standard_product.xml.tmpl'), xml_file,
-                             str(master_safe_dirs), str(slave_safe_dirs), 
-                             ctx['master_orbit_file'], ctx['slave_orbit_file'],
-                             master_pol, slave_pol, preprocess_dem_file, geocode_dem_file,
-                             "1, 2, 3" if ctx['stitch_subswaths_xt'] else ctx['swathnum'],
-                             ctx['azimuth_looks'], ctx['range_looks'], ctx['filter_strength'],
-                             "{} {} {} {}".format(*bbox), "True", do_esd,
-                             esd_coh_th)
+            except CalledProcessError:
+                logger.info("ESD filtering failed with ESD coherence threshold: {}".format(esd_coh_th))
+                esd_coh_th = round(esd_coh_th-esd_coh_increment, 2)
+                if esd_coh_th < esd_coh_min:
+                    logger.info("Disabling ESD filtering.")
+                    do_esd = False
+                    create_input_xml(os.path.join(BASE_PATH, 'topsApp_standard_product.xml.tmpl'), xml_file,
+                                     *(xml_params + [do_esd, esd_coh_th]))
+                    break
+                logger.info("Stepping down ESD coherence threshold to: {}".format(esd_coh_th))
+                logger.info("Creating topsApp.xml with ESD coherence threshold: {}".format(esd_coh_th))
+                create_input_xml(os.path.join(BASE_PATH, 'topsApp_standard_product.xml.tmpl'), xml_file,
+                                 *(xml_params + [do_esd, esd_coh_th]))
+        return {'do_esd': do_esd, 'esd_coh_th': esd_coh_th}
+    esd = registry.run("topsapp_esd", topsapp_esd, [xml_file], params=xml_params, inputs=topsapp_inputs)[0]
+    do_esd = esd['do_esd']
+    esd_coh_th = esd['esd_coh_th']
 
     # run topsApp from rangecoreg to geocode
-    topsapp_cmd = [
-        "topsApp.py", "--steps", "--start=rangecoreg", "--end=geocode",
-    ]
-    topsapp_cmd_line = " ".join(topsapp_cmd)
-    logger.info("Calling topsApp.py to geocode step: {}".format(topsapp_cmd_line))
-    check_call(topsapp_cmd_line, shell=True)
+    def topsapp_geocode():
+        restore_pickle()
+        topsapp_cmd = [
+            "topsApp.py", "--steps", "--start=rangecoreg", "--end=geocode",
+        ]
+        topsapp_cmd_line = " ".join(topsapp_cmd)
+        logger.info("Calling topsApp.py to geocode step: {}".format(topsapp_cmd_line))
+        check_call(topsapp_cmd_line, shell=True)
+    registry.run("topsapp_geocode", topsapp_geocode,
+                 [topsapp_output("merged/filt_topophase.unw.geo"), topsapp_output("PICKLE/geocode")],
+                 params=xml_params + [do_esd, esd_coh_th], inputs=topsapp_inputs)
 
     #topsApp End Time
     topsApp_end_time=datetime.now() 
@@ -684,8 +714,6 @@ def main():
     logger.info("New TopsApp Run Time : {}".format(topsApp_run_time))
 
     swath_list = [1, 2, 3]
-    met_files=[]
-    ds_files=[]
 
     # get radian value for 5-cm wrap. As it is same for all swath, we will use swathnum = 1
     rt = parse('master/IW{}.xml'.format(1))
@@ -696,13 +724,16 @@ def main():
 
 
 
-    # create product directory
+    # create product directory; a product left by an earlier attempt is stale if topsApp was run again
     prod_dir = id
-    os.makedirs(prod_dir, 0o755)
+    if "topsapp_geocode" in registry.ran and os.path.isdir(prod_dir):
+        logger.info("Removing stale product directory {}.".format(prod_dir))
+        shutil.rmtree(prod_dir)
+    if not os.path.isdir(prod_dir): os.makedirs(prod_dir, 0o755)
 
     # create merged directory in product
     prod_merged_dir = os.path.join(prod_dir, 'merged')
-    os.makedirs(prod_merged_dir, 0o755)
+    if not os.path.isdir(prod_merged_dir): os.makedirs(prod_merged_dir, 0o755)
 
 
     # generate GDAL (ENVI) headers and move to product directory
@@ -716,283 +747,51 @@ def main():
         'merged/los.rdr',
         'merged/dem.crop',
     )
-    for i in raster_prods:
-        # radar-coded products
-        call_noerr("isce2gis.py envi -i {}".format(i))
-        #call_noerr("gdal_translate {} {}.tif".format(i, i))
-        gdal_xml = "{}.xml".format(i)
-        gdal_hdr = "{}.hdr".format(i)
-        #gdal_tif = "{}.tif".format(i)
-        gdal_vrt = "{}.vrt".format(i)
-        if os.path.exists(i): shutil.move(i, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(i))
-        if os.path.exists(gdal_xml): shutil.move(gdal_xml, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(gdal_xml))
-        if os.path.exists(gdal_hdr): shutil.move(gdal_hdr, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(gdal_hdr))
-        #if os.path.exists(gdal_tif): shutil.move(gdal_tif, prod_merged_dir)
-        #else: logger.warn("{} wasn't generated.".format(gdal_tif))
-        if os.path.exists(gdal_vrt): shutil.move(gdal_vrt, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(gdal_vrt))
-
-        # geo-coded products
-        j = "{}.geo".format(i)
-        if not os.path.exists(j): continue
-        call_noerr("isce2gis.py envi -i {}".format(j))
-        #call_noerr("gdal_translate {} {}.tif".format(j, j))
-        gdal_xml = "{}.xml".format(j)
-        gdal_hdr = "{}.hdr".format(j)
-        #gdal_tif = "{}.tif".format(j)
-        gdal_vrt = "{}.vrt".format(j)
-        if os.path.exists(j): shutil.move(j, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(j))
-        if os.path.exists(gdal_xml): shutil.move(gdal_xml, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(gdal_xml))
-        if os.path.exists(gdal_hdr): shutil.move(gdal_hdr, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(gdal_hdr))
-        #if os.path.exists(gdal_tif): shutil.move(gdal_tif, prod_merged_dir)
-        #else: logger.warn("{} wasn't generated.".format(gdal_tif))
-        if os.path.exists(gdal_vrt): shutil.move(gdal_vrt, prod_merged_dir)
-        else: logger.warn("{} wasn't generated.".format(gdal_vrt))
-
-
 
     # save other files to product directory
-    shutil.copyfile("_context.json", os.path.join(prod_dir,"{}.context.json".format(id)))
-    shutil.copyfile("topsApp.xml", os.path.join(prod_dir, "topsApp.xml"))
-    if os.path.exists('topsProc.xml'):
-        shutil.copyfile("topsProc.xml", os.path.join(prod_dir, "topsProc.xml"))
-    if os.path.exists('isce.log'):
-        shutil.copyfile("isce.log", os.path.join(prod_dir, "isce.log"))
-
-
-    # move PICKLE to product directory
-    shutil.move('PICKLE', prod_dir)
-
-    fine_int_xmls = []
-    for swathnum in swath_list:
-       # ctx['swathnum'] = swathnum
-        fine_int_xml = "fine_interferogram_IW{}.xml".format(swathnum)
-        master_xml="master_IW{}.xml".format(swathnum)
-        slave_xml = "slave_IW{}.xml".format(swathnum)
-
-        fine_int_xmls.append(os.path.join(prod_dir, fine_int_xml))
-
-        logger.info("\n\nPROCESSING SWATH : {}".format(swathnum))
+    def save_files():
+        shutil.copyfile("_context.json", os.path.join(prod_dir,"{}.context.json".format(id)))
+        shutil.copyfile("topsApp.xml", os.path.join(prod_dir, "topsApp.xml"))
+        if os.path.exists('topsProc.xml'):
+            shutil.copyfile("topsProc.xml", os.path.join(prod_dir, "topsProc.xml"))
+        if os.path.exists('isce.log'):
+            shutil.copyfile("isce.log", os.path.join(prod_dir, "isce.log"))
 
-        shutil.copyfile("fine_interferogram/IW{}.xml".format(swathnum),
-                    os.path.join(prod_dir, fine_int_xml))
-        shutil.copyfile("master/IW{}.xml".format(swathnum),
-                    os.path.join(prod_dir, master_xml))
-        shutil.copyfile("slave/IW{}.xml".format(swathnum),
-                    os.path.join(prod_dir, slave_xml))
 
-    
-    # create browse images
-    os.chdir(prod_merged_dir)
-    mdx_app_path = "{}/applications/mdx.py".format(os.environ['ISCE_HOME'])
-    mdx_path = "{}/bin/mdx".format(os.environ['ISCE_HOME'])
-    from utils.createImage import createImage
-    unw_file = "filt_topophase.unw.geo"
-    #unwrapped image at different rates
-    createImage("{} -P {}".format(mdx_app_path, unw_file),unw_file)
-    createImage("{} -P {} -wrap {}".format(mdx_app_path, unw_file, rad),unw_file + "_5cm")
-    createImage("{} -P {} -wrap 20".format(mdx_app_path, unw_file),unw_file + "_20rad")
-    #amplitude image
-    unw_xml = "filt_topophase.unw.geo.xml"
-    rt = parse(unw_xml)
-    size = eval(rt.xpath('.//component[@name="coordinate1"]/property[@name="size"]/value/text()')[0])
-    rtlr = size * 4
-    logger.info("rtlr value for amplitude browse is: {}".format(rtlr))
-    createImage("{} -P {} -s {} -amp -r4 -rtlr {} -CW".format(mdx_path, unw_file, size, rtlr),'amplitude.geo')
-    #coherence image
-    top_file = "topophase.cor.geo"
-    createImage("{} -P {}".format(mdx_app_path, top_file),top_file)
-    #should be the same size as unw but just in case
-    top_xml = "topophase.cor.geo.xml"
-    rt = parse(top_xml)
-    size = eval(rt.xpath('.//component[@name="coordinate1"]/property[@name="size"]/value/text()')[0])
-    rhdr = size * 4
-    createImage("{} -P {} -s {} -r4 -rhdr {} -cmap cmy -wrap 1.2".format(mdx_path, top_file,size,rhdr),"topophase_ph_only.cor.geo")
+        # move PICKLE to product directory
+        shutil.move('PICKLE', prod_dir)
+    registry.run("save_files", save_files, [os.path.join(prod_dir, "PICKLE")])
 
+    # per swath xmls; the per swath metadata uses the last swath's fine interferogram xml
+    fine_int_xmls = [os.path.join(prod_dir, "fine_interferogram_IW{}.xml".format(i)) for i in swath_list]
+    fine_int_xml = "fine_interferogram_IW{}.xml".format(swath_list[-1])
 
-    '''
-    # unw browse
+    # browse and metadata inputs
     unw_file = "filt_topophase.unw.geo"
-    unw_browse_img = unw_file + ".browse.png"
-    unw_browse_img_small = unw_file + ".browse_small.png"
-    call_noerr("{} -P {}".format(mdx_app_path, unw_file))
-    call_noerr("convert out.ppm -transparent black -trim {}".format(unw_browse_img))
-    call_noerr("convert -resize 250x250 {} {}".format(unw_browse_img, unw_browse_img_small))
-    if os.path.exists('out.ppm'): os.unlink('out.ppm')
-
-    # unw 5cm browse
-    unw_5cm_browse_img = "unw.geo_5cm.browse.png"
-    unw_5cm_browse_img_small = "unw.geo_5cm.browse_small.png"
-    call_noerr("{} -P {} -wrap {}".format(mdx_app_path, unw_file, rad))
-    call_noerr("convert out.ppm -transparent black -trim {}".format(unw_5cm_browse_img))
-    call_noerr("convert -resize 250x250 {} {}".format(unw_5cm_browse_img, unw_5cm_browse_img_small))
-    if os.path.exists('out.ppm'): os.unlink('out.ppm')
-
-    # unw 20rad browse
-    unw_20rad_browse_img = "unw.geo_20rad.browse.png"
-    unw_20rad_browse_img_small = "unw.geo_20rad.browse_small.png"
-    call_noerr("{} -P {} -wrap 20".format(mdx_app_path, unw_file))
-    call_noerr("convert out.ppm -transparent black -trim {}".format(unw_20rad_browse_img))
-    call_noerr("convert -resize 250x250 {} {}".format(unw_20rad_browse_img, unw_20rad_browse_img_small))
-    if os.path.exists('out.ppm'): os.unlink('out.ppm')
-
-    # amplitude browse
     unw_xml = "filt_topophase.unw.geo.xml"
-    amplitude_browse_img = "amplitude.geo.browse.png"
-    amplitude_browse_img_small = "amplitude.geo.browse_small.png"
-    rt = parse(unw_xml)
-    size = eval(rt.xpath('.//component[@name="coordinate1"]/property[@name="size"]/value/text()')[0])
-    rtlr = size * 4
-    logger.info("rtlr value for amplitude browse is: {}".format(rtlr))
-    call_noerr("{} -P {} -s {} -amp -r4 -rtlr {} -CW".format(mdx_path, unw_file, size, rtlr))
-    call_noerr("convert out.ppm -transparent black -trim {}".format(amplitude_browse_img))
-    call_noerr("convert -resize 250x250 {} {}".format(amplitude_browse_img, amplitude_browse_img_small))
-    if os.path.exists('out.ppm'): os.unlink('out.ppm')
-
-    # topophase browse
-    top_file = "topophase.cor.geo"
-    top_browse_img = "top.geo.browse.png"
-    top_browse_img_small = "top.geo.browse_small.png"
-    call_noerr("{} -P {}".format(mdx_app_path, top_file))
-    call_noerr("convert out.ppm -transparent black -trim {}".format(top_browse_img))
-    call_noerr("convert -resize 250x250 {} {}".format(top_browse_img, top_browse_img_small))
-    if os.path.exists('out.ppm'): os.unlink('out.ppm')
-    '''
-    # create unw KMZ
-    unw_kml = "unw.geo.kml"
-    unw_kmz = "{}.kmz".format(id)
-    call_noerr("{} {} -kml {}".format(mdx_app_path, unw_file, unw_kml))
-    call_noerr("{}/create_kmz.py {} {}.png {}".format(BASE_PATH, unw_kml, unw_file, unw_kmz))
-
-    # move all browse images to root of product directory
-    call_noerr("mv -f *.png *.kmz ..")
-
-    # remove kml
-    call_noerr("rm -f *.kml")
-
-    # chdir back up to work directory
-    os.chdir(cwd)
-
-    # create displacement tile layer
-    tiles_dir = "{}/tiles".format(prod_dir)
+    unw_vrt = "filt_topophase.unw.geo.vrt"
     vrt_prod_file = "{}/merged/filt_topophase.unw.geo.vrt".format(prod_dir)
-    tiler_cmd_path = os.path.abspath(os.path.join(BASE_PATH, '..', '..', 'map_tiler'))
-    dis_layer = "displacement"
-    tiler_cmd_tmpl = "{}/create_tiles.py {} {}/{} -b 2 -m prism --nodata 0"
-    check_call(tiler_cmd_tmpl.format(tiler_cmd_path, vrt_prod_file, tiles_dir, dis_layer), shell=True)
-
-    # create amplitude tile layer
-    amp_layer = "amplitude"
-    tiler_cmd_tmpl = "{}/create_tiles.py {} {}/{} -b 1 -m gray --clim_min 10 --clim_max_pct 80 --nodata 0"
-    check_call(tiler_cmd_tmpl.format(tiler_cmd_path, vrt_prod_file, tiles_dir, amp_layer), shell=True)
-
-    # create COG (cloud optimized geotiff) with no_data set
-    cog_prod_file = "{}/merged/filt_topophase.unw.geo.tif".format(prod_dir)
-    cog_cmd_tmpl = "gdal_translate {} tmp.tif -co TILED=YES -co COMPRESS=DEFLATE -a_nodata 0"
-    check_call(cog_cmd_tmpl.format(vrt_prod_file), shell=True)
-    check_call("gdaladdo -r average tmp.tif 2 4 8 16 32", shell=True)
-    cog_cmd_tmpl = "gdal_translate tmp.tif {} -co TILED=YES -co COPY_SRC_OVERVIEWS=YES -co BLOCKXSIZE=512 -co BLOCKYSIZE=512 --config GDAL_TIFF_OVR_BLOCKSIZE 512"
-    check_call(cog_cmd_tmpl.format(cog_prod_file), shell=True)
-    os.unlink("tmp.tif")
-
-
-    # extract metadata from master
-    met_file = os.path.join(prod_dir, "{}.met.json".format(id))
-    extract_cmd_path = os.path.abspath(os.path.join(BASE_PATH, '..', 
-                                                    '..', 'frameMetadata',
-                                                    'sentinel'))
-    extract_cmd_tmpl = "{}/extractMetadata_standard_product.sh -i {}/annotation/s1?-iw?-slc-{}-*.xml -o {}"
-    check_call(extract_cmd_tmpl.format(extract_cmd_path, master_safe_dirs[0],
-                                       master_pol, met_file),shell=True)
-    
-    # update met JSON
     if 'RESORB' in ctx['master_orbit_file'] or 'RESORB' in ctx['slave_orbit_file']:
         orbit_type = 'resorb'
     else: orbit_type = 'poeorb'
     scene_count = min(len(master_safe_dirs), len(slave_safe_dirs))
     master_mission = MISSION_RE.search(master_safe_dirs[0]).group(1)
     slave_mission = MISSION_RE.search(slave_safe_dirs[0]).group(1)
-    unw_vrt = "filt_topophase.unw.geo.vrt"
-    #fine_int_xml = "fine_interferogram.xml"
-    update_met_cmd = '{}/update_met_json_standard_product.py {} {} "{}" {} {} {}/{} "{}" {}/{} {}/{} {}'
-    check_call(update_met_cmd.format(BASE_PATH, orbit_type, scene_count,
-                                     ctx['swathnum'], master_mission,
-                                     slave_mission, prod_dir, 'PICKLE',
-                                     fine_int_xmls,
-                                     prod_merged_dir, unw_vrt,
-                                     prod_merged_dir, unw_xml,
-                                     met_file), shell=True)
-
-    # add master/slave ids and orbits to met JSON (per ASF request)
     master_ids = [i.replace(".zip", "") for i in ctx['master_zip_file']]
     slave_ids = [i.replace(".zip", "") for i in ctx['slave_zip_file']]
-    master_rt = parse(os.path.join(prod_dir, master_xml))
+    master_rt = parse("master/IW{}.xml".format(swath_list[-1]))
     master_orbit_number = eval(master_rt.xpath('.//property[@name="orbitnumber"]/value/text()')[0])
-    slave_rt = parse(os.path.join(prod_dir, slave_xml))
+    slave_rt = parse("slave/IW{}.xml".format(swath_list[-1]))
     slave_orbit_number = eval(slave_rt.xpath('.//property[@name="orbitnumber"]/value/text()')[0])
-    with open(met_file) as f: md = json.load(f)
-    md['master_scenes'] = master_ids
-    md['slave_scenes'] = slave_ids
-    md['orbitNumber'] = [master_orbit_number, slave_orbit_number]
-    if ctx.get('stitch_subswaths_xt', False): md['swath'] = [1, 2, 3]
-    md['esd_threshold'] = esd_coh_th if do_esd else -1.  # add ESD coherence threshold
-
-    # add range_looks and azimuth_looks to metadata for stitching purposes
-    md['azimuth_looks'] = int(ctx['azimuth_looks'])
-    md['range_looks'] = int(ctx['range_looks'])
-
-    # add filter strength
-    md['filter_strength'] = float(ctx['filter_strength'])
-
-    # add dem_type
-    md['dem_type'] = dem_type
-
-    # write met json
-    print("creating met file : %s" %met_file)
-    with open(met_file, 'w') as f: json.dump(md, f, indent=2)
-    
-    # generate dataset JSON
-    ds_file = os.path.join(prod_dir, "{}.dataset.json".format(id))
-    print("creating dataset file : %s" %ds_file)
-    create_dataset_json(id, version, met_file, ds_file)
-    
-    #print( json.dump(md, f, indent=2))
-    
-    for swathnum in swath_list:
-
-        print("\n\n\n Extra Portion: Stitched Dataset\n\n")
-
-        met_file = os.path.join(prod_dir, "{}_s{}.met.json".format(id, swathnum))
-        print(met_file)
-
-        extract_cmd_path = os.path.abspath(os.path.join(BASE_PATH, '..',
+    extract_cmd_path = os.path.abspath(os.path.join(BASE_PATH, '..', 
                                                     '..', 'frameMetadata',
                                                     'sentinel'))
+    met_file = os.path.join(prod_dir, "{}.met.json".format(id))
+    met_files = [os.path.join(prod_dir, "{}_s{}.met.json".format(id, i)) for i in swath_list]
+    ds_files = [os.path.join(prod_dir, "{}_s{}.dataset.json".format(id, i)) for i in swath_list]
 
-        extract_cmd_tmpl = "{}/extractMetadata_s1.sh -i {}/annotation/s1?-iw{}-slc-{}-*.xml -o {}"
-        check_call(extract_cmd_tmpl.format(extract_cmd_path, master_safe_dirs[0],
-                                       swathnum, master_pol, met_file),shell=True)
-
-        # update met JSON
-        update_met_cmd = "{}/update_met_json.py {} {} {} {} {} {}/{} {}/{} {}/{} {}/{} {}"
-        check_call(update_met_cmd.format(BASE_PATH, orbit_type, scene_count,
-                                     swathnum, master_mission,
-                                     slave_mission, prod_dir, 'PICKLE',
-                                     prod_dir, fine_int_xml,
-                                     prod_merged_dir, unw_vrt,
-                                     prod_merged_dir, unw_xml,
-                                     met_file), shell=True)
-
- 
-
-        # master/slave ids and orbits
-
+    def update_md(met_file):
+        # add master/slave ids and orbits to met JSON (per ASF request)
         with open(met_file) as f: md = json.load(f)
         md['master_scenes'] = master_ids
         md['slave_scenes'] = slave_ids
@@ -1011,26 +810,160 @@ def main():
         md['dem_type'] = dem_type
 
         # write met json
+        print("creating met file : %s" %met_file)
         with open(met_file, 'w') as f: json.dump(md, f, indent=2)
-    
+
+    def export_raster(i):
+        # radar-coded and geo-coded products
+        for j in (i, "{}.geo".format(i)):
+            if j != i and not os.path.exists(j): continue
+            call_noerr("isce2gis.py envi -i {}".format(j))
+            for k in (j, "{}.xml".format(j), "{}.hdr".format(j), "{}.vrt".format(j)):
+                if os.path.exists(k): shutil.move(k, prod_merged_dir)
+                else: logger.warn("{} wasn't generated.".format(k))
+
+    def copy_swath(swathnum):
+        logger.info("\n\nPROCESSING SWATH : {}".format(swathnum))
+        shutil.copyfile("fine_interferogram/IW{}.xml".format(swathnum),
+                    os.path.join(prod_dir, "fine_interferogram_IW{}.xml".format(swathnum)))
+        shutil.copyfile("master/IW{}.xml".format(swathnum),
+                    os.path.join(prod_dir, "master_IW{}.xml".format(swathnum)))
+        shutil.copyfile("slave/IW{}.xml".format(swathnum),
+                    os.path.join(prod_dir, "slave_IW{}.xml".format(swathnum)))
+
+    def create_browse():
+        # browse images and KMZ rendered in-process: one read of the unw and one of the cor raster
+        from utils.browse import render_browse, write_kmz, image_snwe
+        unw_path = os.path.join(prod_merged_dir, unw_file)
+        top_file = "topophase.cor.geo"
+        #unwrapped image at different rates and amplitude image
+        unw_png = render_browse(unw_path, [(unw_file, 'rmg', 2 * np.pi),
+                                           (unw_file + "_5cm", 'rmg', rad),
+                                           (unw_file + "_20rad", 'rmg', 20.),
+                                           ('amplitude.geo', 'amp', None)],
+                                prod_dir, full=[unw_file])[0]
+        #coherence image
+        render_browse(os.path.join(prod_merged_dir, top_file), [(top_file, 'rmg', 1.2),
+                                                                 ("topophase_ph_only.cor.geo", 'phase', 1.2)],
+                      prod_dir)
+
+        # create unw KMZ
+        write_kmz(os.path.join(prod_dir, "{}.kmz".format(id)), unw_png, image_snwe(unw_path), id)
+
+    def create_tiles(layers):
+        # all tile layers are generated from a single read of the unw raster
+        tiles_dir = os.path.abspath("{}/tiles".format(prod_dir))
+        tiler_cmd_path = os.path.abspath(os.path.join(BASE_PATH, '..', '..', 'map_tiler'))
+        layer_opts = " ".join('-l {} "{}"'.format(layer, opts) for layer, opts in layers)
+        check_call("{}/create_tiles.py {} {} {}".format(tiler_cmd_path, os.path.abspath(vrt_prod_file),
+                                                        tiles_dir, layer_opts), shell=True)
+
+    def create_cog(prod_file):
+        # create COG (cloud optimized geotiff) with no_data set
+        from utils.cog import write_cog
+        cog_prod_file = "{}/merged/{}.tif".format(prod_dir, prod_file)
+        write_cog("{}/merged/{}.vrt".format(prod_dir, prod_file), cog_prod_file, nodata=0)
+
+    def create_met():
+        # extract metadata from master
+        extract_cmd_tmpl = "{}/extractMetadata_standard_product.sh -i {}/annotation/s1?-iw?-slc-{}-*.xml -o {}"
+        check_call(extract_cmd_tmpl.format(extract_cmd_path, master_safe_dirs[0],
+                                           master_pol, met_file),shell=True)
+
+        # update met JSON
+        update_met_cmd = '{}/update_met_json_standard_product.py {} {} "{}" {} {} {}/{} "{}" {}/{} {}/{} {}'
+        check_call(update_met_cmd.format(BASE_PATH, orbit_type, scene_count,
+                                         ctx['swathnum'], master_mission,
+                                         slave_mission, prod_dir, 'PICKLE',
+                                         fine_int_xmls,
+                                         prod_merged_dir, unw_vrt,
+                                         prod_merged_dir, unw_xml,
+                                         met_file), shell=True)
+        update_md(met_file)
+
         # generate dataset JSON
-        ds_file = os.path.join(prod_dir, "{}_s{}.dataset.json".format(id,swathnum))
-        print(ds_file)
+        ds_file = os.path.join(prod_dir, "{}.dataset.json".format(id))
+        print("creating dataset file : %s" %ds_file)
         create_dataset_json(id, version, met_file, ds_file)
-        
-        ds_files.append(ds_file)
-        met_files.append(met_file)
-    
-    # create stitched dataset json
-    ds_json_file= os.path.join(prod_dir, "{}.dataset.json".format("stitched"))
-    print(ds_json_file)
-    env, starttime, endtime = create_stitched_dataset_json(id, version, ds_files, ds_json_file)      
-    
 
-    # create stitched met json
-    met_json_file = os.path.join(prod_dir, "{}.met.json".format("stitched"))
-    print(met_json_file)
-    create_stitched_met_json(id, version, env, starttime, endtime, met_files, met_json_file)
+    def create_swath_met(index):
+        swathnum = swath_list[index]
+        print("\n\n\n Extra Portion: Stitched Dataset\n\n")
+        print(met_files[index])
+
+        extract_cmd_tmpl = "{}/extractMetadata_s1.sh -i {}/annotation/s1?-iw{}-slc-{}-*.xml -o {}"
+        check_call(extract_cmd_tmpl.format(extract_cmd_path, master_safe_dirs[0],
+                                       swathnum, master_pol, met_files[index]),shell=True)
+
+        # update met JSON
+        update_met_cmd = "{}/update_met_json.py {} {} {} {} {} {}/{} {}/{} {}/{} {}/{} {}"
+        check_call(update_met_cmd.format(BASE_PATH, orbit_type, scene_count,
+                                     swathnum, master_mission,
+                                     slave_mission, prod_dir, 'PICKLE',
+                                     prod_dir, fine_int_xml,
+                                     prod_merged_dir, unw_vrt,
+                                     prod_merged_dir, unw_xml,
+                                     met_files[index]), shell=True)
+        update_md(met_files[index])
+
+        # generate dataset JSON
+        print(ds_files[index])
+        create_dataset_json(id, version, met_files[index], ds_files[index])
+
+    def create_stitched():
+        # create stitched dataset json
+        ds_json_file= os.path.join(prod_dir, "{}.dataset.json".format("stitched"))
+        print(ds_json_file)
+        env, starttime, endtime = create_stitched_dataset_json(id, version, ds_files, ds_json_file)      
+
+        # create stitched met json
+        met_json_file = os.path.join(prod_dir, "{}.met.json".format("stitched"))
+        print(met_json_file)
+        create_stitched_met_json(id, version, env, starttime, endtime, met_files, met_json_file)
+
+    # post-topsApp steps run as a dependency graph; complete steps of an earlier attempt are skipped
+    graph = StepGraph(ctx.get("context", {}).get("post_nproc", min(4, os.cpu_count() or 1)), registry)
+    export_steps = []
+    for i in raster_prods:
+        export_steps.append("export_{}".format(os.path.basename(i)))
+        graph.add(export_steps[-1], lambda i=i: export_raster(i),
+                  outputs=[os.path.join(prod_merged_dir, os.path.basename(i))])
+    copy_steps = []
+    for swathnum in swath_list:
+        copy_steps.append("copy_swath_{}".format(swathnum))
+        graph.add(copy_steps[-1], lambda swathnum=swathnum: copy_swath(swathnum),
+                  outputs=[os.path.join(prod_dir, "{}_IW{}.xml".format(j, swathnum))
+                           for j in ("fine_interferogram", "master", "slave")])
+    unw_steps = ["export_filt_topophase.unw"]
+    graph.add("browse", create_browse, unw_steps + ["export_topophase.cor"],
+              outputs=[os.path.join(prod_dir, "{}.browse.png".format(unw_file)),
+                       os.path.join(prod_dir, "{}.kmz".format(id))])
+    tile_layers = (("displacement", "-b 2 -m prism --nodata 0"),
+                   ("amplitude", "-b 1 -m gray --clim_min 10 --clim_max_pct 80 --nodata 0"))
+    graph.add("tiles", lambda: create_tiles(tile_layers), unw_steps,
+              outputs=[os.path.join(prod_dir, "tiles", layer, "tilemapresource.xml") for layer, opts in tile_layers])
+    graph.add("cog", lambda: create_cog(unw_file), unw_steps,
+              outputs=["{}/merged/{}.tif".format(prod_dir, unw_file)])
+    graph.add("cog_coherence", lambda: create_cog("topophase.cor.geo"), ["export_topophase.cor"],
+              outputs=["{}/merged/topophase.cor.geo.tif".format(prod_dir)])
+    graph.add("met", create_met, unw_steps + copy_steps,
+              outputs=[met_file, os.path.join(prod_dir, "{}.dataset.json".format(id))])
+    swath_met_steps = []
+    for index, swathnum in enumerate(swath_list):
+        swath_met_steps.append("met_s{}".format(swathnum))
+        graph.add(swath_met_steps[-1], lambda index=index: create_swath_met(index), unw_steps + copy_steps,
+                  outputs=[met_files[index], ds_files[index]])
+    graph.add("stitched_met", create_stitched, swath_met_steps,
+              outputs=[os.path.join(prod_dir, "stitched.dataset.json"),
+                       os.path.join(prod_dir, "stitched.met.json")])
+    graph.run()
+
+    # record the times of the steps run in this attempt, and of the steps skipped as complete
+    # from an earlier attempt, in the product met json
+    with open(met_file) as f: md = json.load(f)
+    md['pge_step_times'] = registry.timings
+    md['pge_skipped_steps'] = registry.skipped
+    with open(met_file, 'w') as f: json.dump(md, f, indent=2)
 
 
     # move merged products to root of product directory
@@ -10,6 +10,9 @@ server = 'https://qc.sentinel1.eo.esa.int/'
 
 cal_re = re.compile(r'S1\w_AUX_CAL')
 
+####Result of the last query for the active calibration files, per output directory
+CAL_QUERY_CACHE = 'aux_cal_query.json'
+
 def cmdLineParse():
     '''
     Command line parser.
@@ -20,6 +23,8 @@ def cmdLineParse():
             help='Path to output directory')
     parser.add_argument('-d', '--dry-run', dest='dry_run', action='store_true',
             help="Don't download anything; just output the URLs")
+    parser.add_argument('-m', '--max-age', dest='max_age', type=float, default=24.,
+            help='Reuse the cached query for the active calibration files if younger than this many hours')
 
     return parser.parse_args()
 
@@ -148,19 +153,67 @@ def get_cal_url(id, es_url):
         r.raise_for_status()
 
 
-def fetch(outdir, dry_run):
+def load_query_cache(outdir, max_age):
+    """Cached active calibration urls if the cache is younger than max_age hours."""
+
+    path = os.path.join(outdir, CAL_QUERY_CACHE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        age = datetime.datetime.utcnow() - datetime.datetime.strptime(cache['queried'], '%Y-%m-%dT%H:%M:%S')
+    except (IOError, ValueError, KeyError):
+        return None
+    if age.total_seconds() > max_age * 3600.:
+        return None
+    return cache['cal_urls']
+
+
+def save_query_cache(outdir, active_ids, cal_urls):
+    """Save the active calibration urls."""
+
+    path = os.path.join(outdir, CAL_QUERY_CACHE)
+    cache = {
+        'queried': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        'active_ids': active_ids,
+        'cal_urls': cal_urls,
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.rename(path + '.tmp', path)
+
+
+def is_extracted(cal_url, outdir):
+    """Check if the calibration archive was already extracted into outdir."""
+
+    name = re.sub(r'\.(tgz|TGZ|tar\.gz)$', '', os.path.basename(cal_url))
+    return os.path.isdir(os.path.join(outdir, name))
+
+
+def fetch(outdir, dry_run, max_age=24.):
 
-    # get endpoint configurations
-    uu = UrlUtils()
-    es_url = uu.rest_url
+    # reuse a recent query
+    cal_urls = load_query_cache(outdir, max_age)
 
-    # get active calibration ids
-    active_ids = get_active_ids(es_url)
-    print(active_ids)
+    if cal_urls is None:
+        # get endpoint configurations
+        uu = UrlUtils()
+        es_url = uu.rest_url
 
-    # get urls for active calibration files
-    cal_urls = [get_cal_url(i, es_url) for i in active_ids]
-    print(cal_urls)
+        # get active calibration ids
+        active_ids = get_active_ids(es_url)
+        print(active_ids)
+
+        # get urls for active calibration files
+        cal_urls = [get_cal_url(i, es_url) for i in active_ids]
+        print(cal_urls)
+
+        if not dry_run and len(cal_urls) != 0:
+            if not os.path.isdir(outdir): os.makedirs(outdir)
+            save_query_cache(outdir, active_ids, cal_urls)
+    else:
+        print('Using cached calibration query: ', cal_urls)
 
 
     if len(cal_urls) == 0:
@@ -171,6 +224,9 @@ def fetch(outdir, dry_run):
     else:
         if not os.path.isdir(outdir): os.makedirs(outdir)
         for cal_url in cal_urls:
+            if is_extracted(cal_url, outdir):
+                print('Already extracted: ', cal_url)
+                continue
             try: cal_file = download_file(cal_url, outdir)
             except:
                 print('Failed to download URL: ', cal_url)
@@ -184,4 +240,4 @@ def fetch(outdir, dry_run):
 
 if __name__ == '__main__':
     inps = cmdLineParse()
-    fetch(inps.outdir, inps.dry_run)
+    fetch(inps.outdir, inps.dry_run, inps.max_age)
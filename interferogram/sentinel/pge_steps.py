@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Dependency graph of PGE steps executed with bounded parallelism, and a
+registry of completed steps so that a retried job resumes where it failed.
+"""
+
+import os, json, time, hashlib, logging, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
+logging.basicConfig(format=log_format, level=logging.INFO)
+logger = logging.getLogger('pge_steps')
+
+
+MARKER_DIR = "_pge_steps"
+
+
+def path_fingerprint(path):
+    """Fingerprint of a file or directory: md5 of small files, else sizes and mtimes."""
+
+    if os.path.isdir(path):
+        entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                fname = os.path.join(root, name)
+                st = os.stat(fname)
+                entries.append([os.path.relpath(fname, path), st.st_size, int(st.st_mtime)])
+        return entries
+    if not os.path.exists(path): return None
+    st = os.stat(path)
+    if st.st_size > 16 * 2**20:
+        return [st.st_size, int(st.st_mtime)]
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def output_exists(output):
+    """Check an output path, or any of a tuple of alternative paths, is present and not empty."""
+
+    if isinstance(output, (list, tuple)):
+        return any(output_exists(i) for i in output)
+    if os.path.isdir(output): return True
+    return os.path.isfile(output) and os.path.getsize(output) > 0
+
+
+class StepRegistry(object):
+    """
+    Completion markers of PGE steps in marker_dir. A marker records the input
+    fingerprint, the outputs and the (json) result of a step. A step is skipped
+    if its marker matches the current fingerprint, its outputs are present and
+    none of the steps it depends on was run again. By default a step depends on
+    all steps before it, so a retried job restarts at the first incomplete step.
+    The input files are fingerprinted as the step left them, so inputs a step
+    removes (e.g. unzipped archives) do not make it run again.
+    timings has the seconds of the steps run, skipped the marker of the steps skipped.
+    """
+
+    def __init__(self, marker_dir=MARKER_DIR):
+        self.marker_dir = os.path.abspath(marker_dir)
+        if not os.path.isdir(self.marker_dir): os.makedirs(self.marker_dir)
+        self.order = []
+        self.ran = set()
+        self.timings = {}
+        self.skipped = {}
+        self.lock = threading.Lock()
+
+    def marker_file(self, name):
+        return os.path.join(self.marker_dir, "{}.json".format(name))
+
+    def fingerprint(self, params=None, inputs=()):
+        """md5 of the step parameters and of the input files."""
+
+        fp = {'params': params, 'inputs': [[i, path_fingerprint(i)] for i in inputs]}
+        return hashlib.md5(json.dumps(fp, sort_keys=True, default=str).encode()).hexdigest()
+
+    def load(self, name):
+        try:
+            with open(self.marker_file(name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def is_complete(self, name, fingerprint, deps):
+        """Stored marker if the step need not be run again, else None."""
+
+        if any(dep in self.ran for dep in deps): return None
+        marker = self.load(name)
+        if marker is None or marker['fingerprint'] != fingerprint: return None
+        if not all(output_exists(i) for i in marker['outputs']): return None
+        return marker
+
+    def mark_complete(self, name, fingerprint, outputs, result, seconds):
+        marker = {
+            'fingerprint': fingerprint,
+            'outputs': outputs,
+            'result': result,
+            'seconds': seconds,
+            'completed': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        path = self.marker_file(name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(marker, f, indent=2)
+        os.rename(path + '.tmp', path)
+
+    def run(self, name, func, outputs=(), params=None, inputs=(), deps=None):
+        """
+        Run func() unless the step is complete and return its result. outputs is
+        a list of paths (or tuples of alternative paths) or a function of the
+        result returning one. deps defaults to all steps registered before.
+        Returns (result, seconds, skipped).
+        """
+
+        with self.lock:
+            if deps is None: deps = list(self.order)
+            self.order.append(name)
+        fingerprint = self.fingerprint(params, inputs)
+        marker = self.is_complete(name, fingerprint, deps)
+        if marker is not None:
+            logger.info("Step {} is complete. Skipping.".format(name))
+            self.skipped[name] = {'seconds': marker['seconds'], 'completed': marker['completed']}
+            return marker['result'], marker['seconds'], True
+
+        # invalidate the marker before running so an interrupted step is run again
+        with self.lock:
+            self.ran.add(name)
+            if os.path.exists(self.marker_file(name)): os.unlink(self.marker_file(name))
+        t0 = time.time()
+        result = func()
+        seconds = round(time.time() - t0, 3)
+        fingerprint = self.fingerprint(params, inputs)
+        if callable(outputs): outputs = outputs(result)
+        self.mark_complete(name, fingerprint, list(outputs), result, seconds)
+        self.timings[name] = seconds
+        return result, seconds, False
+
+
+class StepGraph(object):
+    """
+    Named steps with dependencies. A step is started as soon as all its
+    dependencies have completed, with at most max_workers steps running at a
+    time. Steps run in threads and must not change the working directory.
+    With a StepRegistry, complete steps are skipped (see StepRegistry) and steps
+    also depend on the steps run through the registry before the graph.
+    """
+
+    def __init__(self, max_workers=4, registry=None):
+        self.max_workers = max(1, int(max_workers))
+        self.registry = registry
+        self.prefix = list(registry.order) if registry is not None else []
+        self.steps = []
+        self.deps = {}
+        self.funcs = {}
+        self.outputs = {}
+        self.timings = {}
+
+    def add(self, name, func, deps=(), outputs=()):
+        """Add step name running func() after the steps in deps."""
+
+        if name in self.funcs:
+            raise ValueError("Duplicate step %s." % name)
+        for dep in deps:
+            if dep not in self.funcs:
+                raise ValueError("Step %s depends on unknown step %s." % (name, dep))
+        self.steps.append(name)
+        self.deps[name] = tuple(deps)
+        self.funcs[name] = func
+        self.outputs[name] = outputs
+
+    def _run_step(self, name):
+        logger.info("Starting step {}.".format(name))
+        if self.registry is not None:
+            result, secs, skipped = self.registry.run(name, self.funcs[name], self.outputs[name],
+                                                      deps=self.prefix + list(self.deps[name]))
+            if skipped: return
+            self.timings[name] = secs
+        else:
+            t0 = time.time()
+            self.funcs[name]()
+            self.timings[name] = round(time.time() - t0, 3)
+        logger.info("Finished step {} in {:.1f} s.".format(name, self.timings[name]))
+
+    def run(self):
+        """
+        Run all steps and return {step: seconds} of the steps run. On failure no new steps are
+        started, running steps are waited for and the first exception is raised.
+        """
+
+        done = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            while True:
+                if error is None:
+                    for name in self.steps:
+                        if len(running) >= self.max_workers: break
+                        if name in done or name in running.values(): continue
+                        if all(dep in done for dep in self.deps[name]):
+                            running[pool.submit(self._run_step, name)] = name
+
+                if len(running) == 0: break
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    name = running.pop(fut)
+                    try:
+                        fut.result()
+                        done.add(name)
+                    except Exception as e:
+                        logger.error("Step {} failed: {}".format(name, str(e)))
+                        if error is None: error = e
+
+        if error is not None: raise error
+        return dict(self.timings)
@@ -10,7 +10,8 @@ import json
 import numpy as np
 import subprocess as sp
 from datetime import datetime, timedelta
-import fractions
+import math
+import time
 def get_data_from_url(url):
     uu = UrlUtils()
     command = 'curl -k -f -u' + uu.dav_u + ':' + uu.dav_p + ' -O ' + url
@@ -318,64 +319,167 @@ def url_from_dates(dates_complete):
             urls.append(v)
     return urls, dates_incomplete
 
+def date2num(date):
+    return datetime.strptime(date,'%Y%m%d').toordinal()
+
+def num2date(num):
+    return datetime.strftime(datetime.fromordinal(int(num)),'%Y%m%d')
+
+def min_interval_cover(intervals):
+    '''
+    Select the minimum number of half-open intervals [start,end) that cover the span
+    from the earliest start to the latest end. Among the intervals reaching furthest
+    the shortest (latest start) is preferred. Runs in O(n log n).
+    inputs:
+        intervals: (n,2) array of [start,end] integers
+    outputs:
+        sel, gaps: indices of the selected intervals in order of time and list of
+                   [start,end) uncovered ranges. If gaps is not empty sel is empty.
+    '''
+    intervals = np.asarray(intervals)
+    if len(intervals) == 0:
+        return [],[]
+    #order by start, then longest first so that the furthest reach is seen first
+    order = np.lexsort((-intervals[:,1],intervals[:,0]))
+    starts = intervals[order,0]
+    ends = intervals[order,1]
+    cur = starts[0]
+    span_end = np.max(ends)
+    sel = []
+    gaps = []
+    i = 0
+    n = len(order)
+    while cur < span_end:
+        best = -1
+        reach = cur
+        while i < n and starts[i] <= cur:
+            #>= so that for equal reach the latest start, i.e. shortest repeat, wins
+            if ends[i] >= reach and ends[i] > cur:
+                best = i
+                reach = ends[i]
+            i += 1
+        if best < 0:
+            #nothing covers cur, jump to the next start and record the hole
+            nxt = starts[i] if i < n else span_end
+            gaps.append([cur,nxt])
+            cur = nxt
+            continue
+        sel.append(order[best])
+        cur = reach
+    if gaps:
+        return [],gaps
+    return sel,[]
+
 def get_ts_dates(urls):
+    '''
+    Return the [master,slave] dates (as int yyyymmdd) of the minimum chain of urls
+    covering the time span of urls. Each element of urls is a list whose first
+    url is used to get the dates.
+    '''
     dates = []
     for u in urls:
         dates.append(get_dates(u[0]))
-    dates = np.array(dates).astype(np.int)       
-    dts,indx = np.unique(dates[:,1],True)
-    i = 0
-    
-    res = [dates[i]]
-    aux = []
-    guard = 0
-    while i < len(dates) - 1:
-        sel = np.nonzero(dates[i + 1:,1] == dates[i,0])[0]
-        print(i,dates[i,:],i + 1 + sel)
-        #Tracer()()
-        if len(sel) == 0:
-            cont = False
-            guard1 = 0
-            while True:
-                i += 1
-                if i >= len(dates):
-                    break
-                if guard1 == 150:
-                    break
-                if dates[i,1] >= dates[i-1,1] and dates[i,0] > dates[i-1,0]:
-                    res.append(dates[i,:])
-                    aux.append([i,len(np.nonzero(dates[i:,1] == dates[i,1])[0])])
-                    cont = True
-                    break
-                guard1 += 1
-            if cont:
-                i += 1
+    dates = np.array(dates).astype(int)
+    ndates = np.array([[date2num(str(d[1])),date2num(str(d[0]))] for d in dates])
+    sel,gaps = min_interval_cover(ndates)
+    return [dates[i] for i in sel]
+
+def get_ts_urls(urls,min_repeat=12,max_repeat=72,only_best=True):
+    '''
+    Given a set if url provide a list of the minimun number of urls that cover temporally 
+    the time sapn givend by the minimun and maximun date in the urls
+    inputs:
+        urls: list of dicts of the from {1:[url1,url2],2:[url1,url2]} where the
+              key is the swath number and the urls are the urls for that date and swath
+        min_repeat: use ifg with repeat of at least min_repeat days
+        max_repeat: use ifg with repeat of at the most min_repeat days
+        only_best: if False return all the urls with a valid repeat sorted by date
+    outputs:
+        output_urls: list with elements of urls that cover the temporal span or
+                     ([],gaps) where gaps is the list of uncovered dates
+    '''
+    urls = np.array(urls)
+    ndates = []
+    for u in urls:
+        #get one of the key and use that to get the value. from any of
+        #the urls we can get the dates
+        v = u[list(u.keys())[0]]
+        d = [date2num(x) for x in get_dates(v[0])]
+        ndates.append([min(d),max(d)])
+    ndates = np.array(ndates)
+    span = [np.min(ndates[:,0]),np.max(ndates[:,1])]
+    repeats = ndates[:,1] - ndates[:,0]
+    valid = np.nonzero(np.logical_and(repeats >= min_repeat,repeats <= max_repeat))[0]
+    #the valid ifgs must still cover the whole span of all the ifgs
+    sel,gaps = min_interval_cover(ndates[valid])
+    if len(valid):
+        if np.min(ndates[valid,0]) > span[0]:
+            gaps.insert(0,[span[0],np.min(ndates[valid,0])])
+        if np.max(ndates[valid,1]) < span[1]:
+            gaps.append([np.max(ndates[valid,1]),span[1]])
+    else:
+        gaps = [span]
+    if gaps:
+        ret = []
+        for g in gaps:
+            ret.extend([num2date(i) for i in range(g[0],g[1])])
+        return [],ret
+    if only_best:
+        seldates = valid[sel]
+    else:
+        seldates = valid[np.lexsort((ndates[valid,1],ndates[valid,0]))]
+    return urls[seldates]
+
+def make_synthetic_catalog(years,min_repeat=6,max_repeat=48,seed=0):
+    '''
+    Create a list of url dicts as returned by sort_data_dev with acquisitions
+    every 6 or 12 days and ifgs to the next 1-4 acquisitions for benchmarking.
+    '''
+    rng = np.random.RandomState(seed)
+    start = date2num('20150101')
+    acqs = [start]
+    while acqs[-1] < start + 365*years:
+        acqs.append(acqs[-1] + rng.choice([6,12]))
+    urls = []
+    for i in range(len(acqs)):
+        for j in range(i+1,min(i+5,len(acqs))):
+            if not min_repeat <= acqs[j] - acqs[i] <= max_repeat:
                 continue
-            else:
-                break
-        res.append(dates[i + 1 + sel[0],:])
-        aux.append([i,len(np.nonzero(dates[i:,1] == dates[i,1])[0])])
-        i += sel[0] + 1
-        guard += 1
-        if guard == 150:
-            break
-    return res
+            name = 'S1-IFG_STCM_IW_TN001_{}T000000-{}T000000_s1-poeorb-v1'.format(num2date(acqs[j]),num2date(acqs[i]))
+            urls.append({1:['http://localhost/' + name]})
+    return urls
 
-def date2num(date):
-    return datetime.strptime(date,'%Y%m%d').toordinal()
+def benchmark_ts_urls(years=(1,3,5),min_repeat=6,max_repeat=48):
+    '''
+    Compare run time and number of selected urls of get_ts_urls against
+    get_ts_urls_legacy on synthetic catalogs of increasing time span.
+    '''
+    res = []
+    for y in years:
+        urls = make_synthetic_catalog(y,min_repeat,max_repeat)
+        t0 = time.time()
+        new = get_ts_urls(urls,min_repeat,max_repeat)
+        t1 = time.time()
+        old = get_ts_urls_legacy(urls,min_repeat,max_repeat)
+        t2 = time.time()
+        res.append({'years':y,'nurls':len(urls),'selected':len(new),'selected_legacy':len(old),
+                    'time':t1 - t0,'time_legacy':t2 - t1})
+        print(res[-1])
+    return res
 
 #find the smallest step that will sample all the dates at least once
 def get_smallest_step(repeats):
     best = np.max(repeats)
     for i in range(len(repeats)-1):
         for j in range(i,len(repeats)):
-            gdc = fractions.gcd(repeats[i],repeats[j])
+            gdc = math.gcd(repeats[i],repeats[j])
             if gdc < best:
                 best = gdc
     return best
             
-def get_ts_urls(urls,min_repeat=12,max_repeat=72,only_best=True):
+def get_ts_urls_legacy(urls,min_repeat=12,max_repeat=72,only_best=True):
     '''
+    Dense occupancy matrix version of get_ts_urls, kept for benchmarking.
     Given a set if url provide a list of the minimun number of urls that cover temporally 
     the time sapn givend by the minimun and maximun date in the urls
     inputs:
@@ -414,8 +518,8 @@ def get_ts_urls(urls,min_repeat=12,max_repeat=72,only_best=True):
     #find the unique repeats
     urepeats = np.unique(repeats[np.logical_and(repeats >= min_repeat,repeats <= max_repeat)])
     sur = urepeats.size
-    occ = np.zeros((sur,np.max(ndates))).astype(np.int)
-    occ2repeat = np.zeros((sur,np.max(ndates))).astype(np.int)
+    occ = np.zeros((sur,np.max(ndates))).astype(int)
+    occ2repeat = np.zeros((sur,np.max(ndates))).astype(int)
     #for each repeat check the dates that it covers and give it a 
     #unique identifiers (sur - 1)**i
     for i in range(sur):
@@ -424,7 +528,7 @@ def get_ts_urls(urls,min_repeat=12,max_repeat=72,only_best=True):
             occ[i,ndates[j,0]:ndates[j,1]] = (sur - 1)**i
             occ2repeat[i,ndates[j,0]:ndates[j,1]] = j 
     #for now only proceed if it's all covered, eventually use largest chuck
-    non_covered = np.nonzero(np.max(np.cumsum(occ,0),0).astype(np.int) == 0)[0]
+    non_covered = np.nonzero(np.max(np.cumsum(occ,0),0).astype(int) == 0)[0]
     if len(non_covered) > 0:
         ret = []
         for i in non_covered:
@@ -544,6 +648,9 @@ def main(args):
         json.dump(fnames,open(ifg_names,'w'), indent=2, sort_keys=True)
     elif iargs.action == 'stitch':
         stitch(iargs.input)
+    elif iargs.action == 'benchmark_ts':
+        res = benchmark_ts_urls(inps.get('years',[1,3,5]),inps.get('min_repeat',6),inps.get('max_repeat',48))
+        json.dump(res,open(inps['output_file'],'w'), indent=2, sort_keys=True)
     else:
         print('Unrecognized option',iargs.action)
         raise ValueError
@@ -1,112 +1,247 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
-Add tiles to IFG product.
+Add tiles to IFG products.
+
+Lists the IFG products of an index that do not have tiles yet and tiles them
+with a bounded pool of concurrent workers: download the unwrapped
+interferogram, tile the displacement and amplitude layers, upload the tiles
+and update the product document. Completed and failed products are recorded
+in a progress ledger so that an interrupted backfill resumes where it stopped.
 """
 
-import os, sys, json, requests, shutil, argparse
-from urlparse import urlparse
-from pyes import ES
-from pprint import pprint
+import os, sys, json, time, shutil, logging, argparse, threading, traceback
+from urllib.parse import urlparse
 from subprocess import check_call
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+
+import requests
+
+
+log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
+logging.basicConfig(format=log_format, level=logging.INFO)
+logger = logging.getLogger('add_tiles_to_ifg')
+
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+LEDGER_NAME = "add_tiles_ledger.json"
+
+TILE_LAYERS = (("amplitude", "-b 1 -m gray --clim_min 10 --clim_max_pct 80 --nodata 0"),
+               ("displacement", "-b 2 -m prism --nodata 0"))
+
 
-from osaka.main import get, put
+class Ledger(object):
+    """
+    Progress of the backfill: {product id: {status, seconds, error, time}}
+    with status done or failed. Done products are not processed again.
+    """
 
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.products = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                self.products = json.load(f)
 
-BASE_PATH = os.path.dirname(__file__)
+    def is_done(self, prod_id):
+        return self.products.get(prod_id, {}).get('status') == 'done'
 
+    def record(self, prod_id, status, seconds, error=None):
+        with self.lock:
+            self.products[prod_id] = {
+                'status': status,
+                'seconds': seconds,
+                'error': error,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            with open(self.fname + '.tmp', 'w') as f:
+                json.dump(self.products, f, indent=2, sort_keys=True)
+            os.replace(self.fname + '.tmp', self.fname)
 
-# get source and destination index
-es_url = sys.argv[1]
-src = sys.argv[2]
-doc_type = "InSAR"
 
-# get connection
-conn = ES(es_url)
+SCROLL = "60m"
 
-# index all docs from source index to destination index
-query = {
-  "query": {
-    "match_all": {}
-  }
-}
-r = requests.post('%s/%s/_search?search_type=scan&scroll=60m&size=100' % (es_url, src), data=json.dumps(query))
-scan_result = r.json()
-count = scan_result['hits']['total']
-scroll_id = scan_result['_scroll_id']
-results = []
-cwd = os.getcwd()
-while True:
-    r = requests.post('%s/_search/scroll?scroll=60m' % es_url, data=scroll_id)
+
+def iter_candidates(es_url, index, page_size=100, scroll=SCROLL):
+    """
+    Yield the hits of products in index without tiles, page by page. A scroll
+    is used so that products updated during the backfill do not shift the pages.
+    Only the fields needed to tile a product are returned.
+    """
+
+    query = {
+        "_source": ["urls", "metadata.tiles"],
+        "query": {
+            "bool": {
+                "must_not": { "term": { "metadata.tiles": True } }
+            }
+        }
+    }
+    r = requests.post('%s/%s/_search?scroll=%s&size=%d' % (es_url, index, scroll, page_size), data=json.dumps(query))
+    r.raise_for_status()
     res = r.json()
-    scroll_id = res['_scroll_id']
-    if len(res['hits']['hits']) == 0: break
-    for hit in res['hits']['hits']:
-        doc = hit['_source']
-
-        # skip if tiles already generated
-        tiles = doc['metadata'].get('tiles', False)
-        if tiles:
-            print "Skipping {}. Tiles already generated.".format(hit['_id'])
-            continue
-
-        # create work dir
-        prod_id = hit['_id']
-        work_dir = prod_id
-        prod_url = None
-        for url in doc['urls']:
-            if url.startswith('s3://'):
-                prod_url = url
-                break
-        if prod_url is None:
-            print "Failed to find s3 url for prod %s" % prod_id
-            continue
-        if os.path.exists(work_dir): shutil.rmtree(work_dir)
-        os.makedirs(work_dir, 0755)
-        os.chdir(work_dir)
-        merged_dir = "merged"
-        if os.path.exists(merged_dir): shutil.rmtree(merged_dir)
-        os.makedirs(merged_dir, 0755)
+    scroll_id = res.get('_scroll_id')
+    try:
+        while len(res['hits']['hits']) > 0:
+            for hit in res['hits']['hits']:
+                yield hit
+            r = requests.post('%s/_search/scroll?scroll=%s' % (es_url, scroll), data=scroll_id)
+            r.raise_for_status()
+            res = r.json()
+            scroll_id = res.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id is not None:
+            try: requests.delete('%s/_search/scroll' % es_url, data=scroll_id)
+            except Exception as e: logger.warn("Failed to clear scroll: {}".format(str(e)))
+
+
+def product_url(doc):
+    """s3 url of a product document, None if it has none."""
+
+    for url in doc.get('urls', []):
+        if url.startswith('s3://'):
+            return url
+    return None
+
+
+def tile_product(es_url, hit, work_root, nproc=None):
+    """Tile a product in its own work directory and flag its document as tiled."""
+
+    from osaka.main import get, put
+
+    doc = hit['_source']
+    prod_id = hit['_id']
+    prod_url = product_url(doc)
+    if prod_url is None:
+        raise RuntimeError("Failed to find s3 url for prod %s" % prod_id)
+
+    # create work dir
+    work_dir = os.path.join(work_root, prod_id)
+    if os.path.exists(work_dir): shutil.rmtree(work_dir)
+    merged_dir = os.path.join(work_dir, "merged")
+    os.makedirs(merged_dir)
+    try:
         unw_prod_file = "filt_topophase.unw.geo"
         unw_prod_url = "%s/merged/%s" % (prod_url, unw_prod_file)
-        get(unw_prod_url, "merged/{}".format(unw_prod_file))
+        get(unw_prod_url, os.path.join(merged_dir, unw_prod_file))
         for i in ('hdr', 'vrt', 'xml'):
-            get("{}.{}".format(unw_prod_url, i), "merged/{}.{}".format(unw_prod_file, i))
-        
-        #print json.dumps(doc, indent=2)
+            get("{}.{}".format(unw_prod_url, i), os.path.join(merged_dir, "{}.{}".format(unw_prod_file, i)))
 
         # clean out tiles if exists
-        parsed_url = urlparse(prod_url) 
+        parsed_url = urlparse(prod_url)
         tiles_url = "s3://{}/tiles".format(parsed_url.path[1:])
-        cmd = "aws s3 rm --recursive {}"
-        check_call(cmd.format(tiles_url), shell=True)
-
-        # create displacement tile layer
-        vrt_prod_file = "{}.vrt".format(unw_prod_file)
-        dis_layer = "displacement"
-        cmd = "{}/create_tiles.py merged/{} {}/{} -b 2 -m prism --nodata 0"
-        check_call(cmd.format(BASE_PATH, vrt_prod_file, 'tiles', dis_layer), shell=True)
+        check_call("aws s3 rm --recursive {}".format(tiles_url), shell=True)
 
-        # create amplitude tile layer
-        amp_layer = "amplitude"
-        cmd = "{}/create_tiles.py merged/{} {}/{} -b 1 -m gray --clim_min 10 --clim_max_pct 80 --nodata 0"
-        check_call(cmd.format(BASE_PATH, vrt_prod_file, 'tiles', amp_layer), shell=True)
+        # create all tile layers from one read of the raster
+        tiles_dir = os.path.join(work_dir, "tiles")
+        cmd = "{}/create_tiles.py {} {}".format(BASE_PATH, os.path.join(merged_dir, "{}.vrt".format(unw_prod_file)),
+                                                tiles_dir)
+        cmd += "".join(' -l {} "{}"'.format(layer, opts) for layer, opts in TILE_LAYERS)
+        if nproc: cmd += " -p {}".format(nproc)
+        check_call(cmd, shell=True)
 
         # upload tiles
-        put("tiles", "{}/tiles".format(prod_url))
-        
+        put(tiles_dir, "{}/tiles".format(prod_url))
+
         # upsert new document
         new_doc = {
-            "doc": { "metadata": { "tiles": True, "tile_layers": [ amp_layer, dis_layer ] } },
+            "doc": { "metadata": { "tiles": True, "tile_layers": [ layer for layer, opts in TILE_LAYERS ] } },
             "doc_as_upsert": True
         }
-        r = requests.post('%s/%s/%s/%s/_update' % (es_url, src, doc_type, hit['_id']), data=json.dumps(new_doc))
-        result = r.json()
+        r = requests.post('%s/%s/%s/%s/_update' % (es_url, hit['_index'], hit.get('_type', 'InSAR'), prod_id),
+                          data=json.dumps(new_doc))
         if r.status_code != 200:
-            app.logger.debug("Failed to update user_tags for %s. Got status code %d:\n%s" %
-                             (id, r.status_code, json.dumps(result, indent=2)))
+            logger.error("Failed to update tiles for %s. Got status code %d:\n%s" %
+                         (prod_id, r.status_code, r.text))
         r.raise_for_status()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def backfill(es_url, index, workers=4, page_size=100, ledger_file=LEDGER_NAME, work_root=None,
+             retry_failed=True, report_every=10, process=tile_product, scroll=SCROLL):
+    """
+    Tile the products of index without tiles with at most workers products in
+    progress. process(es_url, hit, work_root, nproc) tiles one product. Returns
+    (number done, number failed, number skipped).
+    """
+
+    # list all candidates before tiling so that the scroll is not kept open
+    # (and does not expire) while products are being tiled
+    candidates = list(iter_candidates(es_url, index, page_size, scroll))
+    logger.info("Found {} products without tiles.".format(len(candidates)))
+
+    ledger = Ledger(ledger_file)
+    work_root = os.path.abspath(work_root or os.getcwd())
+    nproc = max(1, (os.cpu_count() or 1) // workers)
+    done, failed, skipped = 0, 0, 0
+    t0 = time.time()
+
+    def run(hit):
+        t = time.time()
+        process(es_url, hit, work_root, nproc)
+        return round(time.time() - t, 3)
+
+    def report(final=False):
+        elapsed = time.time() - t0
+        rate = done / elapsed * 3600. if elapsed > 0 else 0.
+        logger.info("{}{} done, {} failed, {} skipped in {:.0f} s ({:.1f} products/hour).".format(
+                    "Backfill finished: " if final else "", done, failed, skipped, elapsed, rate))
+
+    running = {}
+    with ThreadPoolExecutor(workers) as pool:
+        def collect(return_when):
+            nonlocal done, failed
+            finished, _ = wait(list(running), return_when=return_when)
+            for fut in finished:
+                hit = running.pop(fut)
+                try:
+                    ledger.record(hit['_id'], 'done', fut.result())
+                    done += 1
+                except Exception as e:
+                    logger.error("Failed to tile {}: {}".format(hit['_id'], str(e)))
+                    logger.error("Traceback: {}".format(traceback.format_exc()))
+                    ledger.record(hit['_id'], 'failed', None, str(e))
+                    failed += 1
+                if (done + failed) % report_every == 0: report()
+
+        for hit in candidates:
+            # skip if tiles already generated
+            prod_id = hit['_id']
+            failed_before = ledger.products.get(prod_id, {}).get('status') == 'failed'
+            if hit['_source'].get('metadata', {}).get('tiles', False) or ledger.is_done(prod_id) or \
+               (failed_before and not retry_failed):
+                logger.info("Skipping {}. Tiles already generated or failed.".format(prod_id))
+                skipped += 1
+                continue
+
+            # bounded number of products in progress
+            if len(running) >= workers: collect(FIRST_COMPLETED)
+            running[pool.submit(run, hit)] = hit
+        if running: collect(ALL_COMPLETED)
+
+    report(True)
+    return done, failed, skipped
+
 
-        # clean
-        os.chdir(cwd)
-        if os.path.exists(work_dir):
-            shutil.rmtree(work_dir)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("es_url", help="ElasticSearch URL")
+    parser.add_argument("index", help="index of the IFG products")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=4, help="number of products tiled concurrently")
+    parser.add_argument("-s", "--page_size", dest="page_size", type=int,
+                        default=100, help="number of products per page of candidates")
+    parser.add_argument("--scroll", dest="scroll", default=SCROLL,
+                        help="keep-alive of the scroll listing the candidates (default: %(default)s)")
+    parser.add_argument("-l", "--ledger", dest="ledger", default=LEDGER_NAME,
+                        help="progress ledger of the backfill")
+    parser.add_argument("--work_root", dest="work_root", default=None,
+                        help="directory for the product work directories (default: current directory)")
+    parser.add_argument("--no_retry_failed", dest="retry_failed", action='store_false',
+                        help="skip products that failed in an earlier run")
+    args = parser.parse_args()
+    done, failed, skipped = backfill(args.es_url, args.index, args.workers, args.page_size,
+                                     args.ledger, args.work_root, args.retry_failed, scroll=args.scroll)
+    sys.exit(1 if failed else 0)
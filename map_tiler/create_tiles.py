@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 """
-Map tiler PGE wrapper to generate map tiles following the 
+Map tiler PGE wrapper to generate map tiles following the
 OSGeo Tile Map Service Specification.
+
+Tiles are generated in-process in the global mercator profile of gdal2tiles.
+The source raster (in geographic coordinates) is read once, in strips, and
+block averaged down to about the resolution of the maximum zoom. All layers
+(e.g. displacement and amplitude) are rendered from that single pass: the
+tiles of the maximum zoom are sampled from the averaged bands and colorized,
+and the tiles of each lower zoom are made by downsampling the 4 tiles below
+them. Tiles of a zoom level are written in parallel by a pool of processes.
 """
 
-import os, sys, traceback, logging, argparse
-from subprocess import check_call
+import os, math, shlex, logging, argparse
+import multiprocessing as mp
+import numpy as np
 
-from get_clims import get_clims
+from get_clims import HistogramSketch, iter_blocks
+from utils.cog import average_levels
+from utils.browse import write_png, read_png
 
 
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
@@ -17,76 +28,305 @@ logger = logging.getLogger('create_tiles')
 
 BASE_PATH = os.path.dirname(__file__)
 
+TILE_SIZE = 256
+MAX_LAT = 85.0511287798066
 
-def call_noerr(cmd):
-    """Run command and warn if exit status is not 0."""
+# averaged bands, geotransform and layers shared with the forked tile workers
+_PYRAMID = {}
 
-    try: check_call(cmd, shell=True)
-    except Exception as e:
-        logger.warn("Got exception running {}: {}".format(cmd, str(e)))
-        logger.warn("Traceback: {}".format(traceback.format_exc()))
 
+def tile_pixels(zoom):
+    """Size in pixels of the world at zoom."""
+
+    return TILE_SIZE * 2 ** zoom
+
+
+def lon_to_px(lon, zoom):
+    return (np.asarray(lon, dtype=np.float64) + 180.) / 360. * tile_pixels(zoom)
+
+
+def lat_to_py(lat, zoom):
+    """Global mercator pixel row (from the top) of latitude lat."""
+
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT))
+    return (1. - np.log(np.tan(lat) + 1. / np.cos(lat)) / np.pi) / 2. * tile_pixels(zoom)
+
+
+def px_to_lon(px, zoom):
+    return np.asarray(px, dtype=np.float64) / tile_pixels(zoom) * 360. - 180.
+
+
+def py_to_lat(py, zoom):
+    return np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * np.asarray(py, dtype=np.float64) / tile_pixels(zoom)))))
+
+
+def tile_path(output_dir, zoom, tx, ty):
+    """Path of TMS tile (tx, ty) (ty counted from the bottom as in gdal2tiles)."""
+
+    return os.path.join(output_dir, str(zoom), str(tx), "{}.png".format(ty))
+
+
+def get_cmap(name):
+    """Function mapping values in [0, 1] to RGBA in [0, 1] for a matplotlib colormap name."""
+
+    if name == 'gray':
+        return lambda x: np.stack([x, x, x, np.ones_like(x)], axis=-1)
+    import matplotlib
+    return matplotlib.colormaps[name]
+
+
+def colorize(data, cmap, vmin, vmax, nodata=None):
+    """RGBA tile of data scaled between vmin and vmax; nodata and NaN are transparent."""
+
+    valid = np.isfinite(data)
+    if nodata is not None: valid &= (data != nodata)
+    scale = (vmax - vmin) if vmax != vmin else 1.
+    frac = np.clip((np.where(valid, data, vmin) - vmin) / scale, 0., 1.)
+    rgba = np.round(np.asarray(get_cmap(cmap)(frac))[..., :4] * 255).astype(np.uint8)
+    rgba[..., 3] = 255
+    rgba[~valid] = 0
+    return rgba
+
+
+def base_tile(data, geotrans, zoom, tx, ty):
+    """Nearest samples of data in TMS tile (tx, ty) of zoom, and their validity."""
+
+    n = 2 ** zoom
+    px = tx * TILE_SIZE + np.arange(TILE_SIZE) + 0.5
+    py = (n - 1 - ty) * TILE_SIZE + np.arange(TILE_SIZE) + 0.5
+    cols = np.floor((px_to_lon(px, zoom) - geotrans[0]) / geotrans[1]).astype(int)
+    rows = np.floor((py_to_lat(py, zoom) - geotrans[3]) / geotrans[5]).astype(int)
+    cvalid = (cols >= 0) & (cols < data.shape[1])
+    rvalid = (rows >= 0) & (rows < data.shape[0])
+    tile = data[np.ix_(np.clip(rows, 0, data.shape[0] - 1), np.clip(cols, 0, data.shape[1] - 1))]
+    return tile, rvalid[:, None] & cvalid[None, :]
+
+
+def downsample_tile(children):
+    """
+    Tile from the 2x2 TMS children [[top left, top right], [bottom left, bottom right]]
+    (None if missing), averaging colors weighted by alpha.
+    """
+
+    mosaic = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=np.float64)
+    for i in range(2):
+        for j in range(2):
+            if children[i][j] is not None:
+                mosaic[i*TILE_SIZE:(i+1)*TILE_SIZE, j*TILE_SIZE:(j+1)*TILE_SIZE] = children[i][j]
+    blocks = mosaic.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 4)
+    alpha = blocks[..., 3].sum(axis=(1, 3))
+    rgb = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rgb = np.where(alpha[..., None] > 0, rgb / alpha[..., None], 0)
+    tile = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    tile[..., :3] = np.round(rgb)
+    tile[..., 3] = np.round(alpha / 4.)
+    return tile
+
+
+def _write_tile(layer, zoom, tx, ty, tile):
+    if not tile[..., 3].any(): return 0
+    path = tile_path(layer['output_dir'], zoom, tx, ty)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_png(path, tile)
+    return 1
+
+
+def render_base_tiles(zoom, tiles):
+    """Render TMS tiles [(tx, ty)] of zoom for all layers. Returns the number of tiles written."""
+
+    count = 0
+    for tx, ty in tiles:
+        samples = {}
+        for layer in _PYRAMID['layers']:
+            band = layer['band']
+            if band not in samples:
+                samples[band] = base_tile(_PYRAMID['bands'][band], _PYRAMID['geotrans'], zoom, tx, ty)
+            data, inside = samples[band]
+            tile = colorize(data, layer['cmap'], layer['clim_min'], layer['clim_max'], layer['nodata'])
+            tile[~inside] = 0
+            count += _write_tile(layer, zoom, tx, ty, tile)
+    return count
+
+
+def render_overview_tiles(zoom, tiles):
+    """Make TMS tiles [(tx, ty)] of zoom from their children at zoom+1 for all layers."""
+
+    count = 0
+    for tx, ty in tiles:
+        for layer in _PYRAMID['layers']:
+            children = [[None, None], [None, None]]
+            for i, cy in enumerate((2 * ty + 1, 2 * ty)):
+                for j, cx in enumerate((2 * tx, 2 * tx + 1)):
+                    path = tile_path(layer['output_dir'], zoom + 1, cx, cy)
+                    if os.path.exists(path): children[i][j] = read_png(path)
+            if any(c is not None for row in children for c in row):
+                count += _write_tile(layer, zoom, tx, ty, downsample_tile(children))
+    return count
+
+
+def _render_chunk(args):
+    func, zoom, tiles = args
+    return func(zoom, tiles)
 
-def create_tiles(raster, output_dir, band=1, cmap='jet', clim_min=None,
-                 clim_max=None, clim_min_pct=None, clim_max_pct=None,
-                 zoom=[0, 8], nodata=None):
-    """Generate map tiles following the OSGeo Tile Map Service Specification."""
+
+def base_tile_range(geotrans, width, length, zoom):
+    """TMS tiles of zoom covering the raster."""
+
+    lon0, lon1 = geotrans[0], geotrans[0] + geotrans[1] * width
+    lat0, lat1 = geotrans[3], geotrans[3] + geotrans[5] * length
+    n = 2 ** zoom
+    x = lon_to_px([min(lon0, lon1), max(lon0, lon1)], zoom) / TILE_SIZE
+    y = lat_to_py([max(lat0, lat1), min(lat0, lat1)], zoom) / TILE_SIZE
+    tx = range(max(0, int(x[0])), min(n - 1, int(math.ceil(x[1]) - 1)) + 1)
+    ty = range(max(0, n - int(math.ceil(y[1]))), min(n - 1, n - 1 - int(y[0])) + 1)
+    return [(i, j) for i in tx for j in ty]
+
+
+def resolve_clims(stats, layer):
+    """Set the layer's clim_min/clim_max from the given values or from percentiles of stats (a HistogramSketch)."""
 
     # check mutually exclusive args
-    if clim_min is not None and clim_min_pct is not None:
+    if layer.get('clim_min') is not None and layer.get('clim_min_pct') is not None:
         raise(RuntimeError("Cannot specify both clim_min and clim_min_pct."))
-    if clim_max is not None and clim_max_pct is not None:
+    if layer.get('clim_max') is not None and layer.get('clim_max_pct') is not None:
         raise(RuntimeError("Cannot specify both clim_max and clim_max_pct."))
 
     # get clim
-    min, max, min_pct, max_pct = get_clims(raster, band,
-                                           clim_min_pct if clim_min_pct is not None else 20,
-                                           clim_max_pct if clim_min_pct is not None else 80)
+    min_pct = layer.get('clim_min_pct')
+    max_pct = layer.get('clim_max_pct')
+    min, max, min_pct, max_pct = stats.clims(min_pct if min_pct is not None else 20,
+                                             max_pct if max_pct is not None else 80)
 
     # overwrite if options not specified
-    if clim_min is not None: min = clim_min
-    if clim_max is not None: max = clim_max
-    if clim_min_pct is not None: min = min_pct
-    if clim_max_pct is not None: max = max_pct
-
-    # convert to geotiff
-    logger.info("Generating GeoTIFF.")
-    tif_file = "{}.tif".format(os.path.basename(raster))
-    if os.path.exists(tif_file): os.unlink(tif_file)
-    cmd = "isce2geotiff.py -i {} -o {} -c {:f} {:f} -b {} -m {}"
-    check_call(cmd.format(raster, tif_file, min, max, band-1, cmap), shell=True)
-
-    # create tiles from geotiff
-    logger.info("Generating tiles.")
-    zoom_i = zoom[0]
-    zoom_f = zoom[1]
-    while zoom_f > zoom_i:
-        try:
-            if nodata is None:
-                cmd = "gdal2tiles.py -z {}-{} -p mercator {} {}".format(zoom_i, zoom_f, tif_file, output_dir)
-            else:
-                cmd = "gdal2tiles.py -z {}-{} -p mercator -a {} {} {}".format(zoom_i, zoom_f, nodata, tif_file, output_dir)
-            logger.info("cmd: %s" % cmd)
-            check_call(cmd, shell=True)
-            break
-        except Exception as e:
-            logger.warn("Got exception running {}: {}".format(cmd, str(e)))
-            logger.warn("Traceback: {}".format(traceback.format_exc()))
-            zoom_f -= 1
-
-    # remove geotiff
-    os.unlink(tif_file)
+    if layer.get('clim_min') is not None: min = layer['clim_min']
+    if layer.get('clim_max') is not None: max = layer['clim_max']
+    if layer.get('clim_min_pct') is not None: min = min_pct
+    if layer.get('clim_max_pct') is not None: max = max_pct
+    layer['clim_min'] = 0. if min is None else float(min)
+    layer['clim_max'] = 1. if max is None else float(max)
+    logger.info("{} clims: {} {}".format(layer['output_dir'], layer['clim_min'], layer['clim_max']))
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("raster", help="input raster file (any GDAL-recognized file format)")
-    parser.add_argument("output_dir", help="output directory")
+def write_tilemapresource(output_dir, zoom):
+    """tilemapresource.xml of a mercator TMS layer as written by gdal2tiles."""
+
+    half = math.pi * 6378137.
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<TileMap version="1.0.0" tilemapservice="http://tms.osgeo.org/1.0.0">',
+             '  <Title>{}</Title>'.format(os.path.basename(os.path.normpath(output_dir))),
+             '  <Abstract></Abstract>',
+             '  <SRS>EPSG:3857</SRS>',
+             '  <BoundingBox minx="{0:.14f}" miny="{0:.14f}" maxx="{1:.14f}" maxy="{1:.14f}"/>'.format(-half, half),
+             '  <Origin x="{0:.14f}" y="{0:.14f}"/>'.format(-half),
+             '  <TileFormat width="{0}" height="{0}" mime-type="image/png" extension="png"/>'.format(TILE_SIZE),
+             '  <TileSets profile="mercator">']
+    for z in range(zoom[0], zoom[1] + 1):
+        lines.append('    <TileSet href="{0}" units-per-pixel="{1:.14f}" order="{0}"/>'.format(
+                     z, 2 * half / tile_pixels(z)))
+    lines += ['  </TileSets>', '</TileMap>']
+    with open(os.path.join(output_dir, 'tilemapresource.xml'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def tile_pyramid(bands, geotrans, layers, zoom=[0, 8], nproc=None):
+    """
+    Write the tiles of the layers (dicts with output_dir, band, cmap, clim_min,
+    clim_max and nodata) from zoom[1] down to zoom[0]. bands maps band numbers to
+    arrays with the geotransform geotrans. Returns the number of tiles written.
+    """
+
+    nproc = nproc or mp.cpu_count()
+    length, width = next(iter(bands.values())).shape
+    _PYRAMID.update(bands=bands, geotrans=geotrans, layers=layers)
+    pool = mp.get_context('fork').Pool(nproc) if nproc > 1 else None
+    try:
+        count = 0
+        tiles = base_tile_range(geotrans, width, length, zoom[1])
+        for z in range(zoom[1], zoom[0] - 1, -1):
+            func = render_base_tiles if z == zoom[1] else render_overview_tiles
+            chunks = [(func, z, tiles[i::nproc * 4]) for i in range(min(len(tiles), nproc * 4))]
+            written = sum(pool.map(_render_chunk, chunks) if pool else map(_render_chunk, chunks))
+            logger.info("Zoom {}: {} tiles written for {} layers.".format(z, written, len(layers)))
+            count += written
+            tiles = sorted(set((tx // 2, ty // 2) for tx, ty in tiles))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _PYRAMID.clear()
+
+    for layer in layers:
+        if not os.path.isdir(layer['output_dir']): os.makedirs(layer['output_dir'])
+        write_tilemapresource(layer['output_dir'], zoom)
+    return count
+
+
+def read_bands(raster, bands, zoom, nodata=None, strip_rows=1024):
+    """
+    Read bands of a GDAL raster in one pass of strips, block averaged (ignoring
+    nodata) to about the resolution of zoom. The full resolution strips are also
+    added to a HistogramSketch of each band for the color limits.
+    Returns ({band: array}, geotransform, {band: HistogramSketch}).
+    """
+
+    from osgeo import gdal
+    gdal.UseExceptions()
+
+    ds = gdal.Open(raster)
+    gt = ds.GetGeoTransform()
+    width, length = ds.RasterXSize, ds.RasterYSize
+
+    # averaging factor such that raster pixels stay smaller than tile pixels
+    lat = min(max(abs(gt[3]), abs(gt[3] + gt[5] * length)), MAX_LAT)
+    res = 360. / tile_pixels(zoom)
+    factor = max(1, int(min(res / abs(gt[1]), res * math.cos(math.radians(lat)) / abs(gt[5]))))
+    strip_rows = -(-strip_rows // factor) * factor
+    logger.info("Reading bands {} averaged by {}.".format(list(bands), factor))
+
+    band_nodata = dict((b, nodata.get(b) if isinstance(nodata, dict) else nodata) for b in bands)
+    stats = dict((b, HistogramSketch(nodata=band_nodata[b])) for b in bands)
+    strips = dict((b, []) for b in bands)
+    for r0, blocks in iter_blocks(ds, bands, strip_rows):
+        for b, data in zip(bands, blocks):
+            stats[b].update(data)
+            strips[b].append(average_levels(data, (factor,), band_nodata[b])[0] if factor > 1 else data)
+    out = dict((b, np.concatenate(strips[b])) for b in bands)
+    ds = None
+
+    return out, (gt[0], gt[1] * factor, 0., gt[3], 0., gt[5] * factor), stats
+
+
+def create_layers(raster, layers, zoom=[0, 8], nproc=None):
+    """Generate the tiles of several layers from a single read of the raster."""
+
+    nodata = {}
+    for layer in layers:
+        nodata.setdefault(layer['band'], layer.get('nodata'))
+    bands, geotrans, stats = read_bands(raster, sorted(nodata), zoom[1], nodata)
+    for layer in layers:
+        resolve_clims(stats[layer['band']], layer)
+    return tile_pyramid(bands, geotrans, layers, zoom, nproc)
+
+
+def create_tiles(raster, output_dir, band=1, cmap='jet', clim_min=None,
+                 clim_max=None, clim_min_pct=None, clim_max_pct=None,
+                 zoom=[0, 8], nodata=None, nproc=None):
+    """Generate map tiles following the OSGeo Tile Map Service Specification."""
+
+    layer = dict(output_dir=output_dir, band=band, cmap=cmap, clim_min=clim_min, clim_max=clim_max,
+                 clim_min_pct=clim_min_pct, clim_max_pct=clim_max_pct, nodata=nodata)
+    return create_layers(raster, [layer], zoom, nproc)
+
+
+def layer_parser():
+    parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("-b", "--band", dest="band", type=int,
                         default=1, help="raster band")
-    parser.add_argument("-m", "--cmap", dest="cmap", type=str, 
+    parser.add_argument("-m", "--cmap", dest="cmap", type=str,
                         default='jet', help="matplotlib colormap")
-    parser.add_argument("--clim_min", dest="clim_min", type=float, 
+    parser.add_argument("--clim_min", dest="clim_min", type=float,
                         default=None, help="color limit min value")
     parser.add_argument("--clim_max", dest="clim_max", type=float,
                         default=None, help="color limit max value")
@@ -94,11 +334,33 @@ if __name__ == '__main__':
                         default=None, help="color limit min percent")
     parser.add_argument("--clim_max_pct", dest="clim_max_pct", type=float,
                         default=None, help="color limit max percent")
-    parser.add_argument("-z", "--zoom", dest='zoom', type=int, nargs=2,
-                        default=[0, 8], help='zoom level range to create tiles for')
     parser.add_argument("--nodata", dest="nodata", type=float,
                         default=None, help="nodata value")
+    return parser
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, parents=[layer_parser()])
+    parser.add_argument("raster", help="input raster file (any GDAL-recognized file format)")
+    parser.add_argument("output_dir", help="output directory")
+    parser.add_argument("-z", "--zoom", dest='zoom', type=int, nargs=2,
+                        default=[0, 8], help='zoom level range to create tiles for')
+    parser.add_argument("-l", "--layer", dest="layers", nargs=2, action='append',
+                        metavar=('NAME', 'OPTIONS'), default=None,
+                        help="tile layer NAME under output_dir with the quoted band/cmap/clim/nodata " +
+                             "OPTIONS instead of the options above, e.g. -l amplitude \"-b 1 -m gray\"; " +
+                             "can be repeated to tile several layers from one read of the raster")
+    parser.add_argument("-p", "--nproc", dest="nproc", type=int,
+                        default=None, help="number of processes writing tiles (default: number of CPUs)")
     args = parser.parse_args()
-    status = create_tiles(args.raster, args.output_dir, args.band, args.cmap,
-                          args.clim_min, args.clim_max, args.clim_min_pct,
-                          args.clim_max_pct, args.zoom, args.nodata)
+    if args.layers:
+        layers = []
+        for name, opts in args.layers:
+            layer = vars(layer_parser().parse_args(shlex.split(opts)))
+            layer['output_dir'] = os.path.join(args.output_dir, name)
+            layers.append(layer)
+        status = create_layers(args.raster, layers, args.zoom, args.nproc)
+    else:
+        status = create_tiles(args.raster, args.output_dir, args.band, args.cmap,
+                              args.clim_min, args.clim_max, args.clim_min_pct,
+                              args.clim_max_pct, args.zoom, args.nodata, args.nproc)
@@ -2,14 +2,14 @@
 """
 Return absolute min, absolute max, min percentile, and max percentile
 values of data in a raster band.
+
+The band is read in blocks of rows and the percentiles are approximated
+with a streaming histogram, so the raster is never loaded or sorted as a
+whole. The approximation error is bounded by the histogram bin width (see
+HistogramSketch.error).
 """
 import os, sys, argparse, logging, traceback
 import numpy as np
-from osgeo import gdal
-from gdalconst import GA_ReadOnly
-
-
-gdal.UseExceptions() # make GDAL raise python exceptions
 
 
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
@@ -17,32 +17,125 @@ logging.basicConfig(format=log_format, level=logging.INFO)
 logger = logging.getLogger('get_clims')
 
 
-def get_clims(raster, band, clim_min_pct=None, clim_max_pct=None):
+class HistogramSketch(object):
+    """
+    Streaming histogram of the valid (finite and not nodata) values of blocks
+    of data, for approximate percentiles. The histogram has a fixed number of
+    bins and doubles its range, merging pairs of bins, whenever a block falls
+    outside of it, so the bin width stays within four times the data range
+    divided by the number of bins. Percentiles are within one bin width (error) of the
+    exact numpy percentiles (linear interpolation).
+    """
+
+    def __init__(self, bins=2**16, nodata=None):
+        self.bins = bins + bins % 2
+        self.nodata = nodata
+        self.counts = None
+        self.lo = None
+        self.width = None
+        self.min = None
+        self.max = None
+        self.count = 0
+
+    @property
+    def error(self):
+        return self.width if self.width is not None else 0.
+
+    def _grow(self, vmin, vmax):
+        """Double the range of the histogram until it contains [vmin, vmax]."""
+
+        while vmin < self.lo or vmax >= self.lo + self.width * self.bins:
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts = np.zeros_like(self.counts)
+            if vmin < self.lo:
+                self.counts[self.bins // 2:] = merged
+                self.lo -= self.width * self.bins
+            else:
+                self.counts[:self.bins // 2] = merged
+            self.width *= 2
+
+    def update(self, data):
+        """Add the valid values of a block of data."""
+
+        d = np.asarray(data, dtype=np.float64).ravel()
+        valid = np.isfinite(d)
+        if self.nodata is not None: valid &= (d != self.nodata)
+        d = d[valid]
+        if d.size == 0: return self
+        vmin, vmax = d.min(), d.max()
+
+        if self.counts is None:
+            self.counts = np.zeros(self.bins, dtype=np.int64)
+            self.lo = vmin
+            self.width = (vmax - vmin) / (self.bins - 1) if vmax > vmin else max(abs(vmin), 1.) * 2.**-40
+        else:
+            self._grow(vmin, vmax)
+
+        idx = np.clip(np.floor((d - self.lo) / self.width).astype(np.int64), 0, self.bins - 1)
+        self.counts += np.bincount(idx, minlength=self.bins)
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+        self.count += d.size
+        return self
+
+    def _value(self, cum, rank):
+        """Approximate value of the sorted data at integer rank, spread uniformly in its bin."""
+
+        b = np.searchsorted(cum, rank, side='right')
+        before = cum[b - 1] if b > 0 else 0
+        value = self.lo + self.width * (b + (rank - before + 0.5) / self.counts[b])
+        return min(max(value, self.min), self.max)
+
+    def percentile(self, q):
+        """Approximate q-th percentile, None if there is no valid data."""
+
+        if self.count == 0: return None
+        cum = np.cumsum(self.counts)
+        rank = (self.count - 1) * q / 100.
+        r0 = int(np.floor(rank))
+        r1 = min(r0 + 1, self.count - 1)
+        v0 = self._value(cum, r0)
+        v1 = self._value(cum, r1)
+        return v0 + (rank - r0) * (v1 - v0)
+
+    def clims(self, clim_min_pct=None, clim_max_pct=None):
+        """Absolute min/max and approximate min/max percentile values."""
+
+        return (self.min, self.max,
+                self.percentile(clim_min_pct) if clim_min_pct is not None else None,
+                self.percentile(clim_max_pct) if clim_max_pct is not None else None)
+
+
+def iter_blocks(ds, bands, block_rows=1024):
+    """Yield (first row, [arrays of bands]) for blocks of rows of a GDAL dataset."""
+
+    width, length = ds.RasterXSize, ds.RasterYSize
+    for r0 in range(0, length, block_rows):
+        nrows = min(block_rows, length - r0)
+        yield r0, [ds.GetRasterBand(b).ReadAsArray(0, r0, width, nrows) for b in bands]
+
+
+def get_clims(raster, band, clim_min_pct=None, clim_max_pct=None, nodata=None, block_rows=1024):
     """Get data absolute min/max values as well as min/max percentile values
        for a given GDAL-recognized file format for a particular band."""
 
+    from osgeo import gdal
+    from gdalconst import GA_ReadOnly
+    gdal.UseExceptions() # make GDAL raise python exceptions
+
     # load raster
     gd = gdal.Open(raster, GA_ReadOnly)
 
-    # get number of bands
-    bands = gd.RasterCount
-
-    # process the raster
-    b = gd.GetRasterBand(band)
-    d = b.ReadAsArray()
-    logger.info("band data: {}".format(d))
-    # fetch max and min
-    #min = band.GetMinimum()
-    #max = band.GetMaximum()
-    min = np.amin(d)
-    max = np.amax(d)
-    min_pct = np.percentile(d, clim_min_pct) if clim_min_pct is not None else None
-    max_pct = np.percentile(d, clim_max_pct) if clim_max_pct is not None else None
+    # process the raster in blocks of rows
+    sketch = HistogramSketch(nodata=nodata)
+    for r0, (d,) in iter_blocks(gd, [band], block_rows):
+        sketch.update(d)
+    min, max, min_pct, max_pct = sketch.clims(clim_min_pct, clim_max_pct)
     
     logger.info("band {} absolute min/max: {} {}".format(band, min, max))
-    logger.info("band {} {}/{} percentiles: {} {}".format(band, clim_min_pct,
-                                                          clim_max_pct, min_pct,
-                                                          max_pct))
+    logger.info("band {} {}/{} percentiles: {} {} (+/- {})".format(band, clim_min_pct,
+                                                                   clim_max_pct, min_pct,
+                                                                   max_pct, sketch.error))
     gd = None
 
     return min, max, min_pct, max_pct
@@ -57,6 +150,8 @@ if __name__ == "__main__":
                         default=20, help="color limit min percent")
     parser.add_argument("--clim_max_pct", dest="clim_max_pct", type=float,
                         default=80, help="color limit max percent")
+    parser.add_argument("--nodata", dest="nodata", type=float, default=None,
+                        help="nodata value")
     args = parser.parse_args()
     min, max, min_pct, max_pct = get_clims(args.raster, args.band,
-                                           args.clim_min_pct, args.clim_max_pct)
+                                           args.clim_min_pct, args.clim_max_pct, args.nodata)
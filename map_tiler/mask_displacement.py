@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 """
 Mask displacement values where amplitude is less than some threshold.
+
+The raster is masked in windows of rows, and the statistics of the masked
+displacement (for color limits) are gathered in the same read.
 """
 import os, sys, argparse, logging, traceback
 import numpy as np
 from osgeo import gdal, ogr, osr
 from gdalconst import GA_ReadOnly
 
+from get_clims import HistogramSketch, iter_blocks
+
 
 gdal.UseExceptions()
 
@@ -16,37 +21,36 @@ logging.basicConfig(format=log_format, level=logging.INFO)
 logger = logging.getLogger('mask_displacement')
 
 
-def translate(in_file, out_file, amp_threshold=300, no_data_value=0.):
-    """Use amplitude to mask displacement."""
+def translate(in_file, out_file, amp_threshold=300, no_data_value=0., block_rows=1024, stats=None):
+    """Use amplitude to mask displacement. The masked displacement is added to
+       stats (a HistogramSketch, created if None), which is returned."""
 
-    # read in raster bands
+    # open raster bands
     in_ds = gdal.Open(in_file, GA_ReadOnly)
     gt = in_ds.GetGeoTransform()
     cols = in_ds.RasterXSize
     rows = in_ds.RasterYSize
-    amp_band = in_ds.GetRasterBand(1)
-    #print("amp_band no data value: {}".format(amp_band.GetNoDataValue()))
-    amp = amp_band.ReadAsArray()
-    dis_band = in_ds.GetRasterBand(2)
-    #print("dis_band no data value: {}".format(dis_band.GetNoDataValue()))
-    dis = dis_band.ReadAsArray()
-    #print("col: {}, row: {}, amp: {}, dis: {}".format(1488, 2832, amp[1488,2832], dis[1488,2832]))
-
-    # create masked array
-    dis_masked = np.ma.masked_array(dis, amp < amp_threshold)
 
     # create output raster
     out_ds = gdal.GetDriverByName('GTiff').Create(out_file, cols, rows, 1, gdal.GDT_Float32)
     out_ds.SetGeoTransform(gt)
     dis_band_out = out_ds.GetRasterBand(1)
     dis_band_out.SetNoDataValue(no_data_value)
-    dis_band_out.WriteArray(dis_masked.filled(no_data_value))
     out_srs = osr.SpatialReference()
     out_srs.ImportFromWkt(in_ds.GetProjectionRef())
     out_ds.SetProjection(out_srs.ExportToWkt())
+
+    # mask displacement (band 2) with amplitude (band 1) in windows of rows
+    if stats is None: stats = HistogramSketch(nodata=no_data_value)
+    for r0, (amp, dis) in iter_blocks(in_ds, [1, 2], block_rows):
+        dis_masked = np.ma.masked_array(dis, amp < amp_threshold).filled(no_data_value)
+        dis_band_out.WriteArray(dis_masked, 0, r0)
+        stats.update(dis_masked)
+
     dis_band_out.FlushCache()
     in_ds = None
     out_ds = None 
+    return stats
 
 
 if __name__ == "__main__":
@@ -57,5 +61,10 @@ if __name__ == "__main__":
                         type=int, default=300, help="amplitude threshold")
     parser.add_argument("-n", "--no_data_value", dest="no_data_value",
                         type=int, default=0, help="no data value")
+    parser.add_argument("--block_rows", dest="block_rows",
+                        type=int, default=1024, help="rows masked at a time")
     args = parser.parse_args()
-    translate(args.in_file, args.out_file, args.amp_threshold, args.no_data_value)
+    stats = translate(args.in_file, args.out_file, args.amp_threshold, args.no_data_value,
+                      args.block_rows)
+    logger.info("masked displacement min/max/20%/80%: {} {} {} {} (+/- {})".format(
+                *(stats.clims(20, 80) + (stats.error,))))
@@ -1,22 +1,92 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+import os
 import numpy as np
 from datetime import datetime as DT
-import requests
 import ast
 import sys
-import pyproj
 from collections import OrderedDict
 
-errorCodes ={ 
-              'GPS data unavailable:', 10,
-              'Not enough stations: ', 20
+errorCodes ={
+              'GPS data unavailable:' : 10,
+              'Not enough stations: ' : 20,
+              'GPS Data Error' : 40,
             }
 
 gpsSources = ['measures_comb', 'jpl_ats']
 
-WGS84llh = pyproj.Proj(proj='latlong', ellps='WGS84', datum='WGS84')
-WGS84xyz = pyproj.Proj(proj='geocent', ellps='WGS84', datum='WGS84')
+####WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1.0 / 298.257223563
+WGS84_E2 = WGS84_F * (2.0 - WGS84_F)
+
+
+def llh2xyz(lon, lat, hgt):
+    '''
+    Geodetic lon, lat (deg) and height to ECEF XYZ. Works on arrays.
+    '''
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    N = WGS84_A / np.sqrt(1.0 - WGS84_E2 * np.sin(lat)**2)
+    x = (N + hgt) * np.cos(lat) * np.cos(lon)
+    y = (N + hgt) * np.cos(lat) * np.sin(lon)
+    z = (N * (1.0 - WGS84_E2) + hgt) * np.sin(lat)
+    return x, y, z
+
+
+def xyz2llh(x, y, z, niter=5):
+    '''
+    ECEF XYZ to geodetic lon, lat (deg) and height. Works on arrays.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    p = np.hypot(x, y)
+    lon = np.arctan2(y, x)
+    lat = np.arctan2(z, p * (1.0 - WGS84_E2))
+    for ii in range(niter):
+        N = WGS84_A / np.sqrt(1.0 - WGS84_E2 * np.sin(lat)**2)
+        hgt = p / np.cos(lat) - N
+        lat = np.arctan2(z, p * (1.0 - WGS84_E2 * N / (N + hgt)))
+    N = WGS84_A / np.sqrt(1.0 - WGS84_E2 * np.sin(lat)**2)
+    hgt = p / np.cos(lat) - N
+    return np.degrees(lon), np.degrees(lat), hgt
+
+
+def enuTransform(x, y, z):
+    '''
+    Rotation matrices from ECEF to local east, north, up at points x, y, z.
+    Returns an array of shape (..., 3, 3) with rows east, north and up.
+    '''
+    lon, lat, hgt = xyz2llh(x, y, z)
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    slat, clat = np.sin(lat), np.cos(lat)
+    slon, clon = np.sin(lon), np.cos(lon)
+    zero = np.zeros_like(lat)
+    Tmat = np.stack([np.stack([-slon, clon, zero], axis=-1),
+                     np.stack([-slat*clon, -slat*slon, clat], axis=-1),
+                     np.stack([clat*clon, clat*slon, slat], axis=-1)], axis=-2)
+    return Tmat
+
+
+def batchENU(refXYZ, refSig, xyz, sig):
+    '''
+    ENU vectors and errors from reference positions to positions for all
+    stations and epochs in one call.
+
+    refXYZ, refSig : (nstn, 3) reference positions and sigmas
+    xyz, sig       : (..., nstn, 3) positions and sigmas, e.g. (ndates, nstn, 3)
+
+    Errors assume diagonal covariances in XYZ as in GPS.toENU.
+    '''
+    refXYZ = np.asarray(refXYZ, dtype=np.float64)
+    Tmat = enuTransform(refXYZ[...,0], refXYZ[...,1], refXYZ[...,2])
+    enu = np.einsum('nij,...nj->...ni', Tmat, np.asarray(xyz) - refXYZ)
+    differr = np.asarray(sig)**2 + np.asarray(refSig)**2
+    err = np.sqrt(np.einsum('nij,...nj->...ni', Tmat**2, differr))
+    return enu, err
 
 
 class GPS(object):
@@ -36,73 +106,49 @@ class GPS(object):
 
         for (key, value) in zip(fields, values):
             if key:
-                key1 = key.encode('ascii', 'ignore')
-                val1 = value.encode('ascii', 'ignore')
+                val1 = value.strip()
                 try:
                     val1 = ast.literal_eval(val1)
                 except:
                     pass
 
-                setattr(self, key1.split()[0], val1)
+                setattr(self, str(key.split()[0]), val1)
 
         self.localTransform = None
         self.refError = None
         return
 
+    @property
+    def xyz(self):
+        return np.array([self.x, self.y, self.z])
+
+    @property
+    def sig(self):
+        return np.array([self.x_sig, self.y_sig, self.z_sig])
+
     def verify(self):
         '''
         Verify if the XYZ to LLH data in the results are consistent.
         '''
 
-        res = pyproj.transform(WGS84xyz, WGS84llh, self.x, self.y, self.z)
+        res = xyz2llh(self.x, self.y, self.z)
 
-        print 'Listed: ', self.wgsLon, self.wgsLat, self.wgsHt
-        print 'Estimated: ', res[0], res[1], res[2]
-        print 'Error: ', self.wgsLon - res[0], self.wgsLat-res[1], self.wgsHt - res[2]
+        print('Listed: ', self.wgsLon, self.wgsLat, self.wgsHt)
+        print('Estimated: ', res[0], res[1], res[2])
+        print('Error: ', self.wgsLon - res[0], self.wgsLat-res[1], self.wgsHt - res[2])
 
     def setupLocalCoordinates(self):
         '''
         Sets up the local coordinate system around given point.
-        Adopted from metpy toolbox.
         '''
 
-        ###Local center in XYZ
-        localCenter = np.array([self.x, self.y, self.z])
-        llh = np.array(pyproj.transform(WGS84xyz, WGS84llh, self.x, self.y, self.z))    
-
-        #XYZ coords of point above center
-        aboveCenter = np.array(pyproj.transform(WGS84llh, WGS84xyz, llh[0], llh[1], llh[2]+1.0))
-
-        n = aboveCenter - localCenter
-        n = n/np.linalg.norm(n)
-        localz = n
-
-        #Unit vector projection
-        d = np.dot(n, aboveCenter)
-        P = np.identity(3) - np.transpose(np.vstack((n,n,n))) *np.vstack((n,n,n))
-
-        ###Pick a point directly to the north of the reference location
-        northCenterECEF = np.array(pyproj.transform(WGS84llh, WGS84xyz, llh[0], llh[1]+0.0001, llh[2]))
-        localy = np.dot(P, northCenterECEF)
-        localy = -localy / np.linalg.norm(localy) # negation gets x and y pointing in the right direction
-        
-        #local x is y (cross) z to get an orthogonal system
-        localx = np.transpose(np.cross(localy, localz))
-        localx = localx / np.linalg.norm(localx)
-        
-        
-        Tmat = np.zeros((3,3))
-        Tmat[0,:] = localx
-        Tmat[1,:] = localy
-        Tmat[2,:] = localz
-        #
-        self.localTransform = Tmat
+        self.localTransform = enuTransform(self.x, self.y, self.z)
 
         ####Approximate error in reference position
-        self.refError = np.sqrt(np.diag(np.dot(self.localTransform, np.dot(np.diag([self.x_sig**2, self.y_sig**2, self.z_sig**2]), self.localTransform.T))))
+        self.refError = np.sqrt(np.dot(self.localTransform**2, self.sig**2))
 
         return
-        
+
     def toENU(self, inp):
         '''
         Gives the input vector to point inp from the current point.
@@ -111,73 +157,166 @@ class GPS(object):
         if self.localTransform is None:
             self.setupLocalCoordinates()
 
-        localCenter = np.array([self.x, self.y, self.z])
-        inPoint = np.array([inp.x, inp.y, inp.z])
-        res = np.dot(self.localTransform, inPoint-localCenter)
-
-        ####Approximate error transform
-        ####Assuming diag covariance to diag covariance
-
-        differr = np.array([inp.x_sig**2 + self.x_sig**2 , inp.y_sig**2 + self.y_sig**2, inp.z_sig**2 + self.z_sig**2])
-        err = np.dot(self.localTransform, np.diag(differr))
-        err = np.sqrt(np.diag(np.dot(err, self.localTransform.T)))
-        return res,err
+        enu, err = batchENU(self.xyz[None,:], self.sig[None,:], inp.xyz[None,:], inp.sig[None,:])
+        return enu[0], err[0]
 
     def __str__(self):
         '''
         Print the given station information.
         '''
 
-        import pprint 
+        import pprint
         return pprint.pformat(self.__dict__, indent=4)
 
 
+#######Fetchers return the raw GPS service response for a date, box and source
+class UCSDFetcher(object):
+    '''
+    Fetch GPS positions from the UCSD web service.
+    '''
+    base_url = 'http://geoapp02.ucsd.edu:8080/gpseDB/coord?op=getXYZ'
+
+    def __call__(self, datestr, snwe, source):
+        import requests
+
+        fields=OrderedDict()
+        fields['date']=datestr
+        fields['fil'] = 'flt'
+        fields['minLat'] = snwe[0]
+        fields['maxLat'] = snwe[1]
+        fields['minLon'] = snwe[2]
+        if fields['minLon'] < 0:
+            fields['minLon'] += 360.0
+
+        fields['maxLon'] = snwe[3]
+        if fields['maxLon'] < 0:
+            fields['maxLon'] += 360.0
+
+        fields['source'] = source
+
+        final_url=''+self.base_url
+        for key,val in fields.items():
+            final_url += '&{0}={1}'.format(key,val)
+
+        req = requests.get(final_url, verify=False)
+        req.raise_for_status()
+        return req.text
 
-def getGPSinBox(yyyymmdd, snwe, source='jpl_ats'):
+
+class LocalFileFetcher(object):
+    '''
+    Read GPS service responses saved as {source}_{yyyy-mm-dd}.txt in a directory.
+    The box is applied to the stations read.
+    '''
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def __call__(self, datestr, snwe, source):
+        fname = os.path.join(self.dirname, '{0}_{1}.txt'.format(source, datestr))
+        if not os.path.exists(fname):
+            raise IOError('No local GPS data for {0}: {1}'.format(datestr, fname))
+
+        with open(fname, 'r') as fid:
+            strings = fid.read().split('\n')
+
+        out = strings[:2]
+        for string in strings[2:-1]:
+            stn = GPS(string, strings[1])
+            lon = stn.wgsLon - 360.0 if stn.wgsLon > 180.0 else stn.wgsLon
+            west = snwe[2] - 360.0 if snwe[2] > 180.0 else snwe[2]
+            east = snwe[3] - 360.0 if snwe[3] > 180.0 else snwe[3]
+            if (snwe[0] <= stn.wgsLat <= snwe[1]) and (west <= lon <= east):
+                out.append(string)
+        out.append('')
+        return '\n'.join(out)
+
+
+class GPSCache(object):
+    '''
+    On disk cache of GPS service responses keyed by date, box and source.
+    Only cache misses go to the fetcher.
+    '''
+    def __init__(self, dirname='GPScache', fetcher=None):
+        self.dirname = dirname
+        self.fetcher = UCSDFetcher() if fetcher is None else fetcher
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def key(self, datestr, snwe, source):
+        box = '_'.join(['{0:.4f}'.format(float(v)) for v in snwe])
+        return os.path.join(self.dirname, '{0}_{1}_{2}.txt'.format(source, datestr, box))
+
+    def __call__(self, datestr, snwe, source):
+        fname = self.key(datestr, snwe, source)
+        if os.path.exists(fname):
+            with open(fname, 'r') as fid:
+                return fid.read()
+
+        text = self.fetcher(datestr, snwe, source)
+        with open(fname + '.tmp', 'w') as fid:
+            fid.write(text)
+        os.rename(fname + '.tmp', fname)
+        return text
+
+
+def parseGPSResponse(text):
+    '''
+    Parse a GPS service response into a dictionary of GPS objects by site.
+    '''
+    strings = text.split('\n')
+    sourcestr = strings[0]
+    formatstr = strings[1]
+
+    gpsStns = OrderedDict()
+    for string in strings[2:-1]:
+        newStn = GPS(string, formatstr, source=sourcestr)
+        gpsStns[newStn.site] = newStn
+
+    return gpsStns
+
+
+def getGPSinBox(yyyymmdd, snwe, source='jpl_ats', fetcher=None):
     '''
-    Download GPS data corresponding to given date from UCSD web service.
+    Get GPS data corresponding to given date. Uses the UCSD web service unless
+    a fetcher (e.g. a GPSCache or LocalFileFetcher) is given.
     '''
 
     if source.lower() not in gpsSources:
         raise Exception('Unknown GPS data source: %s'%(source))
 
-    base_url = 'http://geoapp02.ucsd.edu:8080/gpseDB/coord?op=getXYZ'
     if isinstance(yyyymmdd,str):
         datestr = DT.strptime(yyyymmdd,'%Y%m%d').strftime('%Y-%m-%d')
     else:
         datestr = yyyymmdd.strftime('%Y-%m-%d')
 
-    fields={}
-    fields['date']=datestr
-    fields['fil'] = 'flt'
-    fields['minLat'] = snwe[0]
-    fields['maxLat'] = snwe[1]
-    fields['minLon'] = snwe[2]
-    if fields['minLon'] < 0:
-        fields['minLon'] += 360.0
+    if fetcher is None:
+        fetcher = UCSDFetcher()
 
-    fields['maxLon'] = snwe[3]
-    if fields['maxLon'] < 0:
-        fields['maxLon'] += 360.0
+    return parseGPSResponse(fetcher(datestr, snwe, source))
 
-    fields['source'] = source
 
-    final_url=''+base_url
-    for key,val in fields.iteritems():
-        final_url += '&{0}={1}'.format(key,val)
+def getGPSTimeSeries(dates, snwe, source='jpl_ats', fetcher=None, sites=None):
+    '''
+    Get GPS positions of all stations for all dates as arrays.
 
-    req = requests.get(final_url, verify=False)
-    req.raise_for_status()
-    strings = req.text.split('\n')
-    sourcestr = strings[0]
-    formatstr = strings[1]
+    Returns sites, stations of the first date, xyz and sig arrays of shape
+    (ndates, nsites, 3) with NaN where a station has no data on a date.
+    sites defaults to the stations available on the first date.
+    '''
+    daily = [getGPSinBox(date, snwe, source, fetcher) for date in dates]
+    if sites is None:
+        sites = list(daily[0].keys())
 
-    gpsStns = {}
-    for string in strings[2:-1]:
-        newStn = GPS(string, formatstr, source=sourcestr)
-        gpsStns[newStn.site] = newStn
+    xyz = np.full((len(dates), len(sites), 3), np.nan)
+    sig = np.full((len(dates), len(sites), 3), np.nan)
+    for ii, stns in enumerate(daily):
+        for jj, site in enumerate(sites):
+            if site in stns:
+                xyz[ii,jj] = stns[site].xyz
+                sig[ii,jj] = stns[site].sig
+
+    return sites, daily[0], xyz, sig
 
-    return gpsStns
 
 class GPSstn(object):
     '''
@@ -208,7 +347,7 @@ class GPSstn(object):
         try:
             pos = self.dates[date][0]
         except:
-            print 'No GPS data for day %s and station %s'%(date, self.name)
+            print('No GPS data for day %s and station %s'%(date, self.name))
             sys.exit(errorCodes['GPS Data Error'])
 
         return pos
@@ -220,7 +359,7 @@ class GPSstn(object):
         try:
             pos = self.dates[date][1]
         except:
-            print 'No GPS data for day %s and station %s'%(date, self.name)
+            print('No GPS data for day %s and station %s'%(date, self.name))
             sys.exit(errorCodes['GPS Data Error'])
 
         return pos
@@ -242,7 +381,7 @@ class GPSstn(object):
         Create a SOPAC style GPS file without model header.
         '''
         with open(fname, 'w') as fid:
-            dateorder = np.sort(self.dates.keys())
+            dateorder = sorted(self.dates.keys())
             for date in dateorder:
                 dateObj = DT.strptime(date, '%Y%m%d')
                 dayYear = dateObj.timetuple().tm_yday
@@ -274,11 +413,11 @@ if __name__ == '__main__':
     '''
     Test driver.
     '''
-    
-    stns = getGPSinBox('20110101',[34.0,35.0,242.0,240.0])
+
+    stns = getGPSinBox('20110101',[34.0,35.0,242.0,240.0], fetcher=GPSCache())
     stn = stns['alpp']
 
-    print 'Reference: ', stn
-    print 'Point :', stns['ana1']
+    print('Reference: ', stn)
+    print('Point :', stns['ana1'])
 
-    print stn.toENU(stns['ana1'])
+    print(stn.toENU(stns['ana1']))
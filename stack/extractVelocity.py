@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
-import isce
-import numpy as np 
+import numpy as np
 import h5py
 import argparse
 import os
+import time
+import tempfile
+import shutil
+import tracemalloc
+import xml.etree.ElementTree as ET
 
 def cmdLineParse():
     '''
@@ -15,15 +19,51 @@ def cmdLineParse():
     parser.add_argument('-i', '--input', dest='h5file', type=str, default='Stack/TS-PARAMS.h5',
             help='Timefn HDF5 file')
     parser.add_argument('-o', '--output', dest='velfile', type=str, default='LOS_velocity.geo')
-    parser.add_argument('-x', '--xml', dest='xmlfile', type=str, required=True,
+    parser.add_argument('-x', '--xml', dest='xmlfile', type=str, default=None,
             help='Example InsarProc.xml file to geocoding information from')
+    parser.add_argument('-t', '--tif', dest='tiffile', type=str, default=None,
+            help='Also write a tiled, compressed GeoTIFF with overviews')
+    parser.add_argument('-e', '--error', dest='errdset', type=str, default=None,
+            help='Dataset with parameter uncertainties to write as a second GeoTIFF band')
+    parser.add_argument('-b', '--block', dest='block', type=int, default=256,
+            help='Number of rows read from the HDF5 file at a time')
+    parser.add_argument('--benchmark', dest='benchmark', type=int, nargs=3, default=None,
+            metavar=('ROWS', 'COLS', 'NPARMS'),
+            help='Benchmark full and streaming extraction on a synthetic cube')
+
+    inps = parser.parse_args()
+    if (inps.benchmark is None) and (inps.xmlfile is None):
+        parser.error('the following arguments are required: -x/--xml')
+    return inps
+
+
+def rowBlocks(length, block):
+    '''
+    Row ranges of blocks of lines.
+    '''
+    for r0 in range(0, length, block):
+        yield r0, min(r0 + block, length)
 
-    return parser.parse_args()
 
+def getVelocity(h5file, outfile, block=256, dset='parms'):
+    '''
+    Extract velocity (or its uncertainty from dset) from h5file. The band is
+    streamed in blocks of rows.
+    '''
+
+    fid = h5py.File(h5file, 'r')
+    parms = fid[dset]
+    shape = parms.shape[:2]
+    with open(outfile, 'wb') as out:
+        for r0, r1 in rowBlocks(shape[0], block):
+            parms[r0:r1,:,1].astype(np.float32).tofile(out)
+    fid.close()
+    return shape
 
-def getVelocity(h5file, outfile):
+
+def getVelocityFull(h5file, outfile):
     '''
-    Extract velocity from h5file.
+    Extract velocity from h5file in one read of the band. Kept for benchmarking.
     '''
 
     fid = h5py.File(h5file, 'r')
@@ -35,10 +75,67 @@ def getVelocity(h5file, outfile):
     return shape
 
 
+def getGeoTransform(xmlfile):
+    '''
+    GDAL geotransform from an ISCE image xml or an insarProc.xml.
+    '''
+    root = ET.parse(xmlfile).getroot()
+
+    if root.tag == 'imageFile':
+        coords = {}
+        for comp in root.findall('component'):
+            cdict = {}
+            for prop in comp.findall('property'):
+                cdict[prop.attrib['name'].lower()] = prop.find('value').text
+            coords[comp.attrib['name'].lower()] = cdict
+
+        return (float(coords['coordinate1']['startingvalue']), float(coords['coordinate1']['delta']), 0.,
+                float(coords['coordinate2']['startingvalue']), 0., float(coords['coordinate2']['delta']))
+
+    ####insarProc.xml. Min and max latitude are swapped by ISCE, see veloLib.getGeoData.
+    out = root.find('runGeocode/outputs')
+    north = float(out.find('MINIMUM_GEO_LATITUDE').text)
+    west = float(out.find('MINIMUM_GEO_LONGITUDE').text)
+    dlat = -abs(float(out.find('LATITUDE_SPACING').text))
+    dlon = float(out.find('LONGITUDE_SPACING').text)
+    return (west, dlon, 0., north, 0., dlat)
+
+
+def writeVelocityTiff(velfile, tiffile, geotrans, shape, h5file=None, errdset=None, block=256,
+                      tile=256, overviews=(2, 4, 8, 16, 32)):
+    '''
+    Write the velocity file written by getVelocity (and optionally the uncertainty
+    band from errdset in h5file) as a cloud optimized, deflate compressed GeoTIFF
+    with overviews (utils.cog). Only the uncertainty band is streamed from the
+    HDF5 file, block rows at a time.
+    '''
+    from utils.cog import raw_vrt, write_cog
+
+    length, width = shape
+    files = [velfile]
+    descriptions = ['LOS velocity in mm/yr']
+
+    tmpdir = tempfile.mkdtemp(prefix='velocity_', dir=os.path.dirname(os.path.abspath(tiffile)))
+    try:
+        if errdset is not None:
+            files.append(os.path.join(tmpdir, 'error.flt'))
+            descriptions.append('LOS velocity uncertainty in mm/yr')
+            getVelocity(h5file, files[-1], block, errdset)
+
+        vrt = raw_vrt(os.path.join(tmpdir, 'velocity.vrt'), files, width, length, geotrans,
+                      np.float32, nodata='nan', descriptions=descriptions)
+        write_cog(vrt, tiffile, levels=overviews, blocksize=tile, predictor=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return (length, width)
+
+
 def copyGeoXML(xmlfile, outfile, shape):
     '''
     Copy Geocoding information from xmlfile to outfile.xml.
     '''
+    import isce
     import isceobj
 
     img = isceobj.createDemImage()
@@ -59,6 +156,61 @@ def copyGeoXML(xmlfile, outfile, shape):
 
     return
 
+
+def createSyntheticParams(h5file, rows, cols, nparms=3):
+    '''
+    Synthetic TS-PARAMS.h5 with a (rows, cols, nparms) parms cube and perr.
+    '''
+    fid = h5py.File(h5file, 'w')
+    for name in ['parms', 'perr']:
+        dset = fid.create_dataset(name, (rows, cols, nparms), dtype=np.float32)
+        for r0, r1 in rowBlocks(rows, 256):
+            dset[r0:r1] = np.random.randn(r1-r0, cols, nparms).astype(np.float32)
+    fid.close()
+
+
+def benchmark(rows, cols, nparms=3, block=256):
+    '''
+    Time and python peak memory of full and streaming extraction on a synthetic cube.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='extractVelocity_')
+    try:
+        h5file = os.path.join(tmpdir, 'TS-PARAMS.h5')
+        createSyntheticParams(h5file, rows, cols, nparms)
+
+        res = {}
+        shape = (rows, cols)
+        for name, func in [('full', lambda: getVelocityFull(h5file, os.path.join(tmpdir, 'full.geo'))),
+                           ('stream', lambda: getVelocity(h5file, os.path.join(tmpdir, 'stream.geo'), block))]:
+            tracemalloc.start()
+            t0 = time.time()
+            func()
+            res[name] = (time.time() - t0, tracemalloc.get_traced_memory()[1] / 2.0**20)
+            tracemalloc.stop()
+
+        same = np.array_equal(np.fromfile(os.path.join(tmpdir, 'full.geo'), np.float32),
+                              np.fromfile(os.path.join(tmpdir, 'stream.geo'), np.float32))
+
+        try:
+            tracemalloc.start()
+            t0 = time.time()
+            writeVelocityTiff(os.path.join(tmpdir, 'stream.geo'), os.path.join(tmpdir, 'vel.tif'),
+                    (0., 1., 0., 0., 0., -1.), shape, h5file, 'perr', block)
+            res['tiff'] = (time.time() - t0, tracemalloc.get_traced_memory()[1] / 2.0**20)
+            tracemalloc.stop()
+        except ImportError as err:
+            tracemalloc.stop()
+            print('Skipping GeoTIFF benchmark: {0}'.format(err))
+
+        print('Cube {0} x {1} x {2}, block {3} rows. Outputs identical: {4}'.format(rows, cols, nparms, block, same))
+        for name, (secs, peak) in sorted(res.items()):
+            print('{0:>8}: {1:8.2f} s  peak {2:10.1f} MB'.format(name, secs, peak))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return res
+
+
 if __name__ == '__main__':
     '''
     Main driver.
@@ -67,8 +219,13 @@ if __name__ == '__main__':
     ###Parse command line
     inps = cmdLineParse()
 
-    shape = getVelocity(inps.h5file, inps.velfile)
-    
-    copyGeoXML(inps.xmlfile, inps.velfile, shape)
+    if inps.benchmark is not None:
+        benchmark(inps.benchmark[0], inps.benchmark[1], inps.benchmark[2], inps.block)
+    else:
+        shape = getVelocity(inps.h5file, inps.velfile, inps.block)
 
+        copyGeoXML(inps.xmlfile, inps.velfile, shape)
 
+        if inps.tiffile is not None:
+            writeVelocityTiff(inps.velfile, inps.tiffile, getGeoTransform(inps.xmlfile), shape,
+                    inps.h5file, inps.errdset, inps.block)
@@ -5,6 +5,7 @@ import sys
 import numpy as np
 import veloLib
 import GPSlib
+import landMask
 from collections import OrderedDict
 import json
 """
@@ -24,37 +25,6 @@ errorCodes = {
              }
 
 
-def getLandWaterMask(snwe,shape, outFile='mask.flt'):
-    '''
-    Creates a float32 land water mask and dumps it to the outputFile.
-    '''
-
-    tempName = os.path.basename(os.tempnam())+'.grd'
-        
-    ####GMT land water mask command
-    cmd = 'grdlandmask -G{grd} -I{width}+/{length}+ -R{west}/{east}/{south}/{north} -Df'.format(grd=tempName, width=shape[1], length=shape[0],
-            west=snwe[2], east=snwe[3], south=snwe[0], north=snwe[1])
-
-    try:
-        os.system(cmd)
-    except:
-        print 'GRDLANDMASK error'
-        sys.exit(errorCodes['GMT Error'])
-
-    ##### Dump land mask to a float32 files
-    cmd = 'grd2xyz {grd} -ZTLf > {out}'.format(grd=tempName,
-                                                out=outFile)
-    try:
-        os.system(cmd)
-    except:
-        print 'GRD2XYZ error'
-        sys.exit(errorCodes['GMT Error'])
-
-    if os.path.exists(tempName):
-        os.remove(tempName)
-
-    return
-
 def createGIAnTGPSrepo(gpsData, lname='stationlist', gpsdir='neu'):
     '''
     Creates files and directory needed by GIAnT in SOPAC format.
@@ -133,9 +103,15 @@ if __name__ == '__main__':
 
     #####Land Water mask
     if not inps['nolw']:
-        getLandWaterMask(metaData['snwe'], (metaData['length'], metaData['width']), os.path.join(currDir, inps['lwmaskName']))
+        ####Rasterized in process from GSHHG polygons or a WBD image, by GMT if no GSHHG file is found
+        try:
+            allMask = landMask.getLandWaterMask(metaData['snwe'], (metaData['length'], metaData['width']),
+                        os.path.join(currDir, inps['lwmaskName']), gshhsFile=inps.get('gshhsFile'),
+                        wbdFile=inps.get('wbdFile'))
+        except Exception as err:
+            print 'Land water mask error: ', err
+            sys.exit(errorCodes['GMT Error'])
 
-        allMask = np.fromfile(os.path.join(currDir, inps['lwmaskName']), dtype=np.float32).reshape((metaData['length'],metaData['width']))
         allMask[allMask == 0.] = np.nan
         allMask[allMask == 1.] = 0.
     else:
@@ -177,31 +153,37 @@ if __name__ == '__main__':
             sys.exit(errorCodes['Not enough coherence'])
 
     else:
-        ####First get GPS data for the master SAR acquisition
+        ####GPS responses are cached on disk so that repeat runs do no network I/O
+        if inps.get('gpsLocalDir'):
+            fetcher = GPSlib.LocalFileFetcher(inps['gpsLocalDir'])
+        else:
+            fetcher = GPSlib.UCSDFetcher()
+        gpsCache = GPSlib.GPSCache(inps.get('gpsCacheDir', 'GPScache'), fetcher)
+
+        ####Get GPS positions of the master stations for all SAR acquisitions
         try:
-            masterGPS = GPSlib.getGPSinBox(sarList[0], metaData['snwe'])
+            sites, masterGPS, xyz, sig = GPSlib.getGPSTimeSeries(sarList, metaData['snwe'], fetcher=gpsCache)
         except:
-            print 'Unable to get GPS data for master date'
+            print 'Unable to get GPS data for SAR dates'
             sys.exit(errorCodes['GPS Data Error'])
 
-        gpsData = OrderedDict()
-
-        for site, gps in masterGPS.iteritems():
+        ####Keep stations over coherent pixels with data on every date
+        keep = []
+        for kk, site in enumerate(sites):
+            gps = masterGPS[site]
             ii = np.int(np.round((gps.wgsLat - metaData['snwe'][1])/metaData['deltaLat']))
             jj = np.int(np.round((gps.wgsLon - metaData['snwe'][2])/metaData['deltaLon']))
 
             if (ii > inps['gpswin']) and (ii < (metaData['length'] - inps['gpswin'])):
                 if (jj > inps['gpswin']) and (jj < (metaData['width'] - inps['gpswin'])):
                     msk = np.nansum(1*np.isfinite(allMask[ii-inps['gpswin']:ii+inps['gpswin'], jj-inps['gpswin']:jj+inps['gpswin']]))
-                    if msk > 0:
-                        gps.setupLocalCoordinates()
-                        gpsData[site] = GPSlib.GPSstn(gps.site, gps.wgsLat, gps.wgsLon, ii, jj)
-                        gpsData[site].addObservation(sarList[0], np.zeros(3), gps.refError)
+                    if msk > 0 and np.all(np.isfinite(xyz[:,kk,:])):
+                        keep.append((kk, site, ii, jj))
 
 
         #####Check if enough GPS stations are available
-        if len(gpsData) < 5:
-            print 'Less than 5 GPS stations over the frame'
+        if len(keep) < 5:
+            print 'Less than 5 GPS stations with data on all dates over the frame'
             print 'Try manual processing or without GPS'
             sys.exit(errorCodes['Not enough GPS points'])
 
@@ -210,25 +192,18 @@ if __name__ == '__main__':
             print 'Not enough coherence around GPS stations.'
             sys.exit(errorCodes['Not enough GPS points'])
 
-       
-        ####Loop over the SAR dates to create ENU observation array
-        for date in sarList[1:]:
-            try:
-                slaveGPS = GPSlib.getGPSinBox(date, metaData['snwe'])
-            except:
-                print 'Unable to get GPS data for date: '+date
-                sys.exit(errorCodes['GPS Data Error'])
-
-            for site,gps  in gpsData.iteritems():
-                if site not in slaveGPS.keys():
-                    del masterGPS[site]
-                else:
-                    enu,err = masterGPS[site].toENU(slaveGPS[site])
-                    gps.addObservation(date, 1000*enu, 1000*err)
-
-            if len(gpsData) < 5:
-                print 'Number of GPS points available < 5'
-                sys.exit(errorCodes['Not enough GPS points'])
+        ####ENU observations of all stations and dates in one call
+        idx = [k[0] for k in keep]
+        enu, err = GPSlib.batchENU(xyz[0,idx], sig[0,idx], xyz[:,idx], sig[:,idx])
+
+        gpsData = OrderedDict()
+        for nn, (kk, site, ii, jj) in enumerate(keep):
+            gps = masterGPS[site]
+            gps.setupLocalCoordinates()
+            gpsData[site] = GPSlib.GPSstn(gps.site, gps.wgsLat, gps.wgsLon, ii, jj)
+            gpsData[site].addObservation(sarList[0], np.zeros(3), gps.refError)
+            for dd, date in enumerate(sarList[1:]):
+                gpsData[site].addObservation(date, 1000*enu[dd+1,nn], 1000*err[dd+1,nn])
 
         print 'Number of viable GPS stations: ', len(gpsData)
 
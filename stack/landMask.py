@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from utils.isce_raster import RasterImage, get_image_info
+
+"""
+In-process land/water masks on the GMT grdlandmask grid.
+
+The mask is written as the float32 binary that grdlandmask + grd2xyz -ZTLf
+produce (1 land, 0 water, top row first), so existing readers are unchanged.
+Two sources are supported:
+    - GSHHG native binary polygons (gshhs_[fhilc].b from the gshhg-bin release)
+    - ISCE water body (WBD) images from wbdStitcher.py (-1 water, 0 land)
+When no GSHHG file is found, the mask is made by GMT as before.
+"""
+
+GSHHS_RESOLUTIONS = 'fhilc'
+
+#GSHHG version 2 header: id, n, flag, west, east, south, north, area, area_full, container, ancestor
+GSHHS_HEADER = 11
+
+
+def gridNodes(snwe, shape):
+    '''
+    Latitudes and longitudes of the nodes of a gridline registered grid,
+    as created by grdlandmask -R{w}/{e}/{s}/{n} -I{width}+/{length}+.
+    '''
+    lat = np.linspace(snwe[1], snwe[0], shape[0])
+    lon = np.linspace(snwe[2], snwe[3], shape[1])
+    return lat, lon
+
+
+def findGSHHS(resolution='f', dirname=None):
+    '''
+    Locate the GSHHG binary polygon file for a resolution in dirname or $GSHHG_DIR.
+    '''
+    if resolution not in GSHHS_RESOLUTIONS:
+        raise ValueError('Unknown GSHHS resolution: {0}'.format(resolution))
+
+    dirs = [dirname, os.environ.get('GSHHG_DIR'), '/usr/share/gshhg-bin', '/usr/local/share/gshhg-bin']
+    for dd in dirs:
+        if dd is None:
+            continue
+        fname = os.path.join(dd, 'gshhs_{0}.b'.format(resolution))
+        if os.path.exists(fname):
+            return fname
+
+    raise IOError('Could not find gshhs_{0}.b. Set GSHHG_DIR.'.format(resolution))
+
+
+def readGSHHS(fname, snwe, maxlevel=4):
+    '''
+    Read the polygons of a GSHHG binary file whose latitude extent overlaps the box.
+    Returns a list of (lon, lat) arrays in degrees. Longitudes are as stored (0-360
+    except for polygons crossing Greenwich).
+    '''
+    data = np.fromfile(fname, dtype='>i4')
+    polys = []
+    pos = 0
+    while pos < data.size:
+        hdr = data[pos:pos+GSHHS_HEADER]
+        npts = int(hdr[1])
+        level = int(hdr[2]) & 255
+        south = hdr[5] * 1.0e-6
+        north = hdr[6] * 1.0e-6
+        start = pos + GSHHS_HEADER
+        pos = start + 2*npts
+
+        if (level > maxlevel) or (north < snwe[0]) or (south > snwe[1]):
+            continue
+
+        pts = data[start:pos].reshape((npts, 2)).astype(np.float64) * 1.0e-6
+        polys.append((pts[:,0], pts[:,1]))
+
+    return polys
+
+
+def polygonCrossings(lon, lat, snwe, shape):
+    '''
+    Row and column indices of the crossings of the grid rows by the polygon edges.
+    A crossing at column c toggles the inside state of all nodes j >= c.
+    '''
+    length, width = shape
+    dlat = (snwe[1] - snwe[0]) / (length - 1.0)
+    dlon = (snwe[3] - snwe[2]) / (width - 1.0)
+
+    x0 = lon
+    y0 = lat
+    x1 = np.roll(lon, -1)
+    y1 = np.roll(lat, -1)
+
+    ###Edge crosses row latitude y when min(y0,y1) <= y < max(y0,y1)
+    ymin = np.minimum(y0, y1)
+    ymax = np.maximum(y0, y1)
+    ilo = np.maximum(np.floor((snwe[1] - ymax) / dlat).astype(np.int64) + 1, 0)
+    ihi = np.minimum(np.floor((snwe[1] - ymin) / dlat).astype(np.int64), length - 1)
+    nrows = np.maximum(ihi - ilo + 1, 0)
+
+    sel = nrows > 0
+    if not np.any(sel):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    x0, y0, x1, y1 = x0[sel], y0[sel], x1[sel], y1[sel]
+    ilo = ilo[sel]
+    nrows = nrows[sel]
+
+    ###Expand to one entry per (edge, row)
+    edge = np.repeat(np.arange(nrows.size), nrows)
+    offs = np.arange(edge.size) - np.repeat(np.cumsum(nrows) - nrows, nrows)
+    rows = ilo[edge] + offs
+    y = snwe[1] - rows * dlat
+    x = x0[edge] + (y - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+
+    cols = np.clip(np.ceil((x - snwe[2]) / dlon), 0, width).astype(np.int64)
+    return rows, cols
+
+
+def rasterizePolygons(polys, snwe, shape):
+    '''
+    Even-odd rasterization of polygons onto the grid nodes. Nested GSHHG levels
+    (land, lake, island in lake, pond) alternate, so the parity over all polygons
+    is land. Returns a uint8 array with 1 for land.
+    '''
+    length, width = shape
+    toggles = np.zeros((length, width + 1), dtype=np.int32)
+
+    for lon, lat in polys:
+        ###Try the polygon at the longitude branch(es) overlapping the grid
+        for shift in (-360.0, 0.0, 360.0):
+            if (lon.max() + shift < snwe[2]) or (lon.min() + shift > snwe[3]):
+                continue
+            rows, cols = polygonCrossings(lon + shift, lat, snwe, shape)
+            np.add.at(toggles, (rows, cols), 1)
+
+    return (np.cumsum(toggles[:, :width], axis=1) & 1).astype(np.uint8)
+
+
+def sampleWBD(wbdFile, snwe, shape, blockRows=1024, outside=1.0):
+    '''
+    Nearest neighbour sample of an ISCE water body image on the grid nodes.
+    Nodes outside the image get the value outside. Returns float32 with 1 for land.
+    '''
+    info = get_image_info(wbdFile)
+    img = RasterImage(info['filename'], info['width'], info['length'], info['bands'],
+                      info['scheme'], info['dtype'])
+    lat0 = float(info['coordinate2']['startingvalue'])
+    dlat = float(info['coordinate2']['delta'])
+    lon0 = float(info['coordinate1']['startingvalue'])
+    dlon = float(info['coordinate1']['delta'])
+
+    lat, lon = gridNodes(snwe, shape)
+    ii = np.round((lat - lat0) / dlat).astype(np.int64)
+    jj = np.round((lon - lon0) / dlon).astype(np.int64)
+    iok = (ii >= 0) & (ii < img.length)
+    jok = (jj >= 0) & (jj < img.width)
+
+    out = np.empty(shape, dtype=np.float32)
+    out[:] = outside
+    band = img.band(0)
+    jsel = jj[jok]
+    for r0 in range(0, shape[0], blockRows):
+        r1 = min(r0 + blockRows, shape[0])
+        rsel = np.flatnonzero(iok[r0:r1])
+        if rsel.size == 0:
+            continue
+        blk = band[ii[r0:r1][rsel]][:, jsel]
+        out[r0 + rsel[:, None], np.flatnonzero(jok)[None, :]] = (blk != -1)
+
+    return out
+
+
+def getLandWaterMask(snwe, shape, outFile='mask.flt', gshhsFile=None, wbdFile=None, resolution='f'):
+    '''
+    Creates a float32 land water mask and dumps it to the outputFile.
+    Uses the WBD image if given, else the GSHHG polygons, else GMT when no
+    GSHHG binary file is found.
+    '''
+    if wbdFile is not None:
+        mask = sampleWBD(wbdFile, snwe, shape)
+    else:
+        if gshhsFile is None:
+            try:
+                gshhsFile = findGSHHS(resolution)
+            except IOError as err:
+                print('{0} Falling back to GMT grdlandmask.'.format(err))
+                return getLandWaterMaskGMT(snwe, shape, outFile, resolution)
+        polys = readGSHHS(gshhsFile, snwe)
+        mask = rasterizePolygons(polys, snwe, shape).astype(np.float32)
+
+    mask.tofile(outFile)
+    return mask
+
+
+def getLandWaterMaskGMT(snwe, shape, outFile='mask.flt', resolution='f'):
+    '''
+    Creates the float32 land water mask with GMT grdlandmask and grd2xyz.
+    '''
+    fd, tempName = tempfile.mkstemp(suffix='.grd', dir='.')
+    os.close(fd)
+
+    cmd = 'grdlandmask -G{grd} -I{width}+/{length}+ -R{west}/{east}/{south}/{north} -D{res}'.format(grd=tempName,
+            width=shape[1], length=shape[0], west=snwe[2], east=snwe[3], south=snwe[0], north=snwe[1], res=resolution)
+    status = os.system(cmd)
+
+    if status == 0:
+        status = os.system('grd2xyz {grd} -ZTLf > {out}'.format(grd=tempName, out=outFile))
+
+    if os.path.exists(tempName):
+        os.remove(tempName)
+
+    if status != 0:
+        raise RuntimeError('GMT land water mask failed with status {0}'.format(status))
+
+    return np.fromfile(outFile, dtype=np.float32).reshape(shape)
+
+
+def benchmark(snwe, shape, gshhsFile=None, resolution='f'):
+    '''
+    Time the in-process and GMT masks on a grid and report their agreement.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='landmask_')
+    try:
+        t0 = time.time()
+        mask = getLandWaterMask(snwe, shape, os.path.join(tmpdir, 'py.flt'), gshhsFile, resolution=resolution)
+        tpy = time.time() - t0
+
+        t0 = time.time()
+        gmt = getLandWaterMaskGMT(snwe, shape, os.path.join(tmpdir, 'gmt.flt'), resolution)
+        tgmt = time.time() - t0
+    finally:
+        for ff in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, ff))
+        os.rmdir(tmpdir)
+
+    agree = np.mean(mask == gmt)
+    print('Grid {0} x {1}: in-process {2:.2f} s, GMT {3:.2f} s, agreement {4:.4f}'.format(shape[0], shape[1], tpy, tgmt, agree))
+    return tpy, tgmt, agree
+
+
+if __name__ == '__main__':
+    '''
+    Benchmark against GMT: landMask.py south north west east length width [gshhs_file]
+    '''
+    if len(sys.argv) < 7:
+        print('Usage: landMask.py south north west east length width [gshhs_file]')
+        sys.exit(1)
+
+    snwe = [float(x) for x in sys.argv[1:5]]
+    shape = (int(sys.argv[5]), int(sys.argv[6]))
+    gshhsFile = sys.argv[7] if len(sys.argv) > 7 else None
+    benchmark(snwe, shape, gshhsFile)
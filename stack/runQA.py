@@ -5,6 +5,8 @@ import os
 import numpy as np
 import veloLib
 import json
+import multiprocessing
+from utils.isce_raster import row_blocks
 """
 This script 
     - Looks at spatial coverage of all interferograms
@@ -45,6 +47,74 @@ def cmdLineParse():
     #return parser.parse_args()
 
 
+def validMask(unw, cor, cthresh):
+    '''
+    Valid pixels of a block: unw != 0 and cor > cthresh.
+    '''
+    return (unw != 0) & (cor > cthresh)
+
+
+def qaIfg(args):
+    '''
+    Single read of one interferogram in row blocks.
+    Returns the number of valid pixels (unw != 0 and cor > cthresh_qa), their packed
+    mask, the same mask if keep is set (None otherwise) and the packed qa mask
+    (unw != 0 and cor > chthresh).
+    '''
+    unwname, corname, cthresh, chthresh, blockRows, keep = args
+    if not os.path.exists(unwname) or not os.path.exists(corname):
+        return None
+
+    unw = veloLib.createMemmap(unwname).bands[0]
+    cor = veloLib.createMemmap(corname).bands[0]
+    length, width = unw.shape
+
+    count = 0
+    packed = np.zeros((length, (width+7)//8), dtype=np.uint8)
+    packed1 = np.zeros((length, (width+7)//8), dtype=np.uint8)
+    for win in row_blocks(length, width, blockRows):
+        unwblk = unw[win.rows,:]
+        corblk = cor[win.rows,:]
+        mask = validMask(unwblk, corblk, cthresh)
+        count += np.sum(mask)
+        packed[win.rows,:] = np.packbits(mask, axis=1)
+        packed1[win.rows,:] = np.packbits(validMask(unwblk, corblk, chthresh), axis=1)
+
+    return count, packed, packed if keep else None, packed1
+
+
+def setCommonMask(mask):
+    '''
+    Pool initializer sharing the common region with the overlapIfg workers.
+    '''
+    global commonMask
+    commonMask = mask
+
+
+def overlapIfg(args):
+    '''
+    Overlap of one interferogram with the common region, read in row blocks.
+    Used when the masks of the first pass are not kept.
+    '''
+    unwname, corname, cthresh, blockRows = args
+    unw = veloLib.createMemmap(unwname).bands[0]
+    cor = veloLib.createMemmap(corname).bands[0]
+    length, width = unw.shape
+
+    count = 0
+    for win in row_blocks(length, width, blockRows):
+        count += np.sum(validMask(unw[win.rows,:], cor[win.rows,:], cthresh) & commonMask[win.rows,:])
+
+    return count
+
+
+def unpackMask(packed, width):
+    '''
+    Unpack a row packed mask from qaIfg.
+    '''
+    return np.unpackbits(packed, axis=1)[:,:width]
+
+
 if __name__ == '__main__':
     '''
     The main driver for creating aux data.
@@ -65,33 +135,37 @@ if __name__ == '__main__':
     cover = np.zeros(nIfg)
     usefulPair = np.ones(nIfg, dtype=np.bool)
     commonMask = np.zeros((metaData['length'], metaData['width']))
+    commonMask1 = np.ones((metaData['length'], metaData['width']))
+    packedMasks = [None]*nIfg
+    present = []
 
     size = metaData['width']*metaData['length']
+    blockRows = inps.get('blockRows', 1024)
 
-    ######First Pass over interferograms
-    for ind, intdir in enumerate(intList):
+    ######The overlap masks are kept for the common region test if they fit in
+    ######maskMemoryMB (nIfg*length*width/8 bytes), otherwise the ifgs are read again
+    keepMasks = nIfg*metaData['length']*((metaData['width']+7)//8) <= inps.get('maskMemoryMB', 1024)*2**20
+
+    ######Single pass over interferograms. Partial masks are reduced as workers finish
+    jobs = [(os.path.join(intdir, inps['unwFile']), os.path.join(intdir, inps['corFile']),
+             inps['cthresh_qa'], inps['chthresh'], blockRows, keepMasks)
+             for intdir in intList]
+    pool = multiprocessing.Pool(inps.get('nproc', multiprocessing.cpu_count()))
+    for ind, res in enumerate(pool.imap(qaIfg, jobs)):
 
-        print 'Processing IFG  %d out of  %d'%(ind+1, nIfg)
-        
-        unwname = os.path.join(intdir,inps['unwFile'])
-        corname = os.path.join(intdir,inps['corFile'])
-        if not os.path.exists(unwname) or not os.path.exists(corname):
+        print 'Processed IFG  %d out of  %d'%(ind+1, nIfg)
+        if res is None:
             usefulPair[ind] = False
             print 'Pair %d not useful. skipping ....'%(ind)
             continue
 
-        unw = veloLib.createMemmap(unwname)
-        cor = veloLib.createMemmap(corname)
-
-        dmask = (unw.bands[0] != 0)
-        cmask = (cor.bands[0] > inps['cthresh_qa'])
-
-        mask = dmask*cmask
-        commonMask += mask 
-
-        cover[ind] = np.sum(mask) / (1.0*size)
-        unw = None
-        cor = None
+        present.append(ind)
+        count, packed, packedMasks[ind], packed1 = res
+        commonMask += unpackMask(packed, metaData['width'])
+        commonMask1 *= unpackMask(packed1, metaData['width'])
+        cover[ind] = count / (1.0*size)
+    pool.close()
+    pool.join()
 
 
     #######Apply coverage filter
@@ -146,34 +220,22 @@ if __name__ == '__main__':
     if (csum < inps['mincov']):
         raise Exception('Not enough common regions between IFGS.')
 
-    commonMask1 = np.ones((metaData['length'], metaData['width']))
-
-    ######Second Pass over interferograms
-    for ind, intdir in enumerate(intList):
-
-        print 'Processing IFG  %d out of  %d'%(ind+1, nIfg)
-        
-        unwname = os.path.join(intdir, inps['unwFile'])
-        corname = os.path.join(intdir, inps['corFile'])
-        if not os.path.exists(unwname) or not os.path.exists(corname):
-            usefulPair[ind] = False
-            print 'Pair %d not useful. skipping ....'%(ind)
-            continue
-
-        unw = veloLib.createMemmap(unwname)
-        cor = veloLib.createMemmap(unwname)
-
-        size = cor.bands[0].size
-        dmask = (unw.bands[0] != 0)
-        cmask = (cor.bands[0] > inps['cthresh_qa'])
-        mask = dmask*cmask
-                
-        cmask1 = (cor.bands[0] > inps['chthresh'])
-        commonMask1 *= dmask*cmask1
-
-        frac = np.sum(mask * commonMask) / (csum * size)
+    ######Overlap of each interferogram with the common region, from the kept masks
+    ######or from a second read
+    if keepMasks:
+        overlap = [np.sum(unpackMask(packedMasks[ind], metaData['width']) & commonMask) for ind in present]
+        packedMasks = None
+    else:
+        pool = multiprocessing.Pool(inps.get('nproc', multiprocessing.cpu_count()),
+                                    setCommonMask, (commonMask,))
+        overlap = pool.map(overlapIfg, [jobs[ind][:3] + (blockRows,) for ind in present])
+        pool.close()
+        pool.join()
+
+    for ind, count in zip(present, overlap):
+        frac = count / (csum * size)
         if (frac < inps['common']):
-            usefulPair[kk] = False
+            usefulPair[ind] = False
 
 
     useful = np.sum(usefulPair)
@@ -18,20 +18,38 @@
 # foreign persons.
 #
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-import isce
-import stdproc
-import isceobj
-import argparse
+from __future__ import print_function
 import os
-import stackSetup as SS
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+####Files read by the filter step and written by it, relative to the pair dir
+FILTER_INPUTS = ['PICKLE/filter', 'resampOnlyImage.amp']
+FILTER_OUTPUTS = ['phsig.cor', 'phsig.cor.xml']
+STAMP_FILE = '.filtProcess.json'
 
 def load_pickle(step='filter'):
-    import cPickle
+    ####ISCE pickles need the isce paths set up before loading
+    try:
+        import isce
+    except ImportError:
+        pass
 
-    insarObj = cPickle.load(open('PICKLE/{0}'.format(step), 'rb'))
+    insarObj = pickle.load(open('PICKLE/{0}'.format(step), 'rb'))
     return insarObj
 
 def estPhaseSigma(insar):
+    import isce
+    import isceobj
     from mroipac.icu.Icu import Icu
 
     intImage = isceobj.createSlcImage()     #Filtered file
@@ -70,6 +88,149 @@ def estPhaseSigma(insar):
     ampImage.finalizeImage()
     outImage.finalizeImage()
  
+
+def md5sum(fname, blocksize=1<<22):
+    '''
+    md5 of a file read in blocks.
+    '''
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(blocksize), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def filterInputs(insar):
+    '''
+    Input files of the filter step for an insar object.
+    '''
+    return FILTER_INPUTS + [insar.topophaseFlatFilename]
+
+
+def isUpToDate(inputs, outputs=FILTER_OUTPUTS, stamp=STAMP_FILE):
+    '''
+    Outputs are up to date if they exist and are newer than all inputs, or if the
+    inputs still have the checksums recorded when the outputs were made (e.g.
+    restaged copies with new mtimes).
+    '''
+    if not all(os.path.exists(x) for x in outputs):
+        return False
+
+    newest = max(os.path.getmtime(x) for x in inputs)
+    if min(os.path.getmtime(x) for x in outputs) >= newest:
+        return True
+
+    if not os.path.exists(stamp):
+        return False
+
+    with open(stamp, 'r') as fid:
+        recorded = json.load(fid)
+
+    return all(recorded.get(x) == md5sum(x) for x in inputs)
+
+
+def writeStamp(inputs, stamp=STAMP_FILE):
+    '''
+    Record the checksums of the inputs the outputs were made from.
+    '''
+    with open(stamp, 'w') as fid:
+        json.dump(dict((x, md5sum(x)) for x in inputs), fid, indent=2)
+
+
+def setMemoryLimit(maxMem):
+    '''
+    Pool initializer capping the address space of a worker to maxMem GB.
+    '''
+    if maxMem:
+        import resource
+        limit = int(maxMem * (1 << 30))
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def processPair(args):
+    '''
+    Filter one interferogram directory. Returns a summary record.
+    '''
+    pair, force, filterFunc = args
+    rec = {'pair': pair, 'status': None, 'seconds': 0.0, 'error': None}
+    t0 = time.time()
+    currDir = os.getcwd()
+
+    try:
+        os.chdir(pair)
+        iobj = load_pickle()
+        inputs = filterInputs(iobj)
+        if (not force) and isUpToDate(inputs):
+            rec['status'] = 'skipped'
+        else:
+            filterFunc(iobj)
+            writeStamp(inputs)
+            rec['status'] = 'processed'
+    except MemoryError:
+        rec['status'] = 'failed'
+        rec['error'] = 'Worker memory cap exceeded'
+    except Exception as err:
+        rec['status'] = 'failed'
+        rec['error'] = '{0}: {1}'.format(type(err).__name__, err)
+    finally:
+        os.chdir(currDir)
+
+    rec['seconds'] = time.time() - t0
+    return rec
+
+
+def numWorkers(nproc, maxMem):
+    '''
+    Number of workers limited by the cores and by the physical memory over the per
+    worker cap.
+    '''
+    nproc = nproc or multiprocessing.cpu_count()
+    if maxMem:
+        try:
+            total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / float(1 << 30)
+            nproc = min(nproc, max(int(total // maxMem), 1))
+        except (ValueError, OSError, AttributeError):
+            pass
+    return max(nproc, 1)
+
+
+def filterStack(pairDirs, nproc=None, maxMem=None, force=False, filterFunc=estPhaseSigma,
+                summary='filtProcess_summary.json'):
+    '''
+    Filter independent interferograms concurrently and write a run summary.
+    '''
+    nproc = numWorkers(nproc, maxMem)
+    jobs = [(os.path.abspath(pair), force, filterFunc) for pair in pairDirs]
+
+    t0 = time.time()
+    records = []
+    ####One pair per worker process so that ISCE state and memory are released
+    pool = multiprocessing.Pool(nproc, setMemoryLimit, (maxMem,), maxtasksperchild=1)
+    try:
+        for rec in pool.imap_unordered(processPair, jobs):
+            print('{0}: {1} ({2:.1f} s)'.format(rec['pair'], rec['status'], rec['seconds']))
+            if rec['error']:
+                print('    ' + rec['error'])
+            records.append(rec)
+    finally:
+        pool.close()
+        pool.join()
+
+    records.sort(key=lambda x: x['pair'])
+    counts = dict((k, sum(1 for x in records if x['status'] == k)) for k in ['processed', 'skipped', 'failed'])
+    out = {'nproc': nproc,
+           'max_mem_gb': maxMem,
+           'wall_seconds': time.time() - t0,
+           'counts': counts,
+           'pairs': records}
+
+    if summary:
+        with open(summary, 'w') as fid:
+            json.dump(out, fid, indent=2)
+
+    return out
+
+
 def parse():
     '''
     Command line parser.
@@ -81,6 +242,15 @@ def parse():
         type=str)
     parser.add_argument('-force', action='store_true', default=False,
         dest='force', help='Force reprocessing.')
+    parser.add_argument('-p', action='store', default=None,
+        dest='nproc', help='Number of worker processes. Default: number of cores.',
+        type=int)
+    parser.add_argument('-m', action='store', default=None,
+        dest='maxMem', help='Memory cap per worker in GB.',
+        type=float)
+    parser.add_argument('-s', action='store', default='filtProcess_summary.json',
+        dest='summary', help='Run summary json file.',
+        type=str)
     parser.add_argument('-l', action='store', default='',
         dest='subset', help='Consider only a subset of dirs given in file.',
         type=str)
@@ -106,39 +276,25 @@ if __name__ == '__main__':
     '''
     inps = parse()
 
-    currDir = os.getcwd()
-
+    import stackSetup as SS
     if inps.subset in ['', None]:
         pairDirs = SS.getPairDirs(dirname=inps.dirname)
     else:
         pairDirs = SS.pairDirs_from_file(inps.subset, base=inps.dirname)
 
-    print 'Number of IFGs : ', len(pairDirs)
+    print('Number of IFGs : ', len(pairDirs))
 
     if inps.pyaps:
-        print 'PyAPS corrections desired. '
-        print 'PyAPS data to be stored in {0}'.format(inps.atmosdir)
+        print('PyAPS corrections desired. ')
+        print('PyAPS data to be stored in {0}'.format(inps.atmosdir))
+        print('PyAPS functions will go here.')
     elif inps.tropo:
-        print 'Tropo corrections desired. '
-        print 'Tropo data to be stored in {0}'.format(inps.atmosdir)
-
-    for pair in pairDirs:
-        corfile = os.path.join(pair, 'phsig.cor')
-        if os.path.exists(corfile) and (not inps.force):
-            print 'Interferogram {0} already processed'.format(pair)
-        else:
-            print 'Processing: {0}'.format(pair)
-
-            ####Estimate phase standard deviation
-            os.chdir(pair)
-            iobj = load_pickle()
-            estPhaseSigma(iobj)
-
-            ####Estimate PyAPS corrections
-            if inps.pyaps:
-                print 'PyAPS functions will go here.'
-
-            if inps.tropo:
-                print 'Tropo functions will go here.'
+        print('Tropo corrections desired. ')
+        print('Tropo data to be stored in {0}'.format(inps.atmosdir))
+        print('Tropo functions will go here.')
 
-            os.chdir(currDir)
+    ####Estimate phase standard deviation
+    res = filterStack(pairDirs, inps.nproc, inps.maxMem, inps.force, summary=inps.summary)
+    print('Processed: {processed}, skipped: {skipped}, failed: {failed}'.format(**res['counts']))
+    if res['counts']['failed'] > 0:
+        sys.exit(1)
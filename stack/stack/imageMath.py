@@ -18,10 +18,14 @@ import argparse
 import symtable
 import math
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
+from utils.isce_raster import RasterImage, get_image_info, row_blocks
 import logging
 import os
 import sys
+import time
+import tempfile
+import shutil
+from multiprocessing.pool import ThreadPool
 
 
 helpStr = """
@@ -320,133 +324,30 @@ def createLogger(debug):
 
 
 ##########Classes and utils for memory maps
-class memmap(object):
-    '''Create the memap object.'''
+class memmap(RasterImage):
+    '''Create the memap object. Bands are zero-copy views from utils.isce_raster.'''
     def __init__(self,fname, mode='readonly', nchannels=1, nxx=None, nyy=None, scheme='BSQ', dataType='f'):
         '''Init function.'''
-
-        fsize = np.zeros(1, dtype=dataType).itemsize
-
-        if nxx is None:
-            raise ValueError('Undefined file width for : %s'%(fname))
-
-        if mode=='write':
-            if nyy is None:
-                raise ValueError('Undefined file length for opening file: %s in write mode.'%(fname))
-        else:
-            try:
-                nbytes = os.path.getsize(fname)
-            except:
-                raise ValueError('Non-existent file : %s'%(fname))
-
-            if nyy is None:
-                nyy = nbytes/(fsize*nchannels*nxx)
-
-                if (nxx*nyy*fsize*nchannels) != nbytes:
-                    raise ValueError('File size mismatch for %s. Fractional number of lines'(fname))
-            elif (nxx*nyy*fsize*nchannels) > nbytes:
-                    raise ValueError('File size mismatch for %s. Number of bytes expected: %d'%(nbytes))
-             
-
-        self.name = fname
-        self.width = nxx
-        self.length = nyy
-
-        ####List of memmap objects
-        acc = []
-
-        ####Create the memmap for the full file
-        nshape = nchannels*nyy*nxx
-        omap = np.memmap(fname, dtype=dataType, mode=mode, 
-                shape = (nshape,))
-
-        if scheme.upper() == 'BIL':
-            nstrides = (nchannels*nxx*fsize, fsize)
-
-            for band in xrange(nchannels):
-                ###Starting offset
-                noffset = band*nxx
-
-                ###Temporary view
-                tmap = omap[noffset:]
-
-                ####Trick it into creating a 2D array
-                fmap = as_strided(tmap, shape=(nyy,nxx), strides=nstrides)
-
-                ###Add to list of objects
-                acc.append(fmap)
-
-        elif scheme.upper() == 'BSQ':
-            nstrides = (fsize, fsize)
-
-            for band in xrange(nchannels):
-                ###Starting offset
-                noffset = band*nxx*nyy
-
-                ###Temporary view
-                tmap = omap[noffset:noffset+nxx*nyy]
-
-                ####Reshape into 2D array
-                fmap = as_strided(tmap, shape=(nyy,nxx))
-
-                ###Add to lits of objects
-                acc.append(fmap)
-
-        elif scheme.upper() == 'BIP':
-            nstrides = (nchannels*nxx*fsize,nchannels*fsize)
-
-            for band in xrange(nchannels):
-                ####Starting offset
-                noffset = band
-
-                ####Temporary view
-                tmap = omap[noffset:]
-
-                ####Trick it into interpreting ot as a 2D array
-                fmap = as_strided(tmap, shape=(nyy,nxx), strides=nstrides)
-
-                ####Add to the list of objects
-                acc.append(fmap)
-
-        else:
-            raise ValueError('Unknown file scheme: %s for file %s'%(scheme,fname))
-
-        ######Assigning list of objects to self.bands
-        self.bands = acc
+        RasterImage.__init__(self, fname, nxx, nyy, nchannels, scheme, dataType, mode)
 
 
 def mmapFromISCE(fname, logger):
     '''
     Create a file mmap object using information in an ISCE XML.
     '''
-    try:
-        import isce
-        import iscesys
-        from iscesys.Parsers.FileParserFactory import createFileParser
-    except:
-        raise ImportError('ISCE has not been installed or is not importable')
-
-    if not fname.endswith('.xml'):
-        dataName = fname
-        metaName = fname + '.xml'
-    else:
-        metaName = fname
-        dataName = os.path.splitext(fname)[0]
-
-    parser = createFileParser('xml')
-    prop, fac, misc = parser.parse(metaName)
+    info = get_image_info(fname)
 
     logger.debug('Creating readonly ISCE mmap with \n' +
-            'file = %s \n'%(dataName) + 
-            'bands = %d \n'%(prop['number_bands']) + 
-            'width = %d \n'%(prop['width']) + 
-            'length = %d \n'%(prop['length'])+
-            'scheme = %s \n'%(prop['scheme']) +
-            'dtype = %s \n'%(prop['data_type']))
+            'file = %s \n'%(info['filename']) + 
+            'bands = %d \n'%(info['bands']) + 
+            'width = %d \n'%(info['width']) + 
+            'length = %d \n'%(info['length'])+
+            'scheme = %s \n'%(info['scheme']) +
+            'dtype = %s \n'%(info['dtype']))
 
-    mObj = memmap(dataName, nchannels=prop['number_bands'],
-            nxx=prop['width'], nyy=prop['length'], scheme=prop['scheme'],
-            dataType=NUMPY_type(prop['data_type']))
+    mObj = memmap(info['filename'], nchannels=info['bands'],
+            nxx=info['width'], nyy=info['length'], scheme=info['scheme'],
+            dataType=info['dtype'])
 
     return mObj
 
@@ -537,6 +438,105 @@ def renderISCEXML(fname, bands, nyy, nxx, datatype, scheme, descr):
     img.finalizeImage()
 
 
+#######Block evaluation engine
+def compileEquations(equations):
+    '''
+    Compile the math expressions once.
+    '''
+    return [compile(expr, '<imageMath>', 'eval') for expr in equations]
+
+
+def evaluateBlock(codes, bandList, inBands, outBands, start, stop):
+    '''
+    Evaluate compiled expressions over lines start:stop of the input bands.
+    '''
+    dataDict = dict(list(fnDict.items()) + list(constDict.items()))
+    for band in bandList:
+        dataDict[band] = inBands[band][start:stop,:]
+
+    for kk,code in enumerate(codes):
+        outBands[kk][start:stop,:] = eval(code, dataDict)
+
+
+def evaluate(equations, bandList, inBands, outBands, length, blockSize=1024, nthreads=1):
+    '''
+    Evaluate the math expressions over blocks of blockSize lines.
+    Blocks are independent and are distributed over nthreads threads.
+    '''
+    codes = compileEquations(equations)
+    width = outBands[0].shape[1]
+    blocks = [(win.rows.start, win.rows.stop) for win in row_blocks(length, width, blockSize)]
+
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(lambda blk: evaluateBlock(codes, bandList, inBands, outBands, blk[0], blk[1]), blocks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for start,stop in blocks:
+            evaluateBlock(codes, bandList, inBands, outBands, start, stop)
+
+
+def evaluateByLine(equations, bandList, inBands, outBands, length):
+    '''
+    Original line by line evaluation. Used as reference in benchmarks.
+    '''
+    dataDict = dict(list(fnDict.items()) + list(constDict.items()))
+    for lineno in xrange(length):
+        for band in bandList:
+            dataDict[band] = inBands[band][lineno,:]
+
+        for kk,expr in enumerate(equations):
+            outBands[kk][lineno,:] = eval(expr, dataDict)
+
+
+def benchmark(equations, bandList, logger, width=2048, length=4096,
+        blockSize=1024, nthreads=1, dataType='f'):
+    '''
+    Compare line by line and block evaluation of the equations on synthetic
+    BIL, BIP and BSQ inputs. Every input file gets two bands.
+    '''
+    fileList = bandsToFiles(bandList, logger)
+    tmpdir = tempfile.mkdtemp(prefix='imageMath')
+    results = []
+    try:
+        for scheme in ['BIL', 'BIP', 'BSQ']:
+            inBands = {}
+            for infile in fileList:
+                fname = os.path.join(tmpdir, infile + '.' + scheme)
+                data = np.random.rand(2*length*width).astype(dataType)
+                data.tofile(fname)
+                fmap = memmap(fname, nchannels=2, nxx=width, nyy=length,
+                        scheme=scheme, dataType=dataType)
+                inBands[infile] = fmap.bands[0]
+                for ii in xrange(len(fmap.bands)):
+                    inBands['%s_%d'%(infile, ii)] = fmap.bands[ii]
+
+            outs = []
+            for name in ['line', 'block']:
+                outmap = memmap(os.path.join(tmpdir, name + '.' + scheme), mode='write',
+                        nchannels=len(equations), nxx=width, nyy=length,
+                        scheme=scheme, dataType=iMath['outType'])
+                outs.append(outmap.bands)
+
+            t0 = time.time()
+            evaluateByLine(equations, bandList, inBands, outs[0], length)
+            t1 = time.time()
+            evaluate(equations, bandList, inBands, outs[1], length, blockSize, nthreads)
+            t2 = time.time()
+
+            identical = all(np.array_equal(a, b) for a,b in zip(outs[0], outs[1]))
+            mpix = width * length / 1.0e6
+            results.append((scheme, mpix/(t1-t0), mpix/(t2-t1), identical))
+            logger.info('%s: line %.1f Mpix/s, block %.1f Mpix/s, identical = %s'%results[-1])
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
 #######Command line parsing
 def detailedHelp():
     '''
@@ -593,6 +593,13 @@ def firstPassCommandLine():
             help='Print debugging statements', dest='debug')
     parser.add_argument('-n','--noxml', action='store_true', default=False,
             help='Do not create an ISCE XML file for the output.', dest='noxml')
+    parser.add_argument('-b','--block', type=int, default=1024, action='store',
+            help='Number of lines evaluated at a time.', dest='block')
+    parser.add_argument('-p','--threads', type=int, default=1, action='store',
+            help='Number of threads used to evaluate blocks.', dest='threads')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+            help='Compare line and block evaluation of the expression on synthetic inputs.',
+            dest='benchmark')
 
     #######Parse equation and output format first
     args, files = parser.parse_known_args()
@@ -668,6 +675,11 @@ if __name__ == '__main__':
         bandList = bandList + bands 
 
     bandList = uniqueList(bandList)
+
+    if args.benchmark:
+        benchmark(iMath['equations'], bandList, logger,
+                blockSize=args.block, nthreads=args.threads)
+        sys.exit(0)
     
     numOutBands = len(iMath['equations'])
     logger.debug('Number of output bands = %d'%(numOutBands))
@@ -757,24 +769,9 @@ if __name__ == '__main__':
 
     iMath['outBands'] = outmap.bands
 
-    #####Start evaluating the expressions
-
-    ####Set up the name space to use
-    dataDict=dict(fnDict.items() + constDict.items())
-    bands = iMath['inBands']
-    outBands = iMath['outBands']
-
-    #####Replace ^ by ** 
-    for lineno in xrange(iMath['length']):
-
-        ####Load one line from each of the the bands
-        for band in bandList:  #iMath['inBands'].iteritems():
-            dataDict[band] = bands[band][lineno,:]
-
-        ####For each output band
-        for kk,expr in enumerate(iMath['equations']):
-            res = eval(expr, dataDict)
-            outBands[kk][lineno,:] = res
+    #####Start evaluating the expressions over blocks of lines
+    evaluate(iMath['equations'], bandList, iMath['inBands'], iMath['outBands'],
+            iMath['length'], blockSize=args.block, nthreads=args.threads)
 
     
     ######Render ISCE XML if needed
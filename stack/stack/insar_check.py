@@ -14,12 +14,15 @@ from iscesys.StdOEL.StdOELPy import create_writer
 import stdproc
 import datetime
 import sys
+import sarSetup as SS
 
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates 
 import matplotlib
 
 
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
 stdWriter = create_writer("log", "", True, filename="prepareStack.log")
 
 
@@ -45,6 +48,51 @@ class orbit_info:
         self.getPeg()
         self.computeLookAngle()
 
+    def toRecord(self):
+        '''JSON serializable record of the orbit information, for the stack catalog.'''
+        svs = []
+        for sv in self.orbit:
+            svs.append([sv.getTime().strftime(TIME_FORMAT),
+                        [float(x) for x in sv.getPosition()],
+                        [float(x) for x in sv.getVelocity()]])
+
+        return {'dt': self.dt.strftime(TIME_FORMAT),
+                'prf': float(self.prf),
+                'fd': float(self.fd),
+                'rng': float(self.rng),
+                'hgt': float(self.hgt),
+                'rds': float(self.rds),
+                'pos': [float(x) for x in self.pos],
+                'vel': [float(x) for x in self.vel],
+                'peg': str(self.peg),
+                'orbit': svs}
+
+    @classmethod
+    def fromRecord(cls, rec, fname):
+        '''Rebuild from a catalog record without reading the h5 file or estimating the peg.'''
+        obj = cls.__new__(cls)
+        obj.planet = None
+        obj.orbit = Orbit()
+        for tt, pos, vel in rec['orbit']:
+            sv = StateVector()
+            sv.setTime(datetime.datetime.strptime(tt, TIME_FORMAT))
+            sv.setPosition(pos)
+            sv.setVelocity(vel)
+            obj.orbit.addStateVector(sv)
+
+        obj.dt = datetime.datetime.strptime(rec['dt'], TIME_FORMAT)
+        obj.prf = rec['prf']
+        obj.fd = rec['fd']
+        obj.rng = rec['rng']
+        obj.hgt = rec['hgt']
+        obj.rds = rec['rds']
+        obj.pos = rec['pos']
+        obj.vel = rec['vel']
+        obj.peg = rec['peg']
+        obj.filename = fname
+        obj.computeLookAngle()
+        return obj
+
     @staticmethod
     def getStateVector(orbit, time):
         return orbit.interpolateOrbit(time, method='hermite')
@@ -132,6 +180,42 @@ def CSKmetadata(self):
     return fd
 
 
+def scanScene(fname, raw):
+    '''
+    Orbit information and bounding box of a scene for the stack catalog,
+    read with a single HDF5 open.
+    '''
+    if raw:
+        sar = createSensor('COSMO_SKYMED')
+    else:
+        sar = createSensor('COSMO_SKYMED_SLC')
+    sar.hdf5 = fname
+
+    fp = h5py.File(fname, 'r')
+    fd = fp.attrs['Centroid vs Range Time Polynomial']
+    lat, lon = SS.getBboxFromHandle(fp, raw)
+    sar.populateMetadata(file=fp)
+    fp.close()
+
+    rec = orbit_info(sar, fname, fd[0]).toRecord()
+    rec['lat'] = lat
+    rec['lon'] = lon
+    return rec
+
+
+def loadOrbits(fnames, raw, catalog=None, nproc=None):
+    '''
+    orbit_info objects of the scenes from the stack catalog. Only scenes that are
+    new to the catalog are read, in parallel.
+    '''
+    import stackCatalog as SC
+    if not isinstance(catalog, SC.StackCatalog):
+        catalog = SC.StackCatalog(catalog, nproc)
+
+    catalog.update(fnames, raw=raw, orbits=True)
+    return [orbit_info.fromRecord(catalog.get(fname), fname) for fname in fnames]
+
+
 def parse():
     '''
     Parse the command line to get the list of values.
@@ -156,6 +240,10 @@ def parse():
     parser.add_argument('-coh', dest='cThresh', default=0.3, help='Coherence Threshold to estimate viable interferograms. [0., 1.0]', type=float, action=Range(0., 1.))
     parser.add_argument('-raw', dest='raw', default=False, action='store_true',
             help='Set for raw data.')
+    parser.add_argument('-catalog', dest='catalog', default=None, type=str,
+            help='Stack metadata catalog file to reuse and update.')
+    parser.add_argument('-nproc', dest='nproc', default=None, type=int,
+            help='Number of processes for reading new scenes.')
     inps = parser.parse_args()
 
     return inps
@@ -168,16 +256,9 @@ def process(inps):
     print(inps.fnames)
     print('Number of SAR Scenes = %d'%nSar)
 
-    Orbits = []
     print('Reading in all the raw files and metadata.')
-    for k in xrange(nSar):
-        if inps.raw:
-            sar = createSensor('COSMO_SKYMED')
-        else:
-            sar = createSensor('COSMO_SKYMED_SLC')
-        sar.hdf5= inps.fnames[k]
-        fd = CSKmetadata(sar)
-        Orbits.append(orbit_info(sar, inps.fnames[k],fd[0]))
+    Orbits = loadOrbits(inps.fnames, inps.raw, getattr(inps, 'catalog', None),
+                        getattr(inps, 'nproc', None))
 
     ##########We now have all the pegpoints to start processing.
     Dopplers = np.zeros(nSar)
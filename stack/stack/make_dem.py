@@ -6,6 +6,7 @@ import os
 import sys
 import logging
 import sarSetup as SS
+import stackCatalog as SC
 import argparse
 
 logger = logging.getLogger('DemStitcher')
@@ -66,14 +67,17 @@ def createDem(lat=None, lon=None, target='.', buffer=0.):
     return demName
 
 
-def constructDem(source='.', target='.', buffer=0.):
+def constructDem(source='.', target='.', buffer=0., catalog=None):
     '''
     Uses the h5 files in source directory to determine bounding box and creates
-    an appropriate DEM in the target directory.
+    an appropriate DEM in the target directory. The bboxes are read from the
+    stack catalog (stackCatalog.json in source by default), which is updated
+    with new scenes.
     '''
 
     flist = SS.geth5names(dirname=source)
-    lat, lon = SS.getGeoLimits(flist = flist)
+    catalog = SC.StackCatalog(catalog or os.path.join(source, SC.CATALOG_NAME))
+    lat, lon = SS.getGeoLimits(flist = flist, catalog=catalog)
 
     dname = createDem(lat=lat, lon=lon, target=target, buffer=buffer)
     return dname
@@ -87,6 +91,8 @@ def parse():
             help='target directory in which the DEM is downloaded to.', type=str)
     parser.add_argument('-buffer', action='store', default=0.05, dest='buffer',
             help='Padding around the bbox of image obtained from metadata')
+    parser.add_argument('-catalog', action='store', default=None, dest='catalog',
+            help='Stack metadata catalog. Default: stackCatalog.json in srcDir.', type=str)
     inps = parser.parse_args()
 
     return inps
@@ -96,5 +102,5 @@ if __name__ == '__main__':
     Create the required DEM.
     '''
     inps = parse()
-    constructDem(source=inps.srcDir, target=inps.tarDir, buffer=inps.buffer)
+    constructDem(source=inps.srcDir, target=inps.tarDir, buffer=inps.buffer, catalog=inps.catalog)
 
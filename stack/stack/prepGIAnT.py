@@ -3,11 +3,35 @@
 import os 
 import sys
 import numpy as np
-import lxml.objectify as OB
 import stackSetup as SS
 import templateSetup as temp
 import shutil
 import argparse
+import json
+import multiprocessing
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+####Fields harvested from insarProc.xml as paths below the root element.
+####Like lxml.objectify attribute access, the first matching element is used.
+XML_FIELDS = ['baseline/perp_baseline_top',
+              'baseline/perp_baseline_bottom',
+              'runGeocode/outputs/GEO_WIDTH',
+              'runGeocode/outputs/GEO_LENGTH',
+              'runGeocode/outputs/MINIMUM_GEO_LATITUDE',
+              'runGeocode/outputs/MAXIMUM_GEO_LATITUDE',
+              'runGeocode/outputs/MINIMUM_GEO_LONGITUDE',
+              'runGeocode/outputs/MAXIMUM_GEO_LONGITUDE',
+              'runGeocode/inputs/PEG_HEADING',
+              'runGeocode/inputs/RADAR_WAVELENGTH',
+              'runFormSLC/master/outputs/STARTING_RANGE',
+              'runFormSLC/master/inputs/SPACECRAFT_HEIGHT',
+              'runFormSLC/master/inputs/PLANET_LOCAL_RADIUS',
+              'master/frame/SENSING_MID']
+
+CACHE_FILE = '.insarProc_cache.json'
 
 def Seconds(instr):
     vals = instr.split(':')
@@ -24,6 +48,90 @@ def getIncAngle(rng, ht, re):
     cosang = ((rng*rng) + (re*re) - (sat*sat))/(2.0*rng*re)
     return np.degrees(np.arccos(cosang)) - 90.0
 
+def harvestXML(xmlFile, fields=XML_FIELDS):
+    '''
+    Extract the text of the fields from an insarProc.xml with a streaming parser.
+    Elements are discarded as soon as they are closed and parsing stops once all
+    fields are found. Missing fields are not in the returned dict.
+    '''
+    wanted = set(fields)
+    seen = set()
+    out = {}
+    path = []
+
+    context = ET.iterparse(xmlFile, events=('start', 'end'))
+    for event, elem in context:
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+
+        key = '/'.join(path[1:])
+        path.pop()
+
+        ####Only the first element with a given path counts
+        if key not in seen:
+            seen.add(key)
+            if key in wanted:
+                out[key] = (elem.text or '').strip()
+                if len(out) == len(wanted):
+                    break
+        elem.clear()
+
+    return out
+
+
+def _harvestFile(xmlFile):
+    return xmlFile, harvestXML(xmlFile)
+
+
+def harvestStack(xmlFiles, cacheFile=None, nproc=None):
+    '''
+    Harvest the fields of many insarProc.xml files in parallel. Results are cached
+    in cacheFile keyed by absolute path and reused while the mtime is unchanged.
+    Returns a dict of file name to fields.
+    '''
+    cache = {}
+    if cacheFile and os.path.exists(cacheFile):
+        try:
+            with open(cacheFile, 'r') as fid:
+                cache = json.load(fid)
+        except ValueError:
+            cache = {}
+
+    out = {}
+    todo = []
+    for xmlFile in xmlFiles:
+        key = os.path.abspath(xmlFile)
+        rec = cache.get(key)
+        if (rec is not None) and (rec['mtime'] == os.path.getmtime(xmlFile)) and (rec['fields_list'] == XML_FIELDS):
+            out[xmlFile] = rec['fields']
+        else:
+            todo.append(xmlFile)
+
+    if len(todo) > 1 and nproc != 1:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            results = pool.map(_harvestFile, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_harvestFile(x) for x in todo]
+
+    for xmlFile, fields in results:
+        out[xmlFile] = fields
+        cache[os.path.abspath(xmlFile)] = {'mtime': os.path.getmtime(xmlFile),
+                                           'fields_list': XML_FIELDS,
+                                           'fields': fields}
+
+    if cacheFile and todo:
+        with open(cacheFile + '.tmp', 'w') as fid:
+            json.dump(cache, fid)
+        os.rename(cacheFile + '.tmp', cacheFile)
+
+    return out
+
+
 def parse():
     '''
     Command line parser.
@@ -41,6 +149,8 @@ def parse():
             dest='force', help='Force updating of input files for GIAnT.')
     parser.add_argument('-ref', action='store', required=True,
             help='2 Line text file with line number / pixel number in geocoded images  of reference region', dest='ref', type=str)
+    parser.add_argument('-nproc', action='store', default=None, dest='nproc',
+            help='Number of processes for reading insarProc.xml files.', type=int)
     inps = parser.parse_args()
     return inps
 
@@ -63,23 +173,28 @@ if __name__ == '__main__':
     else:
         pairs = SS.pairDirs_from_file(inps.ilist, base=inps.srcDir)
 
-    #Create ifg.list
+    #####Harvest insarProc.xml fields. Only the example is needed if ifg.list exists
     ifglist = os.path.join(inps.prepDir, 'ifg.list')
-    xObj = None
-    if (not os.path.exists(ifglist)) or inps.force:
+    writeList = (not os.path.exists(ifglist)) or inps.force
+    xmlFiles = [os.path.join(pair, 'insarProc.xml') for pair in pairs]
+    exampleXML = xmlFiles[-1] if writeList else xmlFiles[0]
+    meta = harvestStack(xmlFiles if writeList else [exampleXML],
+                        cacheFile=os.path.join(inps.prepDir, CACHE_FILE), nproc=inps.nproc)
+
+    #Create ifg.list
+    if writeList:
         fid = open(ifglist, 'w')
-        for pair in pairs:
+        for pair, xmlFile in zip(pairs, xmlFiles):
             dates=os.path.basename(pair).split('_')
             print pair
-            xmlFile = os.path.join(pair, 'insarProc.xml')
-            xObj = OB.fromstring(open(xmlFile,'r').read())
-            
+            fields = meta[xmlFile]
+
             try:
-                bTop = xObj.baseline.perp_baseline_top
-                bBot = xObj.baseline.perp_baseline_bottom
+                bTop = float(fields['baseline/perp_baseline_top'])
+                bBot = float(fields['baseline/perp_baseline_bottom'])
                 bPerp = 0.5*(bTop + bBot)
             except:
-                print "Pair %s processed with old version of ISCE"
+                print "Pair %s processed with old version of ISCE" % pair
                 print "Baseline not available in insarProc.xml"
                 bPerp = 0.0
 
@@ -90,34 +205,29 @@ if __name__ == '__main__':
         fid.close()
 
     #####Create example.rsc
-    if xObj is None:
-        exampleXML = os.path.join(pairs[0],'insarProc.xml')
-
-        fid = open(exampleXML,'r')
-        xObj = OB.fromstring(fid.read())
-        fid.close()
+    xObj = meta[exampleXML]
 
-    width = int(xObj.runGeocode.outputs.GEO_WIDTH)
-    length = int(xObj.runGeocode.outputs.GEO_LENGTH)
-    rng = float(xObj.runFormSLC.master.outputs.STARTING_RANGE)
-    ht = float(xObj.runFormSLC.master.inputs.SPACECRAFT_HEIGHT) 
-    re = float(xObj.runFormSLC.master.inputs.PLANET_LOCAL_RADIUS)
+    width = int(xObj['runGeocode/outputs/GEO_WIDTH'])
+    length = int(xObj['runGeocode/outputs/GEO_LENGTH'])
+    rng = float(xObj['runFormSLC/master/outputs/STARTING_RANGE'])
+    ht = float(xObj['runFormSLC/master/inputs/SPACECRAFT_HEIGHT'])
+    re = float(xObj['runFormSLC/master/inputs/PLANET_LOCAL_RADIUS'])
     inc = getIncAngle(rng, ht, re)
 
     rdict = {}
     rdict['width'] = width
     rdict['length'] = length
-    rdict['heading'] = float(xObj.runGeocode.inputs.PEG_HEADING) * 180.0 / np.pi        
-    rdict['wvl'] = float(xObj.runGeocode.inputs.RADAR_WAVELENGTH)
+    rdict['heading'] = float(xObj['runGeocode/inputs/PEG_HEADING']) * 180.0 / np.pi
+    rdict['wvl'] = float(xObj['runGeocode/inputs/RADAR_WAVELENGTH'])
     rdict['deltarg'] = 30.
     rdict['deltaaz'] = 30.
-    rdict['utc'] = Seconds(str(xObj.master.frame.SENSING_MID).split( ' ')[-1])
+    rdict['utc'] = Seconds(str(xObj['master/frame/SENSING_MID']).split( ' ')[-1])
 
     #####Get Lat / Lon information
-    maxLat = float(xObj.runGeocode.outputs.MINIMUM_GEO_LATITUDE) #Bug in ISCE
-    minLat = float(xObj.runGeocode.outputs.MAXIMUM_GEO_LATITUDE)
-    minLon = float(xObj.runGeocode.outputs.MINIMUM_GEO_LONGITUDE)
-    maxLon = float(xObj.runGeocode.outputs.MAXIMUM_GEO_LONGITUDE)
+    maxLat = float(xObj['runGeocode/outputs/MINIMUM_GEO_LATITUDE']) #Bug in ISCE
+    minLat = float(xObj['runGeocode/outputs/MAXIMUM_GEO_LATITUDE'])
+    minLon = float(xObj['runGeocode/outputs/MINIMUM_GEO_LONGITUDE'])
+    maxLon = float(xObj['runGeocode/outputs/MAXIMUM_GEO_LONGITUDE'])
 
     rscfile = os.path.join(inps.prepDir, 'example.rsc')
     if (not os.path.exists(rscfile)) or inps.force:
@@ -191,8 +301,8 @@ if __name__ == '__main__':
 
     ##########Create prepxml.py
     rdict = {}
-    rdict['width'] = int(xObj.runGeocode.outputs.GEO_WIDTH)
-    rdict['length'] = int(xObj.runGeocode.outputs.GEO_LENGTH)
+    rdict['width'] = width
+    rdict['length'] = length
     rdict['cohth'] = 0.2
     rdict['nvalid'] = int(0.5 * len(pairs))
     latlon = np.loadtxt(inps.ref)
@@ -31,13 +31,11 @@ def getDateFromh5(fname):
     datestr = g[0:8]
     return datestr
 
-def getBboxFromh5(fname):
-    '''Get the bounding box from a h5 file.'''
-
-    fid = h5py.File(fname, 'r')
+def getBboxFromHandle(fid, raw):
+    '''Get the bounding box from an open h5 file.'''
 
-    locs = numpy.zeros((4,3), dtype=numpy.float)
-    if isRaw(fname):
+    locs = numpy.zeros((4,3), dtype=numpy.float64)
+    if raw:
         locs[0,:] = fid.attrs['Estimated Bottom Left Geodetic Coordinates']
         locs[1,:] = fid.attrs['Estimated Bottom Right Geodetic Coordinates']
         locs[2,:] = fid.attrs['Estimated Top Right Geodetic Coordinates']
@@ -48,18 +46,27 @@ def getBboxFromh5(fname):
         locs[2,:] = fid['S01/SBI'].attrs['Top Right Geodetic Coordinates']
         locs[3,:] = fid['S01/SBI'].attrs['Top Left Geodetic Coordinates']
 
-    fid.close()
+    lat = [float(numpy.min(locs[:,0])), float(numpy.max(locs[:,0]))]
+    lon = [float(numpy.min(locs[:,1])), float(numpy.max(locs[:,1]))]
+    return lat, lon
 
-    lat = [numpy.min(locs[:,0]), numpy.max(locs[:,0])]
-    lon = [numpy.min(locs[:,1]), numpy.max(locs[:,1])]
+def getBboxFromh5(fname):
+    '''Get the bounding box from a h5 file.'''
+
+    fid = h5py.File(fname, 'r')
+    lat, lon = getBboxFromHandle(fid, isRaw(fname))
+    fid.close()
     return lat, lon
 
-def getGeoLimits(flist =None, dirname = '.'):
-    '''Get bbox from h5 files in a directory.'''
+def getGeoLimits(flist =None, dirname = '.', catalog=None):
+    '''Get bbox from h5 files in a directory. Uses the bboxes in a StackCatalog if given.'''
 
     if flist is None:
         flist = geth5names(dirname)
 
+    if catalog is not None:
+        return catalog.getGeoLimits(flist)
+
     latList = []
     lonList = []
     for kk in flist:
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+###Persistent catalog of per scene metadata for a stack of h5 files
+
+from __future__ import print_function
+import os
+import json
+import argparse
+import multiprocessing
+import h5py
+import sarSetup as SS
+
+CATALOG_NAME = 'stackCatalog.json'
+
+def scanScene(args):
+    '''
+    Read the metadata of one scene with a single HDF5 open. Orbit information
+    needs ISCE and is only read if requested.
+    '''
+    fname, raw, orbits = args
+    if orbits:
+        import insar_check as IC
+        rec = IC.scanScene(fname, raw)
+    else:
+        fid = h5py.File(fname, 'r')
+        lat, lon = SS.getBboxFromHandle(fid, raw)
+        fid.close()
+        rec = {'lat': lat, 'lon': lon}
+
+    rec['raw'] = raw
+    rec['date'] = SS.getDateFromh5(fname)
+    rec['mtime'] = os.path.getmtime(fname)
+    return os.path.abspath(fname), rec
+
+
+class StackCatalog(object):
+    '''
+    Scene metadata (bbox and orbit information for baselines) keyed by h5 file path.
+    Only new or modified scenes are scanned when the catalog is updated.
+    '''
+    def __init__(self, filename=CATALOG_NAME, nproc=None):
+        self.filename = filename
+        self.nproc = nproc
+        self.scenes = {}
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as fid:
+                self.scenes = json.load(fid)
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(self.filename + '.tmp', 'w') as fid:
+            json.dump(self.scenes, fid, indent=1, sort_keys=True)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def isCurrent(self, fname, orbits=False):
+        rec = self.scenes.get(os.path.abspath(fname))
+        if rec is None:
+            return False
+        if rec['mtime'] != os.path.getmtime(fname):
+            return False
+        return (not orbits) or ('orbit' in rec)
+
+    def update(self, fnames, raw=None, orbits=False):
+        '''
+        Scan the scenes that are not in the catalog or changed since, in parallel.
+        Returns the number of scenes scanned.
+        '''
+        jobs = []
+        for fname in fnames:
+            if not self.isCurrent(fname, orbits):
+                isRaw = SS.isRaw(fname) if raw is None else raw
+                jobs.append((fname, isRaw, orbits))
+
+        if len(jobs) == 0:
+            return 0
+
+        print('Scanning metadata of {0} new scenes'.format(len(jobs)))
+        if len(jobs) > 1 and self.nproc != 1:
+            pool = multiprocessing.Pool(self.nproc)
+            try:
+                results = pool.map(scanScene, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [scanScene(x) for x in jobs]
+
+        self.scenes.update(results)
+        self.save()
+        return len(jobs)
+
+    def get(self, fname):
+        return self.scenes[os.path.abspath(fname)]
+
+    def getBbox(self, fname):
+        rec = self.get(fname)
+        return rec['lat'], rec['lon']
+
+    def getGeoLimits(self, fnames):
+        '''
+        Bbox of a set of scenes.
+        '''
+        self.update(fnames)
+        latList = []
+        lonList = []
+        for fname in fnames:
+            lat, lon = self.getBbox(fname)
+            latList += lat
+            lonList += lon
+
+        return [min(latList), max(latList)], [min(lonList), max(lonList)]
+
+
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Build or update the metadata catalog of a stack of h5 files.')
+    parser.add_argument('-i', action='store', default='.', dest='srcDir',
+            help='Directory with h5 files organized as subdirs.', type=str)
+    parser.add_argument('-c', action='store', default=None, dest='catalog',
+            help='Catalog file. Default: stackCatalog.json in srcDir.', type=str)
+    parser.add_argument('-nproc', action='store', default=None, dest='nproc',
+            help='Number of processes for scanning.', type=int)
+    parser.add_argument('-noorbit', action='store_true', default=False, dest='noorbit',
+            help='Only read bounding boxes. Does not need ISCE.')
+    inps = parser.parse_args()
+    return inps
+
+
+if __name__ == '__main__':
+    inps = parse()
+    catalog = StackCatalog(inps.catalog or os.path.join(inps.srcDir, CATALOG_NAME), inps.nproc)
+
+    flist = []
+    for dirname in sorted(os.listdir(inps.srcDir)):
+        dname = os.path.join(inps.srcDir, dirname)
+        if os.path.isdir(dname) and dirname.startswith('2'):
+            flist += SS.geth5names(dname)
+
+    nscan = catalog.update(flist, orbits=not inps.noorbit)
+    print('Catalog {0}: {1} scenes, {2} scanned'.format(catalog.filename, len(catalog.scenes), nscan))
@@ -4,6 +4,7 @@ import numpy
 import sarSetup as SS
 import insarSetup as IS
 import insar_check as IC
+import stackCatalog as SC
 import os 
 import sys
 import argparse
@@ -37,6 +38,16 @@ class h5Stack(object):
         except:
             self.cThresh = 0.3
 
+        try:
+            self.catalog = params.catalog
+        except:
+            self.catalog = None
+
+        try:
+            self.nproc = params.nproc
+        except:
+            self.nproc = None
+
         if isinstance(flist,str):
             flist = [flist]
 
@@ -73,6 +84,8 @@ def prepIfgList(source='.', target='.', listfile=False, params=None):
             flist.append(ret[len(ret)//2])
 
     stackObj = h5Stack(flist, params=params)
+    if stackObj.catalog is None:
+        stackObj.catalog = os.path.join(source, SC.CATALOG_NAME)
     pairList = IC.process(stackObj)
 
     if listfile:
@@ -166,6 +179,10 @@ def parse():
             dest='cThresh', help='Coherence threshold', type=float)
     parser.add_argument('-plot', action='store_true', default=False,
             dest='plot', help='Show Baseline plot.')
+    parser.add_argument('-catalog', action='store', default=None, dest='catalog',
+            help='Stack metadata catalog. Default: stackCatalog.json in the h5 dir.', type=str)
+    parser.add_argument('-nproc', action='store', default=None, dest='nproc',
+            help='Number of processes for reading new scenes.', type=int)
     inps = parser.parse_args()
     return inps
 
@@ -2,10 +2,19 @@
 import json
 import argparse
 import os
-import shutil
-import sys
+import ssl
+import time
+import base64
+import hashlib
+import threading
+import urllib.request
+import urllib.error
+import http.client
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+MANIFEST_NAME = 'stage_manifest.json'
+
 def getUrlList(url, id, opt=True):
     '''
     Get URL list of files using webDAV.
@@ -29,49 +38,226 @@ def getUrlList(url, id, opt=True):
     
     return fList
 
-def download_file(url, path, user=None, pw=None):
+def md5sum(fname, blocksize=1<<22):
+    '''
+    md5 of a file read in blocks.
+    '''
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(blocksize), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def fileUrl(url, fname):
+    '''
+    URL of a product file, as curl -O url/file would fetch.
+    '''
+    return url.rstrip('/') + '/' + fname
+
+
+def fetchFile(url, path, user=None, pw=None, md5=None, retries=3, timeout=60, chunk=1<<20):
     '''
-    Download file for input.
+    Download url to path through path.part. An existing partial file is resumed
+    with a byte range request. The size is checked against the size reported by
+    the server and the md5 against md5 if given. Returns (size, md5) of the file.
+    '''
+    part = path + '.part'
+    headers = {}
+    if user is not None:
+        token = base64.b64encode('{0}:{1}'.format(user, pw).encode()).decode()
+        headers['Authorization'] = 'Basic ' + token
+
+    ####Same as curl -k
+    context = ssl._create_unverified_context()
+
+    lastError = None
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        req = urllib.request.Request(url, headers=headers)
+        if offset:
+            req.add_header('Range', 'bytes={0}-'.format(offset))
+
+        try:
+            resp = urllib.request.urlopen(req, timeout=timeout, context=context)
+        except urllib.error.HTTPError as err:
+            ####Range not satisfiable: the partial file is not a prefix of the remote file
+            if err.code == 416 and offset:
+                os.remove(part)
+            lastError = err
+            continue
+        except (urllib.error.URLError, OSError) as err:
+            lastError = err
+            time.sleep(min(2**attempt, 30))
+            continue
+
+        try:
+            if offset and resp.status == 206:
+                mode = 'ab'
+                total = int(resp.headers['Content-Range'].split('/')[-1])
+            else:
+                mode = 'wb'
+                length = resp.headers.get('Content-Length')
+                total = int(length) if length is not None else None
+
+            with open(part, mode) as fid:
+                for data in iter(lambda: resp.read(chunk), b''):
+                    fid.write(data)
+        except (OSError, ValueError, http.client.HTTPException) as err:
+            lastError = err
+            continue
+        finally:
+            resp.close()
+
+        size = os.path.getsize(part)
+        if (total is not None) and (size != total):
+            lastError = IOError('Incomplete transfer of {0}: {1} of {2} bytes'.format(url, size, total))
+            continue
+
+        digest = md5sum(part)
+        if (md5 is not None) and (digest != md5):
+            os.remove(part)
+            lastError = IOError('Checksum mismatch for {0}'.format(url))
+            continue
+
+        os.rename(part, path)
+        return size, digest
+
+    raise IOError('Unable to download {0}: {1}'.format(url, lastError))
+
+
+class StageManifest(object):
     '''
-    from utils.UrlUtils import UrlUtils
-    uu = UrlUtils()
-    return True if uu.download(url,path, user, pw) == 0 else False
+    Record of the staged files (url, size, md5) keyed by path relative to the
+    insar directory. Files in the manifest are not downloaded again.
     '''
-    session = requests.session()
-    session.auth = (user, pw)
-    request = session.get(url, stream=True, verify=False)
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.files = {}
+        if os.path.exists(fname):
+            with open(fname, 'r') as fid:
+                self.files = json.load(fid)
 
-    try:
-#        print 'Url: ', url
-#        print 'Path: ', path
-        val = request.raise_for_status()
-#        print 'Status: ', val
-        success = True
-    except:
-        success = False
+    def isComplete(self, key, path, verify=False):
+        rec = self.files.get(key)
+        if (rec is None) or (not os.path.exists(path)):
+            return False
+        if os.path.getsize(path) != rec['size']:
+            return False
+        return (not verify) or (md5sum(path) == rec['md5'])
 
-    if success:
-        with open(path,'wb') as f:
-            for chunk in request.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
+    def record(self, key, url, size, md5):
+        with self.lock:
+            self.files[key] = {'url': url, 'size': size, 'md5': md5}
+            with open(self.fname + '.tmp', 'w') as fid:
+                json.dump(self.files, fid, indent=2, sort_keys=True)
+            os.replace(self.fname + '.tmp', self.fname)
 
-    return success
+
+def stageInterferograms(listIfgs, insarDir, nproc=4, user=None, pw=None, retries=3, verify=False):
+    '''
+    Stage the interferograms with at most nproc concurrent transfers. Files of an
+    interferogram are downloaded into <dir>.partial which is renamed to <dir> once
+    all its files are staged. Returns the number of staged directories.
     '''
+    manifest = StageManifest(os.path.join(insarDir, MANIFEST_NAME))
+
+    ifgs = []
+    for index,elem in enumerate(listIfgs):
+        url = elem['url']
+        masterDate = datetime.strptime(elem['sensingStart'][0], "%Y-%m-%dT%H:%M:%S.%f")
+        slaveDate = datetime.strptime(elem['sensingStart'][1], "%Y-%m-%dT%H:%M:%S.%f")
+        dirName = masterDate.strftime('%Y%m%d')+'_'+slaveDate.strftime('%Y%m%d')
+        stageDir = os.path.join(insarDir, dirName)
+
+        if slaveDate > masterDate:
+            print('Skipping %s dir - Slave > Master'%(stageDir))
+            continue
+
+        files = [(fileUrl(uu, ff), ff) for uu, ff in getUrlList(url, elem['id'], opt=(index==0))]
+        md5s = elem.get('md5', {})
+        ifgs.append((dirName, stageDir, files, md5s))
+
+    ####Collect the transfers still to be done
+    jobs = []
+    done = {}
+    for dirName, stageDir, files, md5s in ifgs:
+        keys = [os.path.join(dirName, ff) for uu, ff in files]
+        if os.path.isdir(stageDir) and all(manifest.isComplete(kk, os.path.join(insarDir, kk), verify) for kk in keys):
+            print('Staging directory %s already complete.'%(stageDir))
+            done[dirName] = True
+            continue
+
+        workDir = stageDir + '.partial'
+        if os.path.isdir(stageDir) and not os.path.isdir(workDir):
+            os.rename(stageDir, workDir)
+        if not os.path.exists(workDir):
+            os.mkdir(workDir)
+
+        for (uu, ff), kk in zip(files, keys):
+            path = os.path.join(workDir, ff)
+            if not manifest.isComplete(kk, path, verify):
+                jobs.append((dirName, kk, uu, path, md5s.get(ff)))
+
+    print('Number of files to download: ', len(jobs))
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max(nproc, 1)) as pool:
+        futures = dict((pool.submit(fetchFile, uu, path, user, pw, md5, retries), (dirName, kk, uu))
+                       for dirName, kk, uu, path, md5 in jobs)
+        for fut in as_completed(futures):
+            dirName, kk, uu = futures[fut]
+            try:
+                size, digest = fut.result()
+                manifest.record(kk, uu, size, digest)
+            except Exception as err:
+                print('Unable to download: ', kk, err)
+                failed.add(dirName)
+
+    countSuccess = 0
+    for dirName, stageDir, files, md5s in ifgs:
+        if done.get(dirName):
+            countSuccess += 1
+        elif dirName in failed:
+            print('Incomplete directory kept for resume: ', stageDir + '.partial')
+        else:
+            workDir = stageDir + '.partial'
+            if os.path.isdir(stageDir):
+                for ff in os.listdir(workDir):
+                    os.replace(os.path.join(workDir, ff), os.path.join(stageDir, ff))
+                os.rmdir(workDir)
+            else:
+                os.rename(workDir, stageDir)
+            countSuccess += 1
+
+    return countSuccess
+
+
 def parse():
     '''
     Command Line Parser.
     '''
     parser = argparse.ArgumentParser(description='Stages interferograms with information provided in a json file.')
-    parser.add_argument('--meta', dest='inlist', type=str, required=True,
+    parser.add_argument('meta', nargs='?', type=str, default=None,
+            help='Name of the json file with the list of interferograms.')
+    parser.add_argument('--meta', dest='inlist', type=str, required=False,
             help='Name of the json file with the list of interferograms.')
     parser.add_argument('--user', dest='user', type=str, required=False,
             help='JPL user name')
     parser.add_argument('--pw', dest='passwd', type=str, required=False,
             help='JPL password')
+    parser.add_argument('--nproc', dest='nproc', type=int, default=4,
+            help='Number of concurrent transfers')
+    parser.add_argument('--retries', dest='retries', type=int, default=3,
+            help='Number of resumed retries per file')
+    parser.add_argument('--verify', dest='verify', action='store_true', default=False,
+            help='Verify checksums of files already in the manifest')
 
-    return parser.parse_args()
+    inps = parser.parse_args()
+    inps.inlist = inps.inlist or inps.meta
+    if inps.inlist is None:
+        parser.error('json file with the list of interferograms required')
+    return inps
 
 
 if __name__ == '__main__':
@@ -80,10 +266,10 @@ if __name__ == '__main__':
     '''
 
     #Parse command line
-    #inps = parse()
+    inps = parse()
     
     #Parse input json
-    inObj = json.load(open(sys.argv[1]))
+    inObj = json.load(open(inps.inlist))
 
     print('Number of interferograms to stage: ', len(inObj))
     listIfgs = inObj
@@ -98,45 +284,17 @@ if __name__ == '__main__':
     else:
         print('insar Directory %s already exists.'%(insarDir))
 
-    countSuccess = 0
-
-    ###Loop over dirs
-    for index,elem in enumerate(listIfgs):
-        print('Staging interferogram: ', index+1)
-        url = elem['url']
-        id = elem['id']
-        masterDate = datetime.strptime(elem['sensingStart'][0], "%Y-%m-%dT%H:%M:%S.%f")
-        slaveDate = datetime.strptime(elem['sensingStart'][1], "%Y-%m-%dT%H:%M:%S.%f")
-        dirList = getUrlList(url, id, opt= (index==0))
-        stageDir = os.path.join(insarDir, masterDate.strftime('%Y%m%d')+'_'+slaveDate.strftime('%Y%m%d'))
-
-        if slaveDate > masterDate:
-            print('Skipping %s dir - Slave > Master'%(stageDir))
-            continue
-        
-        print('Staging data in directory: %s'%(stageDir))
-
-
-        if not os.path.exists(stageDir):
-            os.mkdir(stageDir)
-        else:
-            print('Staging directory %s already exists.'%(stageDir))
-
-        success = True
-        os.chdir(stageDir)
-        for url,file in dirList:
-            success = (success and download_file(url,file))
-            if not success:
-                print('Unable to download: ', file)
-                break
-
-        os.chdir(currDir)
-        if not success:
-            print('Removing directory: ', stageDir)
-            shutil.rmtree(stageDir)
-        else:
-            countSuccess += 1
+    ####Default to the DAV credentials of the ARIA configuration
+    user, pw = inps.user, inps.passwd
+    if user is None:
+        try:
+            from utils.UrlUtils import UrlUtils
+            uu = UrlUtils()
+            user, pw = uu.dav_u, uu.dav_p
+        except ImportError:
+            pass
 
-        os.chdir(currDir)
+    countSuccess = stageInterferograms(listIfgs, insarDir, inps.nproc, user, pw,
+                                       inps.retries, inps.verify)
 
     print('Number of directories successfully staged: ', countSuccess)
@@ -6,9 +6,9 @@ import sys
 import logging
 import lxml.objectify as OB
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 from collections import OrderedDict
 import cPickle
+from utils.isce_raster import RasterImage, get_image_info
 
 
 errorCodes = {
@@ -23,99 +23,11 @@ errorCodes = {
 
 
 ##########Classes and utils for memory maps
-class memmap(object):
-    '''Create the memap object.'''
+class memmap(RasterImage):
+    '''Create the memap object. Bands are zero-copy views from utils.isce_raster.'''
     def __init__(self,fname, mode='readonly', nchannels=1, nxx=None, nyy=None, scheme='BSQ', dataType='f'):
         '''Init function.'''
-
-        fsize = np.zeros(1, dtype=dataType).itemsize
-
-        if nxx is None:
-            raise ValueError('Undefined file width for : %s'%(fname))
-
-        if mode=='write':
-            if nyy is None:
-                raise ValueError('Undefined file length for opening file: %s in write mode.'%(fname))
-        else:
-            try:
-                nbytes = os.path.getsize(fname)
-            except:
-                raise ValueError('Non-existent file : %s'%(fname))
-
-            if nyy is None:
-                nyy = nbytes/(fsize*nchannels*nxx)
-
-                if (nxx*nyy*fsize*nchannels) != nbytes:
-                    raise ValueError('File size mismatch for %s. Fractional number of lines'(fname))
-            elif (nxx*nyy*fsize*nchannels) > nbytes:
-                    raise ValueError('File size mismatch for %s. Number of bytes expected: %d'%(nbytes))
-             
-
-        self.name = fname
-        self.width = nxx
-        self.length = nyy
-
-        ####List of memmap objects
-        acc = []
-
-        ####Create the memmap for the full file
-        nshape = nchannels*nyy*nxx
-        omap = np.memmap(fname, dtype=dataType, mode=mode, 
-                shape = (nshape,))
-
-        if scheme.upper() == 'BIL':
-            nstrides = (nchannels*nxx*fsize, fsize)
-
-            for band in range(nchannels):
-                ###Starting offset
-                noffset = band*nxx
-
-                ###Temporary view
-                tmap = omap[noffset:]
-
-                ####Trick it into creating a 2D array
-                fmap = as_strided(tmap, shape=(nyy,nxx), strides=nstrides)
-
-                ###Add to list of objects
-                acc.append(fmap)
-
-        elif scheme.upper() == 'BSQ':
-            nstrides = (fsize, fsize)
-
-            for band in range(nchannels):
-                ###Starting offset
-                noffset = band*nxx*nyy
-
-                ###Temporary view
-                tmap = omap[noffset:noffset+nxx*nyy]
-
-                ####Reshape into 2D array
-                fmap = as_strided(tmap, shape=(nyy,nxx))
-
-                ###Add to lits of objects
-                acc.append(fmap)
-
-        elif scheme.upper() == 'BIP':
-            nstrides = (nchannels*nxx*fsize,nchannels*fsize)
-
-            for band in range(nchannels):
-                ####Starting offset
-                noffset = band
-
-                ####Temporary view
-                tmap = omap[noffset:]
-
-                ####Trick it into interpreting ot as a 2D array
-                fmap = as_strided(tmap, shape=(nyy,nxx), strides=nstrides)
-
-                ####Add to the list of objects
-                acc.append(fmap)
-
-        else:
-            raise ValueError('Unknown file scheme: %s for file %s'%(scheme,fname))
-
-        ######Assigning list of objects to self.bands
-        self.bands = acc
+        RasterImage.__init__(self, fname, nxx, nyy, nchannels, scheme, dataType, mode)
 
 
 
@@ -207,19 +119,10 @@ def createMemmap(filename, datatype='f'):
     Create a memmap from ISCE file.
     '''
 
-    if filename.endswith('.xml'):
-        xmlfile = filename
-        datafile = os.path.splitext(filename)[0]
-    else:
-        datafile = filename 
-        xmlfile = filename + '.xml'
-
-
-    rdict = getImageData(xmlfile)
-    mObj = memmap(datafile, nchannels= int(rdict['NUMBER_BANDS']),
-                  nxx = int(rdict['WIDTH']), nyy=int(rdict['LENGTH']),
-                  scheme = rdict['SCHEME'], dataType = datatype)
+    info = get_image_info(filename)
+    mObj = memmap(info['filename'], nchannels=info['bands'],
+                  nxx=info['width'], nyy=info['length'],
+                  scheme=info['scheme'], dataType=datatype)
 
 
     return mObj
-
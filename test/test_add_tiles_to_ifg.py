@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'map_tiler'))
+try:
+    from add_tiles_to_ifg import backfill, Ledger
+except ImportError:
+    backfill = None
+
+
+class ScrollHandler(BaseHTTPRequestHandler):
+    '''
+    Serves server.hits in pages of the requested size through the scroll API.
+    '''
+    def log_message(self, *args):
+        pass
+
+    def reply(self, start, size):
+        hits = self.server.hits[start:start+size]
+        self.server.pages.append(len(hits))
+        body = json.dumps({'_scroll_id': '{0}:{1}'.format(start + size, size),
+                           'hits': {'total': len(self.server.hits), 'hits': hits}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        self.server.scrolls.append(self.path.split('scroll=')[1].split('&')[0])
+        if self.path.startswith('/ifgs/_search'):
+            self.reply(0, int(self.path.split('size=')[1]))
+        else:
+            start, size = body.split(':')
+            self.reply(int(start), int(size))
+
+    def do_DELETE(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.cleared = True
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+@unittest.skipIf(backfill is None, 'requests is not available')
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ScrollHandler)
+        self.server.hits = [{'_id': 'prod{0}'.format(ii), '_index': 'ifgs',
+                             '_source': {'metadata': {'tiles': ii == 3}}} for ii in range(11)]
+        self.server.pages = []
+        self.server.scrolls = []
+        self.server.cleared = False
+        self.es_url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.ledger_file = os.path.join(self.tmpdir, 'ledger.json')
+        self.lock = threading.Lock()
+        self.active = [0, 0]
+        self.processed = []
+        self.fail = set(['prod5'])
+        self.pages_before = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def process(self, es_url, hit, work_root, nproc):
+        with self.lock:
+            if self.pages_before is None:
+                self.pages_before = (list(self.server.pages), self.server.cleared)
+            self.active[0] += 1
+            self.active[1] = max(self.active)
+            self.processed.append(hit['_id'])
+        time.sleep(0.02)
+        with self.lock: self.active[0] -= 1
+        if hit['_id'] in self.fail:
+            raise RuntimeError('tiling failed')
+
+    def test_backfill_and_resume(self):
+        Ledger(self.ledger_file).record('prod0', 'done', 1.)
+        result = backfill(self.es_url, 'ifgs', workers=3, page_size=4, ledger_file=self.ledger_file,
+                          work_root=self.tmpdir, process=self.process)
+
+        ####Already tiled products are skipped, all pages are fetched and the scroll cleared
+        ####before tiling starts
+        self.assertEqual(result, (8, 1, 2))
+        self.assertEqual(sorted(self.processed), sorted('prod{0}'.format(ii) for ii in range(1, 11) if ii != 3))
+        self.assertEqual(self.server.pages, [4, 4, 3, 0])
+        self.assertEqual(self.pages_before, ([4, 4, 3, 0], True))
+        self.assertEqual(set(self.server.scrolls), set(['60m']))
+        self.assertEqual(self.active[1], 3)
+
+        ledger = Ledger(self.ledger_file)
+        self.assertEqual(ledger.products['prod5']['status'], 'failed')
+        self.assertEqual(ledger.products['prod5']['error'], 'tiling failed')
+        self.assertEqual(sum(rec['status'] == 'done' for rec in ledger.products.values()), 9)
+
+        ####A rerun only retries the failed product, unless failures are skipped
+        self.processed = []
+        self.server.scrolls = []
+        self.assertEqual(backfill(self.es_url, 'ifgs', workers=3, page_size=4, ledger_file=self.ledger_file,
+                                  work_root=self.tmpdir, retry_failed=False, process=self.process,
+                                  scroll='5m'), (0, 0, 11))
+        self.assertEqual(self.processed, [])
+        self.assertEqual(set(self.server.scrolls), set(['5m']))
+
+        self.fail = set()
+        self.assertEqual(backfill(self.es_url, 'ifgs', workers=3, page_size=4, ledger_file=self.ledger_file,
+                                  work_root=self.tmpdir, process=self.process), (1, 0, 10))
+        self.assertEqual(self.processed, ['prod5'])
+        self.assertTrue(Ledger(self.ledger_file).is_done('prod5'))
+
+
+if __name__ == '__main__':
+    unittest.main()
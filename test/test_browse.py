@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.browse import render_browse, read_png, write_png, write_kmz, image_snwe
+
+XML_TMPL = """<imageFile>
+    <property name="data_type"><value>FLOAT</value></property>
+    <property name="file_name"><value>{fname}</value></property>
+    <property name="number_bands"><value>2</value></property>
+    <property name="scheme"><value>BIL</value></property>
+    <component name="coordinate1">
+        <property name="size"><value>{width}</value></property>
+        <property name="startingvalue"><value>-118.5</value></property>
+        <property name="delta"><value>0.01</value></property>
+    </component>
+    <component name="coordinate2">
+        <property name="size"><value>{length}</value></property>
+        <property name="startingvalue"><value>35.0</value></property>
+        <property name="delta"><value>-0.005</value></property>
+    </component>
+    <property name="width"><value>{width}</value></property>
+    <property name="length"><value>{length}</value></property>
+</imageFile>
+"""
+
+PI = np.pi
+
+####Amplitude and phase of a 2 x 6 raster. The valid amplitudes average 4, so the
+####amplitude scale is 8 and the brightness sqrt(amp / 8) is 1 for 8, 0.5 for 2
+####and 0.7071 for 4.
+AMP = [[8., 8., 8., 2., 2., 0.],
+       [2., 2., 2., 2., 4., 0.]]
+PHASE = [[0., 2*PI/3, 4*PI/3, PI/3, PI, 4*PI/3],
+         [5*PI/3, -PI/3, 2*PI + 2*PI/3, 0., 4*PI/3, PI/2]]
+
+####Expected RGBA at a 2 pi wrap. The cmy colormap is cyan at 0, magenta at 1/3,
+####yellow at 2/3 of the wrap and linear in between. Zero amplitude is transparent,
+####except in phase only renderings where zero phase is.
+EXPECTED = {
+    'rmg': [[(0, 255, 255, 255), (255, 0, 255, 255), (255, 255, 0, 255),
+             (64, 64, 128, 255), (128, 64, 64, 255), (0, 0, 0, 0)],
+            [(64, 128, 64, 255), (64, 128, 64, 255), (128, 0, 128, 255),
+             (0, 128, 128, 255), (180, 180, 0, 255), (0, 0, 0, 0)]],
+    'amp': [[(255, 255, 255, 255)] * 3 + [(128, 128, 128, 255)] * 2 + [(0, 0, 0, 0)],
+            [(128, 128, 128, 255)] * 4 + [(180, 180, 180, 255), (0, 0, 0, 0)]],
+    'phase': [[(0, 0, 0, 0), (255, 0, 255, 255), (255, 255, 0, 255),
+               (128, 128, 255, 255), (255, 128, 128, 255), (255, 255, 0, 255)],
+              [(128, 255, 128, 255), (128, 255, 128, 255), (255, 0, 255, 255),
+               (0, 0, 0, 0), (255, 255, 0, 255), (191, 64, 255, 255)]],
+}
+
+
+class TestBrowse(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_image(self, amp, phase):
+        amp = np.array(amp, dtype=np.float32)
+        phase = np.array(phase, dtype=np.float32)
+        fname = os.path.join(self.tmpdir, 'filt_topophase.unw.geo')
+        np.stack([amp, phase], axis=1).tofile(fname)
+        with open(fname + '.xml', 'w') as f:
+            f.write(XML_TMPL.format(fname=fname, width=amp.shape[1], length=amp.shape[0]))
+        return fname
+
+    def assertImage(self, png, expected):
+        img = read_png(png).astype(int)
+        expected = np.array(expected)
+        self.assertEqual(img.shape, expected.shape)
+        self.assertTrue(np.all(np.abs(img - expected) <= 1), '%s:\n%s' % (png, img))
+
+    def test_render_browse(self):
+        fname = self.write_image(AMP, PHASE)
+        items = [('unw', 'rmg', 2*PI), ('amp', 'amp', None), ('ph_only', 'phase', 2*PI),
+                 ('unw_3pi', 'rmg', 3*PI)]
+        ####One row per strip of the full size images
+        pngs = render_browse(fname, items, self.tmpdir, full=['unw', 'amp', 'ph_only'],
+                             max_width=3, max_width_small=2, strip_rows=1)
+        self.assertEqual(pngs, [os.path.join(self.tmpdir, n + '.png') for n in ('unw', 'amp', 'ph_only')])
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'unw_3pi.png')))
+        for name, kind, wrap in items[:3]:
+            self.assertImage(os.path.join(self.tmpdir, name + '.png'), EXPECTED[kind])
+
+        ####Browse and small images average 2 and 3 columns (of the 2 rows), each band ignoring
+        ####its zeros. E.g. the first browse block has amplitude 5 (brightness 0.7906) and phase
+        ####2 pi/3 (magenta); the first small block amplitude 5 and phase 6 pi/5 (magenta to
+        ####yellow at 0.8, (1, 0.8, 0.2))
+        self.assertImage(os.path.join(self.tmpdir, 'unw.browse.png'),
+                         [[(202, 0, 202, 255), (141, 169, 28, 255), (156, 88, 68, 255)]])
+        self.assertImage(os.path.join(self.tmpdir, 'unw.browse_small.png'),
+                         [[(202, 161, 40, 255), (143, 50, 93, 255)]])
+
+    def test_png_and_kmz(self):
+        img = (np.arange(5 * 4 * 3) % 256).astype(np.uint8).reshape(5, 4, 3)
+        png = write_png(os.path.join(self.tmpdir, 'rgb.png'), img)
+        self.assertTrue(np.array_equal(read_png(png), img))
+
+        snwe = image_snwe(self.write_image(AMP, PHASE))
+        self.assertTrue(np.allclose(snwe, [35.0 - 0.005 * 2, 35.0, -118.5, -118.5 + 0.01 * 6]))
+        kmz = write_kmz(os.path.join(self.tmpdir, 'prod.kmz'), png, snwe, 'prod')
+        with zipfile.ZipFile(kmz) as z:
+            self.assertEqual(sorted(z.namelist()), ['prod.kml', 'rgb.png'])
+            kml = z.read('prod.kml').decode()
+        self.assertIn('<href>rgb.png</href>', kml)
+        self.assertIn('<north>35.0</north>', kml)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'prod.kml')))
+
+
+if __name__ == '__main__':
+    unittest.main()
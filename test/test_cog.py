@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.cog import average_levels, overview_size, raw_vrt, write_cog
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+
+def block_mean(data, level, nodata):
+    '''
+    Reference nodata aware block average.
+    '''
+    out = np.zeros((overview_size(data.shape[0], level), overview_size(data.shape[1], level)))
+    for ii in range(out.shape[0]):
+        for jj in range(out.shape[1]):
+            blk = data[ii*level:(ii+1)*level, jj*level:(jj+1)*level]
+            val = blk[(blk != nodata) & ~np.isnan(blk)]
+            out[ii, jj] = val.mean() if val.size else nodata
+    return out
+
+
+class TestCOG(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.data = rng.randn(75, 53).astype(np.float32)
+        self.data[rng.rand(*self.data.shape) < 0.3] = 0
+        self.data[:20, :20] = 0
+        self.data[40, 7] = np.nan
+
+    def test_average_levels(self):
+        levels = (2, 4, 8, 16, 32)
+        out = average_levels(self.data, levels, nodata=0)
+        for level, avg in zip(levels, out):
+            self.assertEqual(avg.dtype, np.float32)
+            np.testing.assert_allclose(avg, block_mean(self.data, level, 0), rtol=1e-6, atol=1e-6)
+
+    def test_strips(self):
+        ####Strips that are multiples of the largest level give the same overviews
+        levels = (2, 4, 8)
+        full = average_levels(self.data, levels, nodata=0)
+        strips = [average_levels(self.data[r0:r0+16], levels, nodata=0) for r0 in range(0, 75, 16)]
+        for ii in range(len(levels)):
+            np.testing.assert_array_equal(np.concatenate([x[ii] for x in strips]), full[ii])
+
+    def test_raw_vrt(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            vrt = raw_vrt(os.path.join(tmpdir, 'a.vrt'), ['a.flt', 'b.flt'], 53, 75,
+                          (10., 0.1, 0., 20., 0., -0.1), nodata='nan', descriptions=['a', 'b'])
+            root = ET.parse(vrt).getroot()
+            bands = root.findall('VRTRasterBand')
+            self.assertEqual(len(bands), 2)
+            self.assertEqual(bands[1].find('LineOffset').text, str(4*53))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(gdal is None, 'GDAL not available')
+    def test_write_cog(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'a.flt')
+            data = np.tile(self.data, (8, 8))
+            data.tofile(fname)
+            geotrans = (10., 0.1, 0., 20., 0., -0.1)
+            vrt = raw_vrt(os.path.join(tmpdir, 'a.vrt'), [fname], data.shape[1], data.shape[0], geotrans)
+            levels = write_cog(vrt, os.path.join(tmpdir, 'a.tif'), nodata=0, blocksize=128)
+
+            ds = gdal.Open(os.path.join(tmpdir, 'a.tif'))
+            band = ds.GetRasterBand(1)
+            self.assertEqual(ds.GetGeoTransform(), geotrans)
+            self.assertEqual(band.GetNoDataValue(), 0)
+            np.testing.assert_array_equal(band.ReadAsArray(), data)
+            self.assertEqual(band.GetOverviewCount(), len(levels))
+            np.testing.assert_allclose(band.GetOverview(0).ReadAsArray(),
+                                       average_levels(data, (2,), 0)[0], rtol=1e-6)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
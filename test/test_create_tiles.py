@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'map_tiler'))
+from create_tiles import (tile_pyramid, tile_path, resolve_clims, colorize, lon_to_px, lat_to_py,
+                          px_to_lon, py_to_lat, TILE_SIZE)
+from get_clims import HistogramSketch
+from utils.browse import read_png
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
+
+class TestCreateTiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.length, self.width = 300, 400
+        yy, xx = np.mgrid[:self.length, :self.width]
+        self.amp = (10. + (xx + yy) % 50).astype(np.float32)
+        self.dis = (0.01 * xx - 0.02 * yy).astype(np.float32)
+        self.amp[:, :20] = 0
+        self.geotrans = (-118.0, 0.005, 0., 35.0, 0., -0.005)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def layers(self, name):
+        layers = [dict(output_dir=os.path.join(self.tmpdir, name, 'amplitude'), band=1, cmap='gray',
+                       clim_min=10, clim_max_pct=80, nodata=0),
+                  dict(output_dir=os.path.join(self.tmpdir, name, 'displacement'), band=2, cmap='gray',
+                       nodata=0)]
+        bands = {1: self.amp, 2: self.dis}
+        for layer in layers:
+            resolve_clims(HistogramSketch(nodata=0).update(bands[layer['band']]), layer)
+        return bands, layers
+
+    def test_mercator(self):
+        lon = np.array([-179.5, -118.2, 0., 45.3])
+        lat = np.array([-60.1, 0., 35.2, 80.])
+        self.assertTrue(np.allclose(px_to_lon(lon_to_px(lon, 7), 7), lon))
+        self.assertTrue(np.allclose(py_to_lat(lat_to_py(lat, 7), 7), lat))
+
+    @unittest.skipIf(matplotlib is None, 'matplotlib is not available')
+    def test_matplotlib_cmap(self):
+        ####viridis runs from dark purple to yellow; prism is the displacement layer colormap
+        data = np.array([[0., 0.5, 1., -9999.]])
+        rgba = colorize(data, 'viridis', 0., 1., nodata=-9999.)
+        self.assertEqual(tuple(rgba[0, 0]), (68, 1, 84, 255))
+        self.assertEqual(tuple(rgba[0, 2]), (253, 231, 37, 255))
+        self.assertEqual(tuple(rgba[0, 3]), (0, 0, 0, 0))
+        self.assertEqual(colorize(data, 'prism', 0., 1.).shape, (1, 4, 4))
+
+    def test_pyramid(self):
+        zoom = [4, 8]
+        bands, layers = self.layers('parallel')
+        count = tile_pyramid(bands, self.geotrans, layers, zoom, nproc=2)
+        self.assertGreater(count, 0)
+        amp = layers[0]
+        self.assertEqual(amp['clim_min'], 10.)
+        self.assertAlmostEqual(amp['clim_max'], np.percentile(self.amp[self.amp != 0], 80), 3)
+
+        ####A base tile pixel is the colorized nearest source sample
+        lon, lat = -117.3, 34.6
+        px, py = lon_to_px(lon, zoom[1]), lat_to_py(lat, zoom[1])
+        tx, ty = int(px // TILE_SIZE), 2 ** zoom[1] - 1 - int(py // TILE_SIZE)
+        j, i = int(px % TILE_SIZE), int(py % TILE_SIZE)
+        clon = px_to_lon(np.floor(px) + 0.5, zoom[1])
+        clat = py_to_lat(np.floor(py) + 0.5, zoom[1])
+        row = int((clat - self.geotrans[3]) // self.geotrans[5])
+        col = int((clon - self.geotrans[0]) // self.geotrans[1])
+        for layer, data in zip(layers, (self.amp, self.dis)):
+            tile = read_png(tile_path(layer['output_dir'], zoom[1], tx, ty))
+            frac = np.clip((data[row, col] - layer['clim_min']) / (layer['clim_max'] - layer['clim_min']), 0, 1)
+            self.assertEqual(tuple(tile[i, j]), (int(round(frac * 255)),) * 3 + (255,))
+
+        ####Nodata is transparent
+        px = lon_to_px(-117.95, zoom[1])
+        tx, j = int(px // TILE_SIZE), int(px % TILE_SIZE)
+        tile = read_png(tile_path(amp['output_dir'], zoom[1], tx, ty))
+        self.assertEqual(tile[i, j, 3], 0)
+
+        ####Overview pixels average the children, and all layers have a tile map resource
+        checked = 0
+        for layer in layers:
+            self.assertTrue(os.path.exists(os.path.join(layer['output_dir'], 'tilemapresource.xml')))
+            for z in range(zoom[0], zoom[1]):
+                for tx in os.listdir(os.path.join(layer['output_dir'], str(z))):
+                    for name in os.listdir(os.path.join(layer['output_dir'], str(z), tx)):
+                        ty = int(name[:-4])
+                        tile = read_png(tile_path(layer['output_dir'], z, int(tx), ty)).astype(int)
+                        child = tile_path(layer['output_dir'], z + 1, 2 * int(tx), 2 * ty + 1)
+                        if not os.path.exists(child): continue
+                        block = read_png(child)[:2, :2].reshape(4, 4).astype(float)
+                        alpha = block[:, 3].sum()
+                        rgb = (block[:, :3] * block[:, 3:]).sum(axis=0) / alpha if alpha else np.zeros(3)
+                        self.assertTrue(np.all(np.abs(tile[0, 0, :3] - rgb) <= 0.5))
+                        self.assertEqual(tile[0, 0, 3], round(alpha / 4.))
+                        checked += 1
+        self.assertGreater(checked, 0)
+
+        ####Serial and parallel pyramids are identical
+        bands, serial = self.layers('serial')
+        self.assertEqual(tile_pyramid(bands, self.geotrans, serial, zoom, nproc=1), count)
+        for layer, slayer in zip(layers, serial):
+            for root, dirs, files in os.walk(layer['output_dir']):
+                for name in files:
+                    path = os.path.join(root, name)
+                    spath = os.path.join(slayer['output_dir'], os.path.relpath(path, layer['output_dir']))
+                    with open(path, 'rb') as f, open(spath, 'rb') as g:
+                        self.assertEqual(f.read(), g.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'stack', 'stack'))
+from filtProcess import filterStack, FILTER_OUTPUTS, STAMP_FILE
+
+
+def boxcarPhaseSigma(insar, win=5):
+    '''
+    Stand-in for estPhaseSigma without ISCE. Boxcar coherence of the complex
+    interferogram written as a BIL phsig.cor with a minimal xml.
+    '''
+    width = insar.resampIntImage.width
+    ifg = np.fromfile(insar.topophaseFlatFilename, dtype=np.complex64).reshape((-1, width))
+    amp = np.abs(ifg)
+    phs = np.zeros(ifg.shape, dtype=np.complex64)
+    phs[amp > 0] = ifg[amp > 0] / amp[amp > 0]
+
+    #box sums via 2D cumulative sums
+    csum = np.zeros((ifg.shape[0]+1, width+1), dtype=np.complex128)
+    csum[1:, 1:] = np.cumsum(np.cumsum(phs, axis=0), axis=1)
+    r = np.arange(ifg.shape[0])
+    c = np.arange(width)
+    r0 = np.clip(r - win//2, 0, ifg.shape[0])[:, None]
+    r1 = np.clip(r + win//2 + 1, 0, ifg.shape[0])[:, None]
+    c0 = np.clip(c - win//2, 0, width)[None, :]
+    c1 = np.clip(c + win//2 + 1, 0, width)[None, :]
+    box = csum[r1, c1] - csum[r0, c1] - csum[r1, c0] + csum[r0, c0]
+    cor = (np.abs(box) / ((r1-r0)*(c1-c0))).astype(np.float32)
+
+    cor.tofile('phsig.cor')
+    with open('phsig.cor.xml', 'w') as fid:
+        fid.write('<imageFile><property name="width"><value>{0}</value></property>'
+                  '<property name="length"><value>{1}</value></property>'
+                  '<property name="data_type"><value>FLOAT</value></property>'
+                  '<property name="scheme"><value>BIL</value></property></imageFile>\n'.format(width, cor.shape[0]))
+
+
+def failingFilter(insar):
+    raise RuntimeError('filter failed')
+
+
+class SyntheticInsar(object):
+    '''
+    Minimal picklable stand-in for the insar object of a pair.
+    '''
+    class Image(object):
+        def __init__(self, width):
+            self.width = width
+
+    def __init__(self, width, flat='topophase.flat'):
+        self.resampIntImage = SyntheticInsar.Image(width)
+        self.topophaseFlatFilename = flat
+
+
+def createSyntheticStack(dirname, npairs, length=64, width=64):
+    '''
+    Synthetic pair dirs with the files the filter step reads.
+    '''
+    rng = np.random.RandomState(0)
+    yy, xx = np.mgrid[0:length, 0:width]
+    pairs = []
+    for ii in range(npairs):
+        pair = os.path.join(dirname, '2015{0:04d}_2016{0:04d}'.format(ii+1))
+        os.makedirs(os.path.join(pair, 'PICKLE'))
+        phs = 0.05*(ii+1)*xx + 0.02*yy + rng.randn(length, width)*(0.2 + 0.1*ii)
+        np.exp(1j*phs).astype(np.complex64).tofile(os.path.join(pair, 'topophase.flat'))
+        np.ones((length, 2*width), dtype=np.float32).tofile(os.path.join(pair, 'resampOnlyImage.amp'))
+        with open(os.path.join(pair, 'PICKLE', 'filter'), 'wb') as fid:
+            pickle.dump(SyntheticInsar(width), fid)
+        pairs.append(pair)
+    return pairs
+
+
+def counts(processed=0, skipped=0, failed=0):
+    return {'processed': processed, 'skipped': skipped, 'failed': failed}
+
+
+class TestFiltProcess(unittest.TestCase):
+    npairs = 4
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pairs = createSyntheticStack(self.tmpdir, self.npairs)
+        self.summary = os.path.join(self.tmpdir, 'summary.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_stack(self, force=False, filterFunc=boxcarPhaseSigma):
+        return filterStack(self.pairs, 2, force=force, filterFunc=filterFunc, summary=self.summary)
+
+    def test_first_run_and_summary(self):
+        res = self.run_stack()
+        self.assertEqual(res['counts'], counts(processed=self.npairs))
+        with open(self.summary) as fid:
+            summary = json.load(fid)
+        self.assertEqual(summary['counts'], res['counts'])
+        self.assertEqual(summary['nproc'], 2)
+        self.assertIsNone(summary['max_mem_gb'])
+        self.assertEqual([x['pair'] for x in summary['pairs']], sorted(self.pairs))
+        for rec in summary['pairs']:
+            self.assertEqual(rec['status'], 'processed')
+            self.assertIsNone(rec['error'])
+            for fname in FILTER_OUTPUTS + [STAMP_FILE]:
+                self.assertTrue(os.path.exists(os.path.join(rec['pair'], fname)))
+        cor = np.fromfile(os.path.join(self.pairs[0], 'phsig.cor'), dtype=np.float32)
+        self.assertTrue(np.all((cor >= 0) & (cor <= 1 + 1e-6)))
+
+    def test_rerun_skips(self):
+        self.run_stack()
+        self.assertEqual(self.run_stack()['counts'], counts(skipped=self.npairs))
+
+        #new mtimes with the same content, e.g. restaged inputs
+        for pair in self.pairs:
+            os.utime(os.path.join(pair, 'topophase.flat'), None)
+        self.assertEqual(self.run_stack()['counts'], counts(skipped=self.npairs))
+
+        #a changed input redoes only that pair
+        with open(os.path.join(self.pairs[0], 'resampOnlyImage.amp'), 'r+b') as fid:
+            fid.write(b'\0'*4)
+        res = self.run_stack()
+        self.assertEqual(res['counts'], counts(processed=1, skipped=self.npairs-1))
+        self.assertEqual(res['pairs'][0]['status'], 'processed')
+
+        self.assertEqual(self.run_stack(force=True)['counts'], counts(processed=self.npairs))
+
+    def test_failures_are_reported(self):
+        res = self.run_stack(filterFunc=failingFilter)
+        self.assertEqual(res['counts'], counts(failed=self.npairs))
+        with open(self.summary) as fid:
+            summary = json.load(fid)
+        for rec in summary['pairs']:
+            self.assertEqual(rec['error'], 'RuntimeError: filter failed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'map_tiler'))
+from get_clims import HistogramSketch
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+PCTS = [0, 0.1, 1, 5, 20, 50, 80, 95, 99, 99.9, 100]
+
+
+class TestHistogramSketch(unittest.TestCase):
+    def check(self, blocks, bins, nodata=None):
+        sketch = HistogramSketch(bins, nodata)
+        for block in blocks:
+            sketch.update(block)
+        data = np.concatenate([b.ravel() for b in blocks])
+        data = data[np.isfinite(data)]
+        if nodata is not None: data = data[data != nodata]
+
+        self.assertEqual(sketch.count, data.size)
+        self.assertEqual((sketch.min, sketch.max), (data.min(), data.max()))
+        span = data.max() - data.min()
+        self.assertLessEqual(sketch.error, 4 * span / (bins - 1) * (1 + 1e-9))
+        for q in PCTS:
+            exact = np.percentile(data, q)
+            self.assertLessEqual(abs(sketch.percentile(q) - exact), sketch.error * (1 + 1e-6),
+                                 'percentile %s' % q)
+        return sketch
+
+    def test_accuracy(self):
+        rng = np.random.RandomState(3)
+        for bins in (256, 2**16):
+            ####Range growing on both sides from block to block
+            blocks = [rng.normal(0, 0.1, (50, 200)), rng.normal(3, 1, (50, 200)),
+                      rng.lognormal(0, 2, (50, 200)), -rng.lognormal(1, 1, (50, 200))]
+            self.check(blocks, bins)
+
+            ####Nodata, NaN and inf are ignored, including a constant first block
+            blocks = [np.full((10, 100), 2.5), rng.uniform(-5, 5, (100, 100)).astype(np.float32)]
+            blocks[1][:20] = 0
+            blocks[1][30:40, :50] = np.nan
+            blocks[1][50, :2] = [np.inf, -np.inf]
+            self.check(blocks, bins, nodata=0)
+
+    def test_infinite(self):
+        ####Infinite values are not valid and do not grow the range
+        sketch = HistogramSketch(256).update([1., 2., 3.]).update([np.inf, -np.inf, np.nan, 4.])
+        self.assertEqual((sketch.count, sketch.min, sketch.max), (4, 1., 4.))
+        self.assertTrue(np.isfinite(sketch.error))
+        self.assertLessEqual(abs(sketch.percentile(50) - 2.5), sketch.error * (1 + 1e-6))
+        self.assertIsNone(HistogramSketch().update([np.inf]).percentile(50))
+
+    def test_empty(self):
+        sketch = HistogramSketch(nodata=0).update(np.zeros((5, 5)))
+        self.assertEqual(sketch.clims(20, 80), (None, None, None, None))
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class TestMaskDisplacement(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_windowed_mask(self):
+        from mask_displacement import translate
+        rng = np.random.RandomState(1)
+        amp = rng.uniform(0, 600, (150, 90)).astype(np.float32)
+        dis = rng.normal(0, 2, (150, 90)).astype(np.float32)
+        in_file = os.path.join(self.tmpdir, 'in.tif')
+        ds = gdal.GetDriverByName('GTiff').Create(in_file, 90, 150, 2, gdal.GDT_Float32)
+        ds.SetGeoTransform((-118., 0.01, 0., 35., 0., -0.01))
+        ds.GetRasterBand(1).WriteArray(amp)
+        ds.GetRasterBand(2).WriteArray(dis)
+        ds = None
+
+        out_file = os.path.join(self.tmpdir, 'out.tif')
+        stats = translate(in_file, out_file, 300, 0., block_rows=16)
+        masked = np.where(amp < 300, 0, dis)
+        self.assertTrue(np.array_equal(gdal.Open(out_file).ReadAsArray(), masked))
+        for q in (20, 80):
+            exact = np.percentile(masked[masked != 0], q)
+            self.assertLessEqual(abs(stats.percentile(q) - exact), stats.error * (1 + 1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()
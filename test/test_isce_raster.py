@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.isce_raster import ISCE_TYPES, open_image, create_image, tile_blocks, row_blocks
+
+XML_TMPL = """<imageFile>
+    <property name="data_type"><value>{dtype}</value></property>
+    <property name="file_name"><value>{fname}</value></property>
+    <property name="number_bands"><value>{bands}</value></property>
+    <property name="scheme"><value>{scheme}</value></property>
+    <component name="coordinate1">
+        <property name="size"><value>{width}</value></property>
+    </component>
+    <component name="coordinate2">
+        <property name="size"><value>{length}</value></property>
+    </component>
+    <property name="width"><value>{width}</value></property>
+    <property name="length"><value>{length}</value></property>
+</imageFile>
+"""
+
+
+def write_image(fname, data, scheme, isce_type):
+    '''
+    data is (bands, length, width). Write it interleaved as scheme with its xml.
+    '''
+    bands, length, width = data.shape
+    if scheme == 'BIL':
+        data.transpose(1, 0, 2).tofile(fname)
+    elif scheme == 'BIP':
+        data.transpose(1, 2, 0).tofile(fname)
+    else:
+        data.tofile(fname)
+    with open(fname + '.xml', 'w') as f:
+        f.write(XML_TMPL.format(dtype=isce_type, fname=fname, bands=bands,
+                                scheme=scheme, width=width, length=length))
+
+
+class TestIsceRaster(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_bands_all_schemes_and_types(self):
+        length, width, bands = 7, 5, 3
+        for scheme in ['BIL', 'BIP', 'BSQ']:
+            for isce_type, dtype in ISCE_TYPES.items():
+                vals = (np.arange(bands * length * width) % 100).reshape(bands, length, width)
+                if np.dtype(dtype).names:
+                    data = np.zeros(vals.shape, dtype)
+                    data['re'] = vals
+                    data['im'] = -vals
+                else:
+                    data = vals.astype(dtype)
+                fname = os.path.join(self.tmpdir, '%s_%s.img' % (scheme, isce_type))
+                write_image(fname, data, scheme, isce_type)
+                img = open_image(fname + '.xml')
+                self.assertEqual(img.shape, (length, width))
+                self.assertEqual(img.dtype, np.dtype(dtype))
+                for b in range(bands):
+                    np.testing.assert_array_equal(img.band(b), data[b])
+                    #views share the file buffer
+                    self.assertFalse(img.band(b).flags['OWNDATA'])
+
+    def test_write_through_band_view(self):
+        for scheme in ['BIL', 'BIP', 'BSQ']:
+            fname = os.path.join(self.tmpdir, 'out_' + scheme)
+            img = create_image(fname, 4, 3, 2, scheme, 'FLOAT')
+            img.band(1)[:] = 1.5
+            img.flush()
+            img = None
+            raw = np.fromfile(fname, np.float32)
+            self.assertEqual(raw.sum(), 1.5 * 12)
+
+    def test_complex_integer_pairs(self):
+        #literal interleaved I/Q samples, 2 rows of 2 pixels
+        for isce_type, itype in [('CBYTE', np.int8), ('CSHORT', np.int16)]:
+            fname = os.path.join(self.tmpdir, isce_type.lower())
+            np.array([1, -2, 3, -4, 5, -6, 7, -8], itype).tofile(fname)
+            with open(fname + '.xml', 'w') as f:
+                f.write(XML_TMPL.format(dtype=isce_type, fname=fname, bands=1, scheme='BIP', width=2, length=2))
+            band = open_image(fname).band(0)
+            np.testing.assert_array_equal(band['re'], [[1, 3], [5, 7]])
+            np.testing.assert_array_equal(band['im'], [[-2, -4], [-6, -8]])
+
+    def test_file_name_property(self):
+        #the data file is found next to the xml by its file_name, wherever it was written
+        data = np.arange(12, dtype=np.float32).reshape(1, 3, 4)
+        fname = os.path.join(self.tmpdir, 'data.flt')
+        data.tofile(fname)
+        with open(os.path.join(self.tmpdir, 'other.xml'), 'w') as f:
+            f.write(XML_TMPL.format(dtype='FLOAT', fname='/elsewhere/data.flt', bands=1,
+                                    scheme='BSQ', width=4, length=3))
+        img = open_image(os.path.join(self.tmpdir, 'other.xml'))
+        np.testing.assert_array_equal(img.band(0), data[0])
+
+    def test_size_mismatch(self):
+        fname = os.path.join(self.tmpdir, 'short')
+        np.zeros(10, np.float32).tofile(fname)
+        with open(fname + '.xml', 'w') as f:
+            f.write(XML_TMPL.format(dtype='FLOAT', fname=fname, bands=1, scheme='BIL', width=4, length=4))
+        self.assertRaises(ValueError, open_image, fname)
+
+    def test_blocks_cover_image_once(self):
+        length, width = 23, 17
+        for halo in [0, 2]:
+            count = np.zeros((length, width), int)
+            for win in tile_blocks(length, width, 5, 4, halo):
+                count[win.rows, win.cols] += 1
+                self.assertTrue(win.halo_rows.start <= win.rows.start)
+                self.assertTrue(win.halo_rows.stop >= win.rows.stop)
+            self.assertTrue(np.all(count == 1))
+
+    def test_halo_trim(self):
+        length, width = 10, 6
+        data = np.arange(length * width, dtype=np.float32).reshape(1, length, width)
+        fname = os.path.join(self.tmpdir, 'halo')
+        write_image(fname, data, 'BSQ', 'FLOAT')
+        img = open_image(fname)
+        out = np.zeros((length, width), np.float32)
+        for win, blk in img.blocks(3, halo=2):
+            self.assertEqual(blk.shape[1], width)
+            out[win.rows, win.cols] = win.trim(blk)
+        np.testing.assert_array_equal(out, data[0])
+        self.assertEqual(len(list(row_blocks(length, width, 3))), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'stack'))
+from landMask import (getLandWaterMask, getLandWaterMaskGMT, findGSHHS, gridNodes,
+                      GSHHS_HEADER)
+
+
+def findGSHHSorNone():
+    try:
+        return findGSHHS('f')
+    except IOError:
+        return None
+
+
+def writeGSHHS(fname, polys):
+    '''
+    Write (lon, lat, level) polygons as a GSHHG version 2 binary file.
+    '''
+    data = []
+    for ii, (lon, lat, level) in enumerate(polys):
+        hdr = np.zeros(GSHHS_HEADER, dtype=np.int64)
+        hdr[:7] = [ii, len(lon), level, min(lon)*1e6, max(lon)*1e6, min(lat)*1e6, max(lat)*1e6]
+        data.append(hdr)
+        data.append(np.round(np.column_stack([lon, lat])*1e6).astype(np.int64).ravel())
+    np.concatenate(data).astype('>i4').tofile(fname)
+
+
+def insideEvenOdd(polys, lat, lon):
+    '''
+    Point in polygon reference: parity of the crossings of a ray to the east by all polygons.
+    '''
+    yy, xx = np.meshgrid(lat, lon, indexing='ij')
+    inside = np.zeros(yy.shape, dtype=bool)
+    for plon, plat, level in polys:
+        for k in range(len(plon)):
+            x0, y0 = plon[k], plat[k]
+            x1, y1 = plon[(k+1) % len(plon)], plat[(k+1) % len(plon)]
+            if y0 == y1:
+                continue
+            cross = (np.minimum(y0, y1) <= yy) & (yy < np.maximum(y0, y1))
+            xc = x0 + (yy - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= cross & (xx <= xc)
+    return inside
+
+
+class TestLandMask(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.env = dict(os.environ)
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tmpdir)
+
+    def test_rasterize(self):
+        ####A land polygon with a lake holding an island, one polygon crossing the grid edge.
+        ####No vertex lies on a grid row, where the crossing rules may differ
+        t = np.linspace(0, 2*np.pi, 37)[:-1]
+        polys = [(-121.0337 + 0.61*np.cos(t), 37.5237 + 0.43*np.sin(t), 1),
+                 (-120.9737 + 0.23*np.cos(t), 37.4937 + 0.17*np.sin(t), 2),
+                 (-120.9337 + 0.07*np.cos(t), 37.4737 + 0.05*np.sin(t), 3),
+                 (np.array([-122.1337, -121.7137, -121.8737]), np.array([36.9137, 37.0337, 38.2737]), 1)]
+        fname = os.path.join(self.tmpdir, 'gshhs_f.b')
+        writeGSHHS(fname, polys)
+
+        snwe, shape = [37.0, 38.0, -122.0, -120.3], (101, 171)
+        outFile = os.path.join(self.tmpdir, 'mask.flt')
+        mask = getLandWaterMask(snwe, shape, outFile, gshhsFile=fname)
+        lat, lon = gridNodes(snwe, shape)
+        expected = insideEvenOdd(polys, lat, lon)
+
+        self.assertGreater(expected.sum(), 0)
+        self.assertTrue(np.array_equal(mask, expected.astype(np.float32)))
+        self.assertTrue(np.array_equal(np.fromfile(outFile, dtype=np.float32).reshape(shape), mask))
+
+    @unittest.skipIf(os.path.exists('/usr/share/gshhg-bin') or os.path.exists('/usr/local/share/gshhg-bin'),
+                     'a system GSHHG directory is installed')
+    def test_gmt_fallback(self):
+        ####Stand-in GMT executables on the PATH: grdlandmask records its arguments
+        ####and grd2xyz dumps a known grid
+        shape = (4, 5)
+        expected = np.arange(20, dtype=np.float32).reshape(shape) % 2
+        expected.tofile(os.path.join(self.tmpdir, 'grid.flt'))
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        scripts = {'grdlandmask': '#!/bin/sh\necho "$@" > {0}/args\nfor a in "$@"; do case $a in -G*) touch "${{a#-G}}";; esac; done\n',
+                   'grd2xyz': '#!/bin/sh\ncat {0}/grid.flt\n'}
+        for name, script in scripts.items():
+            with open(os.path.join(bindir, name), 'w') as f:
+                f.write(script.format(self.tmpdir))
+            os.chmod(os.path.join(bindir, name), stat.S_IRWXU)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['GSHHG_DIR'] = self.tmpdir
+
+        mask = getLandWaterMask([37.0, 38.0, -122.0, -121.0], shape, os.path.join(self.tmpdir, 'mask.flt'))
+        self.assertTrue(np.array_equal(mask, expected))
+        with open(os.path.join(self.tmpdir, 'args')) as f:
+            self.assertIn('-I5+/4+ -R-122.0/-121.0/37.0/38.0 -Df', f.read())
+        self.assertEqual([f for f in os.listdir(self.tmpdir) if f.endswith('.grd')], [])
+
+    @unittest.skipIf(shutil.which('grdlandmask') is None or findGSHHSorNone() is None,
+                     'GMT or the GSHHG binary files are not available')
+    def test_agrees_with_gmt(self):
+        ####San Francisco Bay: coast, bay and islands
+        snwe, shape = [37.4, 38.2, -122.7, -121.9], (241, 241)
+        mask = getLandWaterMask(snwe, shape, os.path.join(self.tmpdir, 'py.flt'), findGSHHSorNone())
+        gmt = getLandWaterMaskGMT(snwe, shape, os.path.join(self.tmpdir, 'gmt.flt'))
+        self.assertGreater(mask.sum(), 0)
+        self.assertLess(mask.sum(), mask.size)
+        self.assertGreaterEqual(np.mean(mask == gmt), 0.995)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'interferogram', 'sentinel'))
+from pge_steps import StepGraph, StepRegistry
+
+
+class TestStepGraph(unittest.TestCase):
+    def test_order_and_timings(self):
+        order = []
+        lock = threading.Lock()
+
+        def step(name, secs=0.):
+            def func():
+                time.sleep(secs)
+                with lock: order.append(name)
+            return func
+
+        graph = StepGraph(3)
+        graph.add('a', step('a', 0.05))
+        graph.add('b', step('b'))
+        graph.add('c', step('c'), ['a', 'b'])
+        graph.add('d', step('d'), ['c'])
+        times = graph.run()
+
+        self.assertEqual(sorted(times), ['a', 'b', 'c', 'd'])
+        self.assertEqual(order[2:], ['c', 'd'])
+        self.assertGreaterEqual(times['a'], 0.04)
+
+    def test_bounded_parallelism(self):
+        active = [0, 0]
+        lock = threading.Lock()
+
+        def func():
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.02)
+            with lock: active[0] -= 1
+
+        graph = StepGraph(2)
+        for ii in range(6):
+            graph.add('s{}'.format(ii), func)
+        graph.run()
+        self.assertEqual(active[1], 2)
+
+    def test_failure(self):
+        ran = []
+
+        def fail():
+            raise RuntimeError('step failed')
+
+        graph = StepGraph(2)
+        graph.add('a', fail)
+        graph.add('b', lambda: ran.append('b'), ['a'])
+        self.assertRaises(RuntimeError, graph.run)
+        self.assertEqual(ran, [])
+        self.assertRaises(ValueError, graph.add, 'c', fail, ['missing'])
+
+
+class TestStepRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.markers = os.path.join(self.tmpdir, '_pge_steps')
+        self.ran = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def step(self, name, fail=False):
+        out = os.path.join(self.tmpdir, name + '.out')
+        def func():
+            self.ran.append(name)
+            if fail: raise RuntimeError(name)
+            with open(out, 'w') as f: f.write(name)
+            return {'file': out}
+        return func, [out]
+
+    def run_job(self, params=1, fail=None):
+        registry = StepRegistry(self.markers)
+        for name in ['a', 'b']:
+            func, outputs = self.step(name, fail == name)
+            registry.run(name, func, outputs, params=params if name == 'a' else None)
+        graph = StepGraph(2, registry)
+        for name, deps in [('c', []), ('d', ['c'])]:
+            func, outputs = self.step(name, fail == name)
+            graph.add(name, func, deps, outputs)
+        graph.run()
+        return registry
+
+    def test_resume(self):
+        self.assertRaises(RuntimeError, self.run_job, fail='d')
+        self.assertEqual(self.ran, ['a', 'b', 'c', 'd'])
+
+        ####Retry restarts at the failed step
+        self.ran = []
+        registry = self.run_job()
+        self.assertEqual(self.ran, ['d'])
+        self.assertEqual(sorted(registry.timings), ['d'])
+        self.assertEqual(sorted(registry.skipped), ['a', 'b', 'c'])
+
+        ####Missing outputs or changed inputs rerun the step and everything after it
+        self.ran = []
+        os.unlink(os.path.join(self.tmpdir, 'b.out'))
+        self.run_job()
+        self.assertEqual(self.ran, ['b', 'c', 'd'])
+
+        self.ran = []
+        self.run_job(params=2)
+        self.assertEqual(self.ran, ['a', 'b', 'c', 'd'])
+
+    def test_inputs(self):
+        data = os.path.join(self.tmpdir, 'data.zip')
+        with open(data, 'w') as f: f.write('v1')
+
+        def unzip():
+            self.ran.append('unzip')
+            with open(data) as f, open(os.path.join(self.tmpdir, 'data.safe'), 'w') as g:
+                g.write(f.read())
+            os.unlink(data)
+
+        def run_job():
+            registry = StepRegistry(self.markers)
+            registry.run('unzip', unzip, [os.path.join(self.tmpdir, 'data.safe')], inputs=[data])
+            func, outputs = self.step('process')
+            registry.run('process', func, outputs, inputs=[os.path.join(self.tmpdir, 'data.safe')])
+
+        ####An input removed by its step does not rerun it
+        run_job()
+        run_job()
+        self.assertEqual(self.ran, ['unzip', 'process'])
+
+        ####A new input reruns the step and the steps reading its outputs
+        with open(data, 'w') as f: f.write('v2')
+        run_job()
+        self.assertEqual(self.ran, ['unzip', 'process'] * 2)
+
+        ####A changed input reruns the step
+        with open(os.path.join(self.tmpdir, 'data.safe'), 'w') as f: f.write('v3')
+        run_job()
+        self.assertEqual(self.ran, ['unzip', 'process'] * 2 + ['process'])
+
+    def test_result(self):
+        registry = StepRegistry(self.markers)
+        self.assertEqual(registry.run('x', lambda: {'th': 0.8})[0], {'th': 0.8})
+        registry = StepRegistry(self.markers)
+        result, secs, skipped = registry.run('x', lambda: {'th': 0.5})
+        self.assertTrue(skipped)
+        self.assertEqual(result, {'th': 0.8})
+
+
+if __name__ == '__main__':
+    unittest.main()
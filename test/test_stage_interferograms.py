@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stack.stageInterferograms import (stageInterferograms, fetchFile, getUrlList,
+                                       StageManifest, MANIFEST_NAME)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''
+    Serves server.files {path: bytes} with byte range support. Paths in
+    server.fail_once are cut off halfway through the first response.
+    '''
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if data is None:
+            self.send_error(404)
+            return
+
+        start = 0
+        rng = self.headers.get('Range')
+        if rng:
+            start = int(rng.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+
+        body = data[start:]
+        if self.path in self.server.fail_once:
+            self.server.fail_once.remove(self.path)
+            self.wfile.write(body[:len(body)//2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def ifgEntry(base, ii):
+    return {'url': base + '/prod{0}'.format(ii),
+            'id': 'prod{0}'.format(ii),
+            'sensingStart': ['2015-02-{0:02d}T00:00:00.0'.format(ii+10), '2015-01-{0:02d}T00:00:00.0'.format(ii+1)]}
+
+
+class TestStageInterferograms(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.files = {}
+        self.server.fail_once = set()
+        self.server.requests = []
+        self.base = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.ifgs = [ifgEntry(self.base, ii) for ii in range(3)]
+        for index, elem in enumerate(self.ifgs):
+            for url, fname in getUrlList(elem['url'], elem['id'], opt=(index==0)):
+                path = url[len(self.base):] + '/' + fname
+                self.server.files[path] = os.urandom(1000 + 37*len(self.server.files))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def checkStaged(self):
+        for index, elem in enumerate(self.ifgs):
+            dates = [x[:10].replace('-', '') for x in elem['sensingStart']]
+            stageDir = os.path.join(self.tmpdir, '_'.join(dates))
+            for url, fname in getUrlList(elem['url'], elem['id'], opt=(index==0)):
+                with open(os.path.join(stageDir, fname), 'rb') as fid:
+                    self.assertEqual(fid.read(), self.server.files[url[len(self.base):] + '/' + fname])
+
+    def test_resume_and_manifest(self):
+        path = '/prod0/insarProc.xml'
+        self.server.fail_once.add(path)
+        self.assertEqual(stageInterferograms(self.ifgs, self.tmpdir, nproc=4), 3)
+        self.checkStaged()
+
+        ####The interrupted file was resumed from where it stopped
+        ranges = [rng for pp, rng in self.server.requests if pp == path]
+        self.assertEqual(ranges[0], None)
+        self.assertTrue(ranges[1].startswith('bytes=') and ranges[1] != 'bytes=0-')
+
+        manifest = StageManifest(os.path.join(self.tmpdir, MANIFEST_NAME))
+        self.assertEqual(len(manifest.files), len(self.server.files))
+
+        ####Rerun skips everything
+        self.server.requests = []
+        self.assertEqual(stageInterferograms(self.ifgs, self.tmpdir, nproc=4), 3)
+        self.assertEqual(self.server.requests, [])
+
+    def test_failure_keeps_partial(self):
+        del self.server.files['/prod1/insarProc.xml']
+        self.assertEqual(stageInterferograms(self.ifgs, self.tmpdir, nproc=2, retries=0), 2)
+        partial = [x for x in os.listdir(self.tmpdir) if x.endswith('.partial')]
+        self.assertEqual(len(partial), 1)
+
+        ####Only the missing file is requested again once it is available
+        self.server.files['/prod1/insarProc.xml'] = b'x' * 100
+        self.server.requests = []
+        self.assertEqual(stageInterferograms(self.ifgs, self.tmpdir, nproc=2), 3)
+        self.assertEqual([pp for pp, rng in self.server.requests], ['/prod1/insarProc.xml'])
+        self.checkStaged()
+
+    def test_checksum(self):
+        path = '/prod2/browse.png'
+        out = os.path.join(self.tmpdir, 'browse.png')
+        good = hashlib.md5(self.server.files[path]).hexdigest()
+        self.assertEqual(fetchFile(self.base + path, out, md5=good)[1], good)
+        self.assertRaises(IOError, fetchFile, self.base + path, out, md5='0'*32, retries=1)
+        self.assertFalse(os.path.exists(out + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -492,7 +492,7 @@ def main(input_json_file):
     #Compute bounding polygon before 
     bound_polygon = None
     try:
-        bound_polygon = ts_common.get_bounding_polygon("./Slack/NSBAS-PARAMS.h5")
+        bound_polygon = ts_common.get_bounding_polygon("./Stack/NSBAS-PARAMS.h5")
     except Exception as e:
         logger.warn("Using less precise BBOX due to error. {0}.{1}".format(type(e),e))
     # move and compress HDF5 products
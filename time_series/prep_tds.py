@@ -18,6 +18,12 @@ logging.basicConfig(format=log_format, level=logging.INFO)
 logger = logging.getLogger('prep_tds')
 
 
+TS_DSETS = ("rawts", "recons", "error")
+UNIX_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+DEFAULT_BLOCK_MB = 256
+DEFAULT_TILE = 256
+
+
 def get_geocoded_coords(vrt_file):
     """Return geocoded coordinates of radar pixels."""
 
@@ -26,72 +32,95 @@ def get_geocoded_coords(vrt_file):
     gt = ds.GetGeoTransform()
     cols = ds.RasterXSize
     rows = ds.RasterYSize
-    lon_arr = list(range(0, cols))
-    lat_arr = list(range(0, rows))
-    lons = np.empty((cols,))
-    lats = np.empty((rows,))
-    #logger.info("lon_arr: %s" % lon_arr)
-    #logger.info("lat_arr: %s" % lat_arr)
-    for py in lat_arr:
-        lats[py] = gt[3] + (py * gt[5])
-    for px in lon_arr:
-        lons[px] = gt[0] + (px * gt[1])
+    lats = gt[3] + np.arange(rows, dtype=np.float64) * gt[5]
+    lons = gt[0] + np.arange(cols, dtype=np.float64) * gt[1]
     return lats, lons
 
 
-def prep_tds(aligned_vrt, h5_file):
-    """Add lat, lon, and time info for TDS compatibility."""
+def get_times(dates):
+    """Return seconds since the unix epoch for an array of date ordinals."""
+
+    return (np.asarray(dates).astype(np.int64) - UNIX_EPOCH_ORDINAL) * 86400.
+
+
+def copy_cube(src, dst, name, tile=DEFAULT_TILE, block_mb=DEFAULT_BLOCK_MB,
+              compression="gzip", compression_opts=4):
+    """Copy a (time, lat, lon) cube into dst with CF-friendly chunking,
+       streaming whole dates in blocks of at most block_mb megabytes."""
 
-    #logger.info(aligned_vrt)
-    #logger.info(h5_file)
+    cube = src[name]
+    ntimes, rows, cols = cube.shape
+    chunks = (1, min(tile, rows), min(tile, cols))
+    out = dst.create_dataset(name, cube.shape, cube.dtype, chunks=chunks,
+                             compression=compression,
+                             compression_opts=compression_opts, shuffle=True)
+    for k, v in cube.attrs.items():
+        if k not in ("DIMENSION_LIST", "REFERENCE_LIST"): out.attrs[k] = v
+    slab_bytes = rows * cols * cube.dtype.itemsize
+    step = max(1, int(block_mb * 1024 * 1024 // slab_bytes))
+    for t0 in range(0, ntimes, step):
+        t1 = min(t0 + step, ntimes)
+        out[t0:t1] = cube[t0:t1]
+    logger.info("Copied {} {} with chunks {} in blocks of {} dates.".format(
+                name, cube.shape, chunks, step))
+    return out
+
+
+def prep_tds(aligned_vrt, h5_file, tile=DEFAULT_TILE, block_mb=DEFAULT_BLOCK_MB):
+    """Add lat, lon, and time info for TDS compatibility.
+
+    The product is rewritten to a temporary file with chunked, compressed
+    cubes and then moved over h5_file.
+    """
 
     # get geocoded coordinates
     lats, lons = get_geocoded_coords(aligned_vrt)
-    #logger.info(lats)
-    #logger.info(lats.shape)
-    #logger.info(lons)
-    #logger.info(lons.shape)
-
-    #Open a file for append
-    h5f = h5py.File(h5_file, "r+")
-
-    #Calculate times from ordinals
-    dates = h5f.get("dates")
-    times = [int(datetime.fromordinal(int(item)).strftime("%s")) for item in dates]
-
-    #Create time, lat, and lon dataset
-    time = h5f.create_dataset("time",dates.shape, "d")
-    time[:] = times
-    lat = h5f.create_dataset("lat", lats.shape, "d")
-    lat[:] = lats
-    lon = h5f.create_dataset("lon", lons.shape, "d")
-    lon[:] = lons
-
-    #Create new dimension vars
-    dims = {}
-    time.attrs.create("axis", np.string_("T"))
-    time.attrs.create("units", np.string_("seconds since 1970-01-01 00:00:00 +0000"))
-    time.attrs.create("standard_name", np.string_("time"))
-    lat.attrs.create("help", np.string_("Latitude array"))
-    lon.attrs.create("help", np.string_("Longitude array"))
-
-    #Attach the new time dimension to the rawts and recons as scales
-    #In addition, attach lat and lon as scales
-    for dset_name in ["rawts", "recons", "error"]:
-        dset = h5f.get(dset_name)
-        if dset is None: continue
-        dset.dims.create_scale(time, "time")
-        dset.dims[0].attach_scale(time)
-        dset.dims.create_scale(lat, "lat")
-        dset.dims[1].attach_scale(lat)
-        dset.dims.create_scale(lon, "lon")
-        dset.dims[2].attach_scale(lon)
-
-        # add units attribute
-        dset.attrs.create("units", np.string_("mm"))
-
-    #Close file
-    h5f.close()
+
+    tmp_file = "{}.tds.tmp".format(h5_file)
+    try:
+        with h5py.File(h5_file, "r") as src, h5py.File(tmp_file, "w") as h5f:
+            for k, v in src.attrs.items(): h5f.attrs[k] = v
+
+            # copy everything but the cubes as is
+            for name in src:
+                if name in TS_DSETS or name in ("time", "lat", "lon"): continue
+                src.copy(name, h5f)
+
+            #Calculate times from ordinals
+            dates = h5f.get("dates")
+            times = get_times(dates[:])
+
+            #Create time, lat, and lon dataset
+            time = h5f.create_dataset("time", data=times, dtype="d")
+            lat = h5f.create_dataset("lat", data=lats, dtype="d")
+            lon = h5f.create_dataset("lon", data=lons, dtype="d")
+
+            #Create new dimension vars
+            time.attrs.create("axis", np.bytes_("T"))
+            time.attrs.create("units", np.bytes_("seconds since 1970-01-01 00:00:00 +0000"))
+            time.attrs.create("standard_name", np.bytes_("time"))
+            lat.attrs.create("help", np.bytes_("Latitude array"))
+            lon.attrs.create("help", np.bytes_("Longitude array"))
+
+            #Attach the new time dimension to the rawts and recons as scales
+            #In addition, attach lat and lon as scales
+            for dset_name in TS_DSETS:
+                if src.get(dset_name) is None: continue
+                dset = copy_cube(src, h5f, dset_name, tile, block_mb)
+                dset.dims.create_scale(time, "time")
+                dset.dims[0].attach_scale(time)
+                dset.dims.create_scale(lat, "lat")
+                dset.dims[1].attach_scale(lat)
+                dset.dims.create_scale(lon, "lon")
+                dset.dims[2].attach_scale(lon)
+
+                # add units attribute
+                dset.attrs.create("units", np.bytes_("mm"))
+
+        os.rename(tmp_file, h5_file)
+    finally:
+        # remove the partial rewrite on failure
+        if os.path.exists(tmp_file): os.unlink(tmp_file)
 
 
 if __name__ == "__main__":
@@ -103,8 +132,12 @@ if __name__ == "__main__":
     parser.add_argument("h5_file", nargs='?',
                         help="HDF5 GIAnT product file (default: NSBAS-PARAMS.h5)",
                         default="NSBAS-PARAMS.h5")
+    parser.add_argument("-t", "--tile", type=int, default=DEFAULT_TILE,
+                        help="lat/lon chunk size of the cubes (default: %(default)s)")
+    parser.add_argument("-b", "--block_mb", type=int, default=DEFAULT_BLOCK_MB,
+                        help="memory bound in MB for each block copy (default: %(default)s)")
     args = parser.parse_args()
-    try: prep_tds(args.aligned_vrt, args.h5_file)
+    try: prep_tds(args.aligned_vrt, args.h5_file, args.tile, args.block_mb)
     except Exception as e:
         with open('_alt_error.txt', 'w') as f:
             f.write("{}\n".format(e))
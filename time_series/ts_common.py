@@ -52,21 +52,45 @@ def get_envelope(product_dirs):
     return geom_col.GetEnvelope()
 
 
-def get_bounding_polygon(path):
+def get_valid_row_extents(data, block_rows=1024):
+    '''
+    Stream a 2D dataset in row blocks and return the rows containing valid
+    (non-NaN) data with their leftmost and rightmost valid columns.
+    @param data - 2D array-like (e.g. h5py dataset slice)
+    @param block_rows - number of rows read per block
+    '''
+    rows, cols = data.shape
+    row_idx, left, right = [], [], []
+    for r0 in range(0, rows, block_rows):
+        r1 = min(r0 + block_rows, rows)
+        valid = ~np.isnan(data[r0:r1])
+        has = valid.any(axis=1)
+        if not has.any(): continue
+        valid = valid[has]
+        row_idx.append(np.nonzero(has)[0] + r0)
+        left.append(valid.argmax(axis=1))
+        right.append(cols - 1 - valid[:, ::-1].argmax(axis=1))
+    if not row_idx:
+        raise RuntimeError("No valid pixels found.")
+    return np.concatenate(row_idx), np.concatenate(left), np.concatenate(right)
+
+
+def get_bounding_polygon(path, block_rows=1024):
     '''
     Get the minimum bounding region
     @param path - path to h5 file from which to read TS data
+    @param block_rows - number of rows of the first frame read at a time
     '''
-    fle = h5py.File("./Stack/NSBAS-PARAMS.h5", "r")
-    #Read out the first data frame, lats vector and lons vector.
-    data = fle["rawts"][0]
-    lons = fle["lon"]
-    lats = fle["lat"]
-    #Create a grid of lon, lat pairs
-    coords = np.dstack(np.meshgrid(lons,lats))
-    #Calculate any point in the data that is not NaN, and grab the coordinates 
-    inx = ~np.isnan(data)
-    points = coords[inx]
+    with h5py.File(path, "r") as fle:
+        #Stream the first data frame, keeping only each row's extreme valid pixels.
+        #Every valid pixel of a row lies between them so the hull is unchanged.
+        rows, left, right = get_valid_row_extents(_FirstFrame(fle["rawts"]), block_rows)
+        lons = fle["lon"][:]
+        lats = fle["lat"][:]
+    points = np.vstack([
+        np.column_stack([lons[left], lats[rows]]),
+        np.column_stack([lons[right], lats[rows]]),
+    ])
     #Calculate the convex-hull of the data points.  This will be a mimimum
     #bounding convex-polygon.
     hull = scipy.spatial.ConvexHull(points)
@@ -75,6 +99,18 @@ def get_bounding_polygon(path):
     pts.append(pts[0])
     return pts
 
+
+class _FirstFrame(object):
+    '''
+    Row-sliceable view of the first frame of a (time, lat, lon) dataset
+    '''
+    def __init__(self, dset):
+        self.dset = dset
+        self.shape = dset.shape[1:]
+
+    def __getitem__(self, rows):
+        return self.dset[0, rows, :]
+
 def get_bperp(catalog):
     '''
     Return perpendicular baseline.
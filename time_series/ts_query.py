@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Per-pixel time-series queries over pixel-major GIAnT exports
+(see export_pixel_ts.py) with an LRU cache of decoded chunks.
+"""
+
+import os, sys, time, json, shutil, logging, argparse, tempfile, h5py
+from collections import OrderedDict
+import numpy as np
+
+from export_pixel_ts import export_pixel_major
+
+
+log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
+logging.basicConfig(format=log_format, level=logging.INFO)
+logger = logging.getLogger('ts_query')
+
+
+class TSQuery(object):
+    """Query time series of points, boxes and polygons from a pixel-major h5."""
+
+    def __init__(self, h5_file, dset="rawts", cache_chunks=256):
+        self.h5f = h5py.File(h5_file, "r")
+        self.dset = self.h5f[dset]
+        self.rows, self.cols, self.ndates = self.dset.shape
+        self.chunk_rows, self.chunk_cols = self.dset.chunks[:2]
+        self.lats = self.h5f["lat"][:] if "lat" in self.h5f else None
+        self.lons = self.h5f["lon"][:] if "lon" in self.h5f else None
+        self.cache_chunks = cache_chunks
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.h5f.close()
+        self.cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_chunk(self, cr, cc):
+        """Return chunk (cr, cc) as an array, reading it only on a cache miss."""
+
+        key = (cr, cc)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        r0, c0 = cr * self.chunk_rows, cc * self.chunk_cols
+        chunk = self.dset[r0:r0 + self.chunk_rows, c0:c0 + self.chunk_cols, :]
+        self.cache[key] = chunk
+        if len(self.cache) > self.cache_chunks: self.cache.popitem(last=False)
+        return chunk
+
+    def read_window(self, r0, r1, c0, c1):
+        """Return the (r1-r0, c1-c0, dates) window assembled from cached chunks."""
+
+        r0, c0 = max(r0, 0), max(c0, 0)
+        r1, c1 = min(r1, self.rows), min(c1, self.cols)
+        if r1 <= r0 or c1 <= c0:
+            raise RuntimeError("Window {} is outside the grid.".format((r0, r1, c0, c1)))
+        out = np.empty((r1 - r0, c1 - c0, self.ndates), self.dset.dtype)
+        for cr in range(r0 // self.chunk_rows, (r1 - 1) // self.chunk_rows + 1):
+            for cc in range(c0 // self.chunk_cols, (c1 - 1) // self.chunk_cols + 1):
+                chunk = self.get_chunk(cr, cc)
+                cr0, cc0 = cr * self.chunk_rows, cc * self.chunk_cols
+                sr0, sr1 = max(r0, cr0), min(r1, cr0 + chunk.shape[0])
+                sc0, sc1 = max(c0, cc0), min(c1, cc0 + chunk.shape[1])
+                out[sr0 - r0:sr1 - r0, sc0 - c0:sc1 - c0] = \
+                    chunk[sr0 - cr0:sr1 - cr0, sc0 - cc0:sc1 - cc0]
+        return out
+
+    def to_pixel(self, lat, lon):
+        """Return (row, col) of the grid cell nearest to lat/lon."""
+
+        if self.lats is None or self.lons is None:
+            raise RuntimeError("No lat/lon datasets; run prep_tds.py before exporting.")
+        row = int(np.abs(self.lats - lat).argmin())
+        col = int(np.abs(self.lons - lon).argmin())
+        return row, col
+
+    def pixel(self, row, col):
+        """Return the time series of pixel (row, col)."""
+
+        return self.read_window(row, row + 1, col, col + 1)[0, 0]
+
+    def point(self, lat, lon):
+        """Return the time series of the pixel nearest to lat/lon."""
+
+        return self.pixel(*self.to_pixel(lat, lon))
+
+    def box(self, min_lat, max_lat, min_lon, max_lon):
+        """Return the (rows, cols, dates) cube of pixels within a lat/lon box."""
+
+        ra, ca = self.to_pixel(max_lat, min_lon)
+        rb, cb = self.to_pixel(min_lat, max_lon)
+        return self.read_window(min(ra, rb), max(ra, rb) + 1,
+                                min(ca, cb), max(ca, cb) + 1)
+
+    def polygon(self, coords, reduce=np.nanmean):
+        """Return time series of pixels inside polygon coords [[lon, lat], ...].
+
+        If reduce is given it is applied over the pixels and a single series
+        is returned, otherwise a (npixels, dates) array.
+        """
+
+        coords = np.asarray(coords, dtype=np.float64)
+        lons, lats = coords[:, 0], coords[:, 1]
+        ra, ca = self.to_pixel(lats.max(), lons.min())
+        rb, cb = self.to_pixel(lats.min(), lons.max())
+        r0, r1 = min(ra, rb), max(ra, rb) + 1
+        c0, c1 = min(ca, cb), max(ca, cb) + 1
+        win = self.read_window(r0, r1, c0, c1)
+        glon, glat = np.meshgrid(self.lons[c0:c1], self.lats[r0:r1])
+        mask = points_in_polygon(glon, glat, lons, lats)
+        series = win[mask]
+        if reduce is None: return series
+        return reduce(series, axis=0)
+
+
+def points_in_polygon(x, y, px, py):
+    """Vectorized even-odd rule test of points (x, y) against polygon (px, py)."""
+
+    inside = np.zeros(x.shape, dtype=bool)
+    n = len(px)
+    for i in range(n):
+        x0, y0 = px[i], py[i]
+        x1, y1 = px[(i + 1) % n], py[(i + 1) % n]
+        if y0 == y1: continue
+        crosses = (y0 > y) != (y1 > y)
+        xint = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < xint)
+    return inside
+
+
+def create_synthetic_cube(h5_file, ndates=500, rows=512, cols=512):
+    """Write a date-major GIAnT-like cube for benchmarking."""
+
+    with h5py.File(h5_file, "w") as h5f:
+        h5f.create_dataset("dates", data=np.arange(736000, 736000 + ndates * 12, 12,
+                                                   dtype=np.float64))
+        h5f.create_dataset("lat", data=np.linspace(35., 34., rows))
+        h5f.create_dataset("lon", data=np.linspace(-118., -117., cols))
+        cube = h5f.create_dataset("rawts", (ndates, rows, cols), np.float32)
+        for i in range(ndates):
+            cube[i] = np.random.randn(rows, cols).astype(np.float32)
+
+
+def benchmark(work_dir, ndates=500, rows=512, cols=512, nqueries=50):
+    """Compare cold and warm point query latency on a synthetic cube."""
+
+    src = os.path.join(work_dir, "synthetic-PARAMS.h5")
+    dst = os.path.join(work_dir, "synthetic-PIXEL.h5")
+    create_synthetic_cube(src, ndates, rows, cols)
+    rng = np.random.RandomState(0)
+    pix = list(zip(rng.randint(0, rows, nqueries), rng.randint(0, cols, nqueries)))
+
+    # baseline: slice the date-major cube directly
+    with h5py.File(src, "r") as h5f:
+        t0 = time.time()
+        for r, c in pix: h5f["rawts"][:, r, c]
+        date_major = (time.time() - t0) / nqueries
+
+    t0 = time.time()
+    export_pixel_major(src, dst)
+    export_time = time.time() - t0
+
+    with TSQuery(dst) as q:
+        t0 = time.time()
+        for r, c in pix: q.pixel(r, c)
+        cold = (time.time() - t0) / nqueries
+        t0 = time.time()
+        for r, c in pix: q.pixel(r, c)
+        warm = (time.time() - t0) / nqueries
+    results = {
+        "cube": [ndates, rows, cols],
+        "export_s": export_time,
+        "date_major_query_ms": date_major * 1e3,
+        "cold_query_ms": cold * 1e3,
+        "warm_query_ms": warm * 1e3,
+    }
+    logger.info("benchmark: {}".format(json.dumps(results, indent=2)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="cmd")
+    p = sub.add_parser("point", help="time series of the pixel nearest to lat/lon")
+    p.add_argument("h5_file")
+    p.add_argument("lat", type=float)
+    p.add_argument("lon", type=float)
+    p.add_argument("-d", "--dset", default="rawts")
+    b = sub.add_parser("benchmark", help="cold/warm query latency on a synthetic cube")
+    b.add_argument("-n", "--ndates", type=int, default=500)
+    b.add_argument("-s", "--size", type=int, default=512)
+    args = parser.parse_args()
+    if args.cmd == "point":
+        with TSQuery(args.h5_file, args.dset) as q:
+            print(json.dumps(q.point(args.lat, args.lon).tolist()))
+    elif args.cmd == "benchmark":
+        work_dir = tempfile.mkdtemp(prefix="ts_query_")
+        try: benchmark(work_dir, args.ndates, args.size, args.size)
+        finally: shutil.rmtree(work_dir)
+    else:
+        parser.print_help()
@@ -0,0 +1,289 @@
+"""
+Browse images and KMZ of geocoded ISCE rasters without mdx and ImageMagick.
+
+A raster is read once, in strips of rows through a memory map, and averaged
+down (ignoring nodata) to the sizes of the full, browse and small images at the
+same time. Several renderings of the same raster (e.g. the unwrapped phase at
+different wrap rates and the amplitude) are made from that single read:
+
+    rmg     amplitude as brightness and the second band, wrapped, as cmy color
+    amp     amplitude of the first band in gray levels
+    phase   second band, wrapped, as cmy color at full brightness
+
+The amplitude brightness is the square root of the amplitude normalized by
+twice its mean, and pixels with zero (nodata) amplitude are transparent, as
+after "convert -transparent black" of the mdx output. PNGs are written with
+zlib only, and full size images are rendered and compressed in strips of rows.
+"""
+
+import os
+import zlib
+import struct
+import zipfile
+import numpy as np
+
+from utils.cog import average_levels
+from utils.isce_raster import open_image, get_image_info
+
+__all__ = ['cmy', 'render', 'render_strips', 'write_png', 'write_png_strips', 'read_png',
+           'read_decimated', 'render_browse', 'write_kml', 'write_kmz', 'image_snwe']
+
+#cmy colormap: cyan, magenta, yellow and back to cyan
+CMY = np.array([[0., 1., 1.], [1., 0., 1.], [1., 1., 0.], [0., 1., 1.]], dtype=np.float32)
+
+
+def cmy(frac):
+    '''
+    RGB in [0, 1] of the cyclic cmy colormap at frac in [0, 1).
+    '''
+    pos = np.asarray(frac, dtype=np.float32) * np.float32(3)
+    idx = np.clip(np.floor(pos), 0, 2)
+    t = (pos - idx)[..., None]
+    idx = idx.astype(np.intp)
+    return CMY[idx] * (1 - t) + CMY[idx + 1] * t
+
+
+def render(kind, bands, wrap=2*np.pi, amp_scale=None):
+    '''
+    RGBA uint8 image of bands (first band amplitude, second band phase or
+    coherence) for the rendering kind rmg, amp or phase. amp_scale defaults to
+    twice the mean valid amplitude. Computed in float32.
+    '''
+    amp = np.asarray(bands[0], dtype=np.float32)
+    valid = np.isfinite(amp) & (amp != 0)
+    if kind == 'phase':
+        val = np.asarray(bands[1], dtype=np.float32)
+        valid = np.isfinite(val) & (val != 0)
+
+    if amp_scale is None:
+        amp_scale = 2.0 * amp[valid].mean(dtype=np.float64) if valid.any() else 1.0
+
+    bright = np.sqrt(np.clip(np.where(valid, amp, 0) / np.float32(amp_scale), 0, 1))
+    if kind == 'amp':
+        rgb = np.repeat(bright[..., None], 3, axis=-1)
+    else:
+        wrap = np.float32(wrap)
+        val = np.where(valid, np.asarray(bands[1], dtype=np.float32), 0)
+        rgb = cmy(np.mod(val, wrap) / wrap)
+        if kind == 'rmg':
+            rgb = rgb * bright[..., None]
+        elif kind != 'phase':
+            raise ValueError('Unknown rendering: %s' % kind)
+
+    out = np.zeros(amp.shape + (4,), dtype=np.uint8)
+    out[..., :3] = np.round(rgb * 255)
+    out[..., 3] = 255
+    out[~valid] = 0
+    return out
+
+
+def render_strips(kind, bands, wrap=2*np.pi, amp_scale=None, strip_rows=512):
+    '''
+    Render as render in strips of strip_rows rows, yielding the RGBA strips top to
+    bottom. amp_scale defaults to twice the mean valid amplitude of all bands.
+    '''
+    if amp_scale is None:
+        amp = np.asarray(bands[0])
+        amp = amp[np.isfinite(amp) & (amp != 0)]
+        amp_scale = 2.0 * amp.mean(dtype=np.float64) if amp.size else 1.0
+    for r0 in range(0, bands[0].shape[0], strip_rows):
+        yield render(kind, [b[r0:r0+strip_rows] for b in bands], wrap, amp_scale)
+
+
+def _chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def write_png_strips(fname, length, width, strips, nchan=4, level=6):
+    '''
+    Write the (rows, width, nchan) uint8 strips, top to bottom, of a length x width
+    image as RGB or RGBA PNG. The strips are compressed as they come, one IDAT
+    chunk each, so only one strip is in memory at a time.
+    '''
+    header = struct.pack('>IIBBBBB', width, length, 8, 6 if nchan == 4 else 2, 0, 0, 0)
+    comp = zlib.compressobj(level)
+    nrows = 0
+    with open(fname, 'wb') as fid:
+        fid.write(b'\x89PNG\r\n\x1a\n')
+        fid.write(_chunk(b'IHDR', header))
+        for strip in strips:
+            strip = np.ascontiguousarray(strip, dtype=np.uint8)
+            raw = np.zeros((strip.shape[0], 1 + width * nchan), dtype=np.uint8)
+            raw[:, 1:] = strip.reshape(strip.shape[0], -1)
+            nrows += strip.shape[0]
+            data = comp.compress(raw.tobytes())
+            if data:
+                fid.write(_chunk(b'IDAT', data))
+        fid.write(_chunk(b'IDAT', comp.flush()))
+        fid.write(_chunk(b'IEND', b''))
+    if nrows != length:
+        raise ValueError('Wrote %d rows of %d to %s' % (nrows, length, fname))
+    return fname
+
+
+def write_png(fname, img, level=6):
+    '''
+    Write a (length, width, 3 or 4) uint8 image as RGB or RGBA PNG.
+    '''
+    length, width, nchan = np.shape(img)
+    return write_png_strips(fname, length, width, [img], nchan, level)
+
+
+def read_png(fname):
+    '''
+    Read an 8 bit RGB/RGBA PNG without row filters, as written by write_png.
+    '''
+    with open(fname, 'rb') as fid:
+        data = fid.read()
+    pos = 8
+    idat = []
+    while pos < len(data):
+        size, = struct.unpack('>I', data[pos:pos+4])
+        tag = data[pos+4:pos+8]
+        body = data[pos+8:pos+8+size]
+        if tag == b'IHDR':
+            width, length, depth, ctype = struct.unpack('>IIBB', body[:10])
+        elif tag == b'IDAT':
+            idat.append(body)
+        pos += size + 12
+
+    nchan = 4 if ctype == 6 else 3
+    raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8).reshape(length, -1)
+    if depth != 8 or np.any(raw[:, 0] != 0):
+        raise ValueError('Only unfiltered 8 bit PNGs are supported: %s' % fname)
+    return raw[:, 1:].reshape(length, width, nchan)
+
+
+class _Decimator(object):
+    '''
+    Averages rows pushed in strips over level x level blocks, carrying over the
+    rows that do not fill a block yet.
+    '''
+    def __init__(self, level, nodata):
+        self.level = level
+        self.nodata = nodata
+        self.rest = None
+        self.out = []
+
+    def push(self, rows):
+        if self.rest is not None:
+            rows = np.concatenate([self.rest, rows])
+        nfull = (rows.shape[0] // self.level) * self.level
+        if nfull:
+            self.out.append(average_levels(rows[:nfull], (self.level,), self.nodata)[0])
+        self.rest = rows[nfull:] if nfull < rows.shape[0] else None
+
+    def finish(self):
+        if self.rest is not None:
+            self.out.append(average_levels(self.rest, (self.level,), self.nodata)[0])
+            self.rest = None
+        return np.concatenate(self.out)
+
+
+def decimation(width, max_width):
+    '''
+    Averaging factor to reduce width below max_width, as used by createImage.
+    '''
+    if (max_width is None) or (width < max_width):
+        return 1
+    return int(width / max_width)
+
+
+def read_decimated(fname, levels, bands=(0, 1), nodata=0, strip_rows=512):
+    '''
+    Read bands of an ISCE image once and return, for each level, the list of
+    bands averaged over level x level blocks ignoring nodata.
+    '''
+    img = open_image(fname)
+    bands = [b for b in bands if b < img.nbands]
+    decs = [[_Decimator(level, nodata) for b in bands] for level in levels]
+    for r0 in range(0, img.length, strip_rows):
+        r1 = min(r0 + strip_rows, img.length)
+        for kk, b in enumerate(bands):
+            rows = np.array(img.bands[b][r0:r1], dtype=np.float32)
+            for dec in decs:
+                dec[kk].push(rows)
+    return [[d.finish() for d in dec] for dec in decs]
+
+
+def render_browse(fname, items, outdir='.', full=(), max_full=None, max_width=800,
+                  max_width_small=300, nodata=0, strip_rows=512):
+    '''
+    Render items [(name, kind, wrap)] of the ISCE image fname from a single read
+    into <name>.browse.png and <name>.browse_small.png in outdir, reduced as in
+    createImage but by block averaging. For the names in full, <name>.png is also
+    written at full size (averaged down below max_full if given), rendered and
+    written in strips of strip_rows rows. Returns the full size png file names.
+    '''
+    width = get_image_info(fname)['width']
+    levels = [decimation(width, max_full), decimation(width, max_width), decimation(width, max_width_small)]
+    if not full: levels = levels[1:]
+    sizes = read_decimated(fname, levels, nodata=nodata)
+
+    ####The same amplitude scaling at all sizes
+    amp = sizes[0][0][np.isfinite(sizes[0][0]) & (sizes[0][0] != 0)]
+    amp_scale = 2.0 * amp.mean() if amp.size else 1.0
+
+    pngs = []
+    for name, kind, wrap in items:
+        if name in full:
+            length, width = sizes[0][0].shape
+            pngs.append(write_png_strips(os.path.join(outdir, name + '.png'), length, width,
+                                         render_strips(kind, sizes[0], wrap, amp_scale, strip_rows)))
+        write_png(os.path.join(outdir, name + '.browse.png'), render(kind, sizes[-2], wrap, amp_scale))
+        write_png(os.path.join(outdir, name + '.browse_small.png'), render(kind, sizes[-1], wrap, amp_scale))
+    return pngs
+
+
+def image_snwe(fname):
+    '''
+    South, north, west and east edges of a geocoded ISCE image.
+    '''
+    info = get_image_info(fname)
+    lon0 = float(info['coordinate1']['startingvalue'])
+    dlon = float(info['coordinate1']['delta'])
+    lat0 = float(info['coordinate2']['startingvalue'])
+    dlat = float(info['coordinate2']['delta'])
+    lat1 = lat0 + dlat * info['length']
+    lon1 = lon0 + dlon * info['width']
+    return [min(lat0, lat1), max(lat0, lat1), min(lon0, lon1), max(lon0, lon1)]
+
+
+def write_kml(kml_file, png_file, snwe, name=None):
+    '''
+    KML ground overlay of png_file over the snwe box.
+    '''
+    name = name or os.path.basename(png_file)
+    kml = '''<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <GroundOverlay>
+    <name>{0}</name>
+    <Icon>
+      <href>{1}</href>
+    </Icon>
+    <LatLonBox>
+      <north>{3}</north>
+      <south>{2}</south>
+      <east>{5}</east>
+      <west>{4}</west>
+    </LatLonBox>
+  </GroundOverlay>
+</kml>
+'''.format(name, os.path.basename(png_file), *snwe)
+    with open(kml_file, 'w') as fid:
+        fid.write(kml)
+    return kml_file
+
+
+def write_kmz(kmz_file, png_file, snwe, name=None):
+    '''
+    KMZ with a ground overlay of png_file over the snwe box.
+    '''
+    kmz_base = os.path.splitext(os.path.basename(kmz_file))[0]
+    kml = write_kml(os.path.join(os.path.dirname(os.path.abspath(kmz_file)), kmz_base + '.kml'),
+                    png_file, snwe, name)
+    with zipfile.ZipFile(kmz_file, 'w') as z:
+        z.write(kml, os.path.basename(kml))
+        z.write(png_file, os.path.basename(png_file))
+    os.unlink(kml)
+    return kmz_file
@@ -0,0 +1,200 @@
+"""
+Cloud optimized GeoTIFF writer.
+
+Overviews are computed by block averaging from a single streamed pass over the
+source raster, in strips of rows, and stored as external overviews of a
+temporary VRT. The COG is then written in one compressed copy with the
+overviews placed before the full resolution data, as gdal_translate with
+COPY_SRC_OVERVIEWS does. Averaging ignores nodata (and NaN) pixels like
+gdaladdo -r average.
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+__all__ = ['DEFAULT_LEVELS', 'overview_size', 'average_levels', 'raw_vrt', 'write_cog']
+
+DEFAULT_LEVELS = (2, 4, 8, 16, 32)
+
+#numpy to GDAL data type names for raw VRTs
+VRT_TYPES = {'uint8': 'Byte', 'int16': 'Int16', 'uint16': 'UInt16', 'int32': 'Int32',
+             'uint32': 'UInt32', 'float32': 'Float32', 'float64': 'Float64'}
+
+
+def overview_size(size, level):
+    '''
+    Number of overview pixels along a dimension, as GDAL computes it.
+    '''
+    return (size + level - 1) // level
+
+
+def _block_sums(data, factor):
+    '''
+    Sums over factor x factor blocks, padding ragged edges with zeros.
+    '''
+    length, width = data.shape
+    olen = overview_size(length, factor)
+    owid = overview_size(width, factor)
+    if (olen * factor != length) or (owid * factor != width):
+        pad = np.zeros((olen * factor, owid * factor), dtype=data.dtype)
+        pad[:length, :width] = data
+        data = pad
+    return data.reshape(olen, factor, owid, factor).sum(axis=(1, 3))
+
+
+def average_levels(data, levels=DEFAULT_LEVELS, nodata=None):
+    '''
+    Averages of data over level x level blocks for each level, ignoring nodata
+    and NaN pixels. Blocks without valid pixels are set to nodata (NaN if nodata
+    is None). Each level is computed from the sums of the previous one when it
+    divides it, so the base is only traversed once.
+    '''
+    data = np.asarray(data)
+    valid = ~np.isnan(data) if np.issubdtype(data.dtype, np.floating) else np.ones(data.shape, dtype=bool)
+    if (nodata is not None) and not np.isnan(nodata):
+        valid &= (data != nodata)
+
+    base = (np.where(valid, data, 0).astype(np.float64), valid.astype(np.int32))
+    sums, counts, prev = base[0], base[1], 1
+    fill = np.nan if nodata is None else nodata
+
+    out = []
+    for level in levels:
+        if level % prev == 0:
+            sums, counts = _block_sums(sums, level // prev), _block_sums(counts, level // prev)
+        else:
+            sums, counts = _block_sums(base[0], level), _block_sums(base[1], level)
+        prev = level
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = sums / counts
+        avg[counts == 0] = fill
+        if np.issubdtype(data.dtype, np.integer):
+            avg = np.round(avg)
+        out.append(avg.astype(data.dtype))
+
+    return out
+
+
+def raw_vrt(vrt_file, files, width, length, geotrans=None, dtype=np.float32, nodata=None,
+            descriptions=None, srs='EPSG:4326'):
+    '''
+    Write a VRT for single band flat binary files (one band per file), so that
+    they can be read by GDAL.
+    '''
+    dtype = np.dtype(dtype)
+    lines = ['<VRTDataset rasterXSize="{0}" rasterYSize="{1}">'.format(width, length)]
+    if geotrans is not None:
+        lines.append('  <SRS>{0}</SRS>'.format(srs))
+        lines.append('  <GeoTransform>{0}</GeoTransform>'.format(', '.join(repr(float(x)) for x in geotrans)))
+
+    for kk, fname in enumerate(files):
+        lines.append('  <VRTRasterBand dataType="{0}" band="{1}" subClass="VRTRawRasterBand">'.format(
+                     VRT_TYPES[dtype.name], kk+1))
+        if descriptions is not None:
+            lines.append('    <Description>{0}</Description>'.format(descriptions[kk]))
+        if nodata is not None:
+            lines.append('    <NoDataValue>{0}</NoDataValue>'.format(nodata))
+        lines.append('    <SourceFilename relativeToVRT="0">{0}</SourceFilename>'.format(os.path.abspath(fname)))
+        lines.append('    <ImageOffset>0</ImageOffset>')
+        lines.append('    <PixelOffset>{0}</PixelOffset>'.format(dtype.itemsize))
+        lines.append('    <LineOffset>{0}</LineOffset>'.format(dtype.itemsize * width))
+        lines.append('    <ByteOrder>LSB</ByteOrder>')
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+
+    with open(vrt_file, 'w') as fid:
+        fid.write('\n'.join(lines) + '\n')
+    return vrt_file
+
+
+def write_cog(src, dst, nodata=None, levels=DEFAULT_LEVELS, blocksize=512, compress='DEFLATE',
+              num_threads='ALL_CPUS', predictor=False, strip_rows=None):
+    '''
+    Write the GDAL readable raster src as a COG dst with average overviews at the
+    given levels. nodata is set on all bands (default: keep the source nodata).
+    The source is streamed once in strips of strip_rows rows (default: a multiple
+    of the largest level of at least blocksize rows) to compute the overviews,
+    and read once more by the compressed copy. Compression uses num_threads
+    threads. Returns the overview levels written.
+    '''
+    from osgeo import gdal
+    gdal.UseExceptions()
+
+    src_ds = gdal.Open(src) if isinstance(src, str) else src
+    width, length, nbands = src_ds.RasterXSize, src_ds.RasterYSize, src_ds.RasterCount
+    levels = [x for x in sorted(levels) if (length // x >= 1) and (width // x >= 1)]
+
+    if nodata is None:
+        nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+
+    tmpdir = tempfile.mkdtemp(prefix='cog_', dir=os.path.dirname(os.path.abspath(dst)))
+    try:
+        ####Source VRT with nodata, overviews are attached to it as an external .ovr
+        vrt_file = os.path.join(tmpdir, 'src.vrt')
+        vrt_ds = gdal.GetDriverByName('VRT').CreateCopy(vrt_file, src_ds)
+        if nodata is not None:
+            for kk in range(nbands):
+                vrt_ds.GetRasterBand(kk+1).SetNoDataValue(nodata)
+        vrt_ds.FlushCache()
+        vrt_ds = None
+
+        if levels:
+            ####The .ovr is a tiff with the first level as base and the others as its overviews
+            band = src_ds.GetRasterBand(1)
+            ovr_ds = gdal.GetDriverByName('GTiff').Create(vrt_file + '.ovr',
+                    overview_size(width, levels[0]), overview_size(length, levels[0]), nbands,
+                    band.DataType, ['TILED=YES', 'BLOCKXSIZE={0}'.format(blocksize),
+                                    'BLOCKYSIZE={0}'.format(blocksize), 'BIGTIFF=IF_SAFER'])
+            if len(levels) > 1:
+                ovr_ds.BuildOverviews('NONE', [x // levels[0] for x in levels[1:]])
+
+            ovr_bands = []
+            for kk in range(nbands):
+                obase = ovr_ds.GetRasterBand(kk+1)
+                if nodata is not None:
+                    obase.SetNoDataValue(nodata)
+                ovr_bands.append([obase] + [obase.GetOverview(ii) for ii in range(len(levels)-1)])
+
+            if strip_rows is None:
+                strip_rows = max(blocksize, levels[-1])
+            strip_rows = -(-strip_rows // levels[-1]) * levels[-1]
+
+            for r0 in range(0, length, strip_rows):
+                nrows = min(strip_rows, length - r0)
+                for kk in range(nbands):
+                    data = src_ds.GetRasterBand(kk+1).ReadAsArray(0, r0, width, nrows)
+                    for ii, avg in enumerate(average_levels(data, levels, nodata)):
+                        ovr_bands[kk][ii].WriteArray(avg, 0, r0 // levels[ii])
+
+            ovr_ds.FlushCache()
+            ovr_ds = None
+
+        ####Single compressed copy with the overviews ahead of the full resolution data
+        vrt_ds = gdal.Open(vrt_file)
+        if gdal.GetDriverByName('COG') is not None:
+            opts = ['BLOCKSIZE={0}'.format(blocksize), 'COMPRESS={0}'.format(compress),
+                    'NUM_THREADS={0}'.format(num_threads), 'BIGTIFF=IF_SAFER',
+                    'OVERVIEWS={0}'.format('FORCE_USE_EXISTING' if levels else 'NONE')]
+            if predictor:
+                opts.append('PREDICTOR=YES')
+            gdal.GetDriverByName('COG').CreateCopy(dst, vrt_ds, options=opts)
+        else:
+            opts = ['TILED=YES', 'COPY_SRC_OVERVIEWS=YES', 'BLOCKXSIZE={0}'.format(blocksize),
+                    'BLOCKYSIZE={0}'.format(blocksize), 'COMPRESS={0}'.format(compress),
+                    'NUM_THREADS={0}'.format(num_threads), 'BIGTIFF=IF_SAFER']
+            if predictor:
+                fp = gdal.GetDataTypeName(vrt_ds.GetRasterBand(1).DataType).startswith('Float')
+                opts.append('PREDICTOR={0}'.format(3 if fp else 2))
+            gdal.SetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE', str(blocksize))
+            try:
+                gdal.GetDriverByName('GTiff').CreateCopy(dst, vrt_ds, options=opts)
+            finally:
+                gdal.SetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE', None)
+        vrt_ds = None
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return levels
@@ -14,23 +14,25 @@ import logging
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
 logging.basicConfig(format=log_format, level=logging.INFO)
 logger = logging.getLogger('createImage')
-def call_noerr(cmd):
+def call_noerr(cmd, cwd=None):
     """Run command and warn if exit status is not 0."""
 
-    try: check_call(cmd, shell=True)
+    try: check_call(cmd, shell=True, cwd=cwd)
     except Exception as e:
         logger.warn("Got exception running {}: {}".format(cmd, str(e)))
         logger.warn("Traceback: {}".format(traceback.format_exc()))
-def createImage(command,item):
+def createImage(command,item,cwd=None):
     #print(command)
+    #files are created in cwd (default: current directory) without changing directory
+    path = lambda x: x if cwd is None else os.path.join(cwd, x)
     max_width = 800
     max_width_small = 300
     name1 = item + '.png'
     final = item + '.browse.png'
     finalSmall = item + '.browse_small.png'
-    call_noerr(command)
-    call_noerr('convert out.ppm -transparent black ' + name1)
-    im = mpimg.imread(name1)
+    call_noerr(command, cwd)
+    call_noerr('convert out.ppm -transparent black ' + name1, cwd)
+    im = mpimg.imread(path(name1))
     #if there is alpha channel set transparency to one (makes it black) where all data are zero
     if im.shape[2] == 4:
         im[im[:,:,3] == 0,3] = 1
@@ -39,16 +41,16 @@ def createImage(command,item):
     #reduce the width to max 512 for normal size and 128 for small size
     resamp = 1 if width < max_width else int(width/max_width)
     if(resamp == 1):
-        call_noerr('cp ' + name1 + ' ' + final)
+        call_noerr('cp ' + name1 + ' ' + final, cwd)
     else:
-        mpimg.imsave(final,im[::resamp,::resamp,:])
+        mpimg.imsave(path(final),im[::resamp,::resamp,:])
    
     resamp = 1 if width < max_width_small else int(width/max_width_small)
     if(resamp == 1):
-        call_noerr('cp ' + name1 + ' ' + finalSmall)
+        call_noerr('cp ' + name1 + ' ' + finalSmall, cwd)
     else:
-        mpimg.imsave(finalSmall,im[::resamp,::resamp,:])
-    if os.path.exists('out.ppm'):
-        os.unlink('out.ppm')
-    if os.path.exists(name1):
-        os.unlink(name1)
+        mpimg.imsave(path(finalSmall),im[::resamp,::resamp,:])
+    if os.path.exists(path('out.ppm')):
+        os.unlink(path('out.ppm'))
+    if os.path.exists(path(name1)):
+        os.unlink(path(name1))
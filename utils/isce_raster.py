@@ -0,0 +1,220 @@
+"""
+Zero-copy access to ISCE raster images.
+
+Images are opened from their .xml metadata (or explicit dimensions) as a single
+numpy memmap of the file and each band is exposed as a 2D (length, width) view,
+whatever the interleaving scheme. Row-strip and tile iterators with optional
+halo are provided for block processing.
+"""
+
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+import numpy as np
+
+__all__ = ['ISCE_TYPES', 'get_image_info', 'numpy_type', 'RasterImage',
+           'open_image', 'create_image', 'Window', 'row_blocks', 'tile_blocks']
+
+#ISCE data type names to numpy types. The complex integer types have no numpy
+#equivalent and are read as interleaved (re, im) pairs.
+ISCE_TYPES = {'BYTE': np.int8,
+              'CBYTE': np.dtype([('re', 'i1'), ('im', 'i1')]),
+              'SHORT': np.int16,
+              'CSHORT': np.dtype([('re', 'i2'), ('im', 'i2')]),
+              'INT': np.int32,
+              'LONG': np.int64,
+              'FLOAT': np.float32,
+              'DOUBLE': np.float64,
+              'CFLOAT': np.complex64,
+              'CDOUBLE': np.complex128}
+
+SCHEMES = ('BIL', 'BIP', 'BSQ')
+
+
+def numpy_type(data_type):
+    '''
+    Return the numpy type for an ISCE data type name or any numpy type spec.
+    '''
+    try:
+        return np.dtype(ISCE_TYPES[str(data_type).upper()])
+    except KeyError:
+        return np.dtype(data_type)
+
+
+def get_image_info(fname):
+    '''
+    Parse the properties of an ISCE image xml. Returns a dict with the lower case
+    property names, the data file name and the width, length, bands, scheme and dtype.
+    When opened from the xml, the data file is the file_name property looked up
+    next to the xml, or the xml name without .xml if it is missing. The properties of the coordinate components are under their names, e.g.
+    info['coordinate1']['startingvalue'].
+    '''
+    if fname.endswith('.xml'):
+        xml_file = fname
+        data_file = fname[:-4]
+    else:
+        xml_file = fname + '.xml'
+        data_file = fname
+
+    root = ET.parse(xml_file).getroot()
+    prop = {}
+    for p in root.findall('property'):
+        val = p.find('value')
+        prop[p.attrib['name'].lower()] = val.text.strip() if val is not None and val.text else None
+
+    #the image size can also be only in the coordinate components
+    coords = {}
+    comps = {}
+    for c in root.findall('component'):
+        cprop = comps.setdefault(c.attrib['name'].lower(), {})
+        for p in c.findall('property'):
+            val = p.find('value')
+            cprop[p.attrib['name'].lower()] = val.text.strip() if val is not None and val.text else None
+            if p.attrib['name'].lower() == 'size':
+                coords[c.attrib['name'].lower()] = int(p.find('value').text)
+
+    info = dict(comps)
+    info.update(prop)
+    if fname.endswith('.xml') and prop.get('file_name'):
+        data_file = os.path.join(os.path.dirname(xml_file), os.path.basename(prop['file_name']))
+    info['filename'] = data_file
+    info['width'] = int(prop.get('width') or coords['coordinate1'])
+    info['length'] = int(prop.get('length') or coords['coordinate2'])
+    info['bands'] = int(prop.get('number_bands') or 1)
+    info['scheme'] = (prop.get('scheme') or 'BIP').upper()
+    info['dtype'] = numpy_type(prop.get('data_type') or 'FLOAT')
+    return info
+
+
+class Window(namedtuple('Window', ['rows', 'cols', 'halo_rows', 'halo_cols'])):
+    '''
+    A block of an image. rows and cols are the slices of the block, halo_rows and
+    halo_cols the slices of the block extended by the halo and clipped to the image.
+    '''
+    __slots__ = ()
+
+    @property
+    def inner(self):
+        '''
+        Slices of the block inside an array read over the halo window.
+        '''
+        r0 = self.rows.start - self.halo_rows.start
+        c0 = self.cols.start - self.halo_cols.start
+        return (slice(r0, r0 + self.rows.stop - self.rows.start),
+                slice(c0, c0 + self.cols.stop - self.cols.start))
+
+    def trim(self, arr):
+        '''
+        Remove the halo from an array read over the halo window.
+        '''
+        return arr[self.inner]
+
+
+def tile_blocks(length, width, block_rows, block_cols=None, halo=0):
+    '''
+    Iterate over the Windows of blocks of block_rows x block_cols covering a
+    length x width image. block_cols=None means full rows.
+    '''
+    if block_cols is None:
+        block_cols = width
+    for r0 in range(0, length, block_rows):
+        r1 = min(r0 + block_rows, length)
+        for c0 in range(0, width, block_cols):
+            c1 = min(c0 + block_cols, width)
+            yield Window(slice(r0, r1), slice(c0, c1),
+                         slice(max(r0 - halo, 0), min(r1 + halo, length)),
+                         slice(max(c0 - halo, 0), min(c1 + halo, width)))
+
+
+def row_blocks(length, width, block_rows, halo=0):
+    '''
+    Iterate over the Windows of full width strips of block_rows lines.
+    '''
+    return tile_blocks(length, width, block_rows, None, halo)
+
+
+class RasterImage(object):
+    '''
+    Memory map of an ISCE image with a 2D view per band.
+    '''
+    def __init__(self, fname, width, length=None, bands=1, scheme='BSQ',
+                 dtype=np.float32, mode='r'):
+        scheme = scheme.upper()
+        if scheme not in SCHEMES:
+            raise ValueError('Unknown file scheme: %s for file %s' % (scheme, fname))
+        dtype = numpy_type(dtype)
+        if width is None:
+            raise ValueError('Undefined file width for : %s' % (fname))
+
+        if mode in ('w+', 'write'):
+            if length is None:
+                raise ValueError('Undefined file length for opening file: %s in write mode.' % (fname))
+        else:
+            try:
+                nbytes = os.path.getsize(fname)
+            except OSError:
+                raise ValueError('Non-existent file : %s' % (fname))
+            line_bytes = dtype.itemsize * bands * width
+            if length is None:
+                length = nbytes // line_bytes
+                if length * line_bytes != nbytes:
+                    raise ValueError('File size mismatch for %s. Fractional number of lines' % (fname))
+            elif length * line_bytes > nbytes:
+                raise ValueError('File size mismatch for %s. Number of bytes expected: %d' % (fname, length * line_bytes))
+
+        self.name = fname
+        self.width = width
+        self.length = length
+        self.nbands = bands
+        self.scheme = scheme
+        self.dtype = dtype
+
+        if scheme == 'BIL':
+            shape = (length, bands, width)
+        elif scheme == 'BIP':
+            shape = (length, width, bands)
+        else:
+            shape = (bands, length, width)
+        self.data = np.memmap(fname, dtype=dtype, mode=mode, shape=shape)
+
+        if scheme == 'BIL':
+            self.bands = [self.data[:, i, :] for i in range(bands)]
+        elif scheme == 'BIP':
+            self.bands = [self.data[:, :, i] for i in range(bands)]
+        else:
+            self.bands = [self.data[i] for i in range(bands)]
+
+    @property
+    def shape(self):
+        return (self.length, self.width)
+
+    def band(self, i=0):
+        return self.bands[i]
+
+    def blocks(self, block_rows, block_cols=None, halo=0, band=0):
+        '''
+        Iterate over (window, data) where data is the view of band over the halo window.
+        '''
+        bnd = self.bands[band]
+        for win in tile_blocks(self.length, self.width, block_rows, block_cols, halo):
+            yield win, bnd[win.halo_rows, win.halo_cols]
+
+    def flush(self):
+        self.data.flush()
+
+
+def open_image(fname, mode='r', dtype=None):
+    '''
+    Open an ISCE image using the information in its xml file. dtype overrides
+    the data type in the xml.
+    '''
+    info = get_image_info(fname)
+    return RasterImage(info['filename'], info['width'], info['length'], info['bands'],
+                       info['scheme'], info['dtype'] if dtype is None else dtype, mode)
+
+
+def create_image(fname, width, length, bands=1, scheme='BSQ', dtype=np.float32):
+    '''
+    Create a new image file of the given size.
+    '''
+    return RasterImage(fname, width, length, bands, scheme, dtype, 'w+')